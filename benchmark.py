@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline benchmark of the service classes against tinyback.mockserver
+
+The mock server runs in a child process, so the CPU time reported per code is
+that of the client alone. Service rate limits are not applied.
+
+With --parse, responses are captured from the mock handlers up front and only
+the parsing of codes answered with an HTML page is timed, without sockets.
+
+With --compression, the gzipped result files given as arguments are
+decompressed and compressed again with every available backend and level of
+tinyback.compression, reporting throughput and compression ratio.
+"""
+
+import gzip
+import httplib
+import multiprocessing
+import optparse
+import os
+import threading
+import time
+
+from tinyback import aio, compression, exceptions, generators, mockserver, services
+
+PARSE_PASSES = 10
+"""Number of times every captured page is parsed with --parse"""
+
+COMPRESSION_LEVELS = {
+    "gzip": (1, 6, 9),
+    "zlib": (1, 6, 9),
+    "xz": (0, 6, 9),
+    "zstd": (1, 3, 9, 19),
+    "lz4": (0, 9),
+}
+"""Levels of every backend tried with --compression"""
+
+COMPRESSION_MIN_TIME = 1.0
+"""Seconds every backend and level is timed at least with --compression"""
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options] [RESULTS...]")
+
+    parser.add_option("-s", "--services", dest="services",
+        help="Comma-separated list of services (default: all)",
+        metavar="NAMES")
+    parser.add_option("-n", "--codes", dest="codes", type="int",
+        default=1000, help="Fetch N codes per service (default: 1000)",
+        metavar="N")
+    parser.add_option("-w", "--window", dest="window", type="int", default=1,
+        help="Fetch with N threads per service (default: 1)", metavar="N")
+    parser.add_option("-l", "--latency", dest="latency", type="float",
+        default=0, help="Delay every answer by MS milliseconds",
+        metavar="MS")
+    parser.add_option("-e", "--error-rate", dest="error_rate", type="float",
+        default=0, help="Answer a fraction P of the requests with HTTP "
+        "status 503", metavar="P")
+    parser.add_option("-r", "--rate-limit", dest="rate_limit",
+        help="Block requests beyond N per SECONDS for every service",
+        metavar="N/SECONDS")
+    parser.add_option("-p", "--parse", dest="parse", action="store_true",
+        default=False, help="Only time parsing of captured pages")
+    parser.add_option("-z", "--compression", dest="compression",
+        action="store_true", default=False, help="Time compression of the "
+        "gzipped RESULTS files instead")
+
+    options, args = parser.parse_args()
+    if options.compression:
+        if not args:
+            parser.error("--compression needs result files")
+        options.results = args
+    elif args:
+        parser.error("Unexpected argument %s" % args[0])
+    if options.rate_limit:
+        try:
+            requests, period = options.rate_limit.split("/")
+            options.rate_limit = (int(requests), float(period))
+        except ValueError:
+            parser.error("Bad rate limit %s" % options.rate_limit)
+    if options.services:
+        options.services = options.services.split(",")
+        for name in options.services:
+            if name not in services._factory_map:
+                parser.error("Unknown service %s" % name)
+    else:
+        options.services = sorted(services._factory_map)
+
+    return options
+
+def test_codes(charset):
+    return generators.sequence_generator({
+        "charset": charset,
+        "start": charset[1] + charset[0] * 3,
+        "stop": charset[-1] * 4,
+    })
+
+def serve(options, addresses):
+    server = mockserver.MockServer(latency=options.latency / 1000.0,
+        error_rate=options.error_rate, rate_limit=options.rate_limit)
+    addresses.put(server.server_address)
+    server.serve_forever()
+
+def benchmark(name, address, options):
+    """
+    Fetch options.codes codes of the service, returns the statistics
+    """
+    codes = test_codes(mockserver.mock_service(name, address).charset)
+    codes_lock = threading.Lock()
+    issued = [0]
+    latencies = []
+    outcomes = {}
+
+    def worker():
+        service = mockserver.mock_service(name, address)
+        while True:
+            with codes_lock:
+                if issued[0] >= options.codes:
+                    return
+                issued[0] += 1
+                code = codes.next()
+            start = time.time()
+            try:
+                service.fetch(code)
+                outcome = "redirect"
+            except exceptions.CodeBlockedException:
+                outcome = "code blocked"
+            except exceptions.NoRedirectException:
+                outcome = "no redirect"
+            except exceptions.BlockedException:
+                outcome = "blocked"
+            except exceptions.ServiceException:
+                outcome = "error"
+            latency = time.time() - start
+            with codes_lock:
+                latencies.append(latency)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    cpu = sum(os.times()[:2])
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(options.window)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "codes": count,
+        "rate": count / elapsed,
+        "p50": latencies[count // 2],
+        "p99": latencies[min(count - 1, count * 99 // 100)],
+        "cpu": cpu / count,
+        "outcomes": outcomes,
+    }
+
+def capture(service, code):
+    """
+    Returns the responses fetch needs for the code, keyed by (method, path)
+    """
+    responses = {}
+    while True:
+        try:
+            service._replay_fetch(code, responses)
+        except services._PendingRequest, e:
+            resp = httplib.HTTPResponse(aio._BufferSocket(mockserver.capture(e.method, e.path)), method=e.method)
+            resp.begin()
+            responses[(e.method, e.path)] = (resp, resp.read())
+        except exceptions.ServiceException:
+            return responses
+        else:
+            return responses
+
+def benchmark_parse(name, options):
+    """
+    Parse options.codes pages of the service PARSE_PASSES times, returns the
+    statistics or None if the service does not parse pages
+    """
+    service = mockserver.mock_service(name, ("127.0.0.1", 80))
+    if not service.http_body_statuses:
+        return None
+    pages = []
+    codes = test_codes(service.charset)
+    for i in range(options.codes * 100):
+        if len(pages) >= options.codes:
+            break
+        code = codes.next()
+        responses = capture(service, code)
+        if any(resp.getheader("Content-Type") == "text/html" for resp, body in responses.values()):
+            pages.append((code, responses))
+    if not pages:
+        return None
+
+    outcomes = {}
+    cpu = time.clock()
+    for i in range(PARSE_PASSES):
+        for code, responses in pages:
+            try:
+                service._replay_fetch(code, responses)
+                outcome = "redirect"
+            except exceptions.CodeBlockedException:
+                outcome = "code blocked"
+            except exceptions.NoRedirectException:
+                outcome = "no redirect"
+            except exceptions.BlockedException:
+                outcome = "blocked"
+            except exceptions.ServiceException:
+                outcome = "error"
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    cpu = time.clock() - cpu
+
+    count = len(pages) * PARSE_PASSES
+    return {
+        "codes": count,
+        "rate": count / cpu,
+        "cpu": cpu / count,
+        "outcomes": outcomes,
+    }
+
+def main_parse(options):
+    print "%-12s %8s %10s %11s  %s" % ("service", "pages", "pages/sec",
+        "CPU us/page", "outcomes")
+    for name in options.services:
+        stats = benchmark_parse(name, options)
+        if not stats:
+            continue
+        outcomes = ", ".join("%s: %i" % item for item in sorted(stats["outcomes"].items()))
+        print "%-12s %8i %10.1f %11.1f  %s" % (name, stats["codes"],
+            stats["rate"], stats["cpu"] * 1000000, outcomes)
+
+def benchmark_compression(data, backend, level):
+    """
+    Compress data with the backend through a CompressedWriter until
+    COMPRESSION_MIN_TIME has passed, returns the statistics
+    """
+    passes = 0
+    start = time.time()
+    cpu_start = time.clock()
+    while True:
+        output = _CountingFile()
+        writer = compression.CompressedWriter(output, backend, level)
+        for pos in xrange(0, len(data), 4096):
+            writer.write(data[pos:pos + 4096])
+        writer.close()
+        passes += 1
+        elapsed = time.time() - start
+        if elapsed >= COMPRESSION_MIN_TIME:
+            break
+    return {
+        "rate": passes * len(data) / elapsed,
+        "cpu": (time.clock() - cpu_start) / passes,
+        "ratio": float(output.size) / len(data),
+        "size": output.size,
+    }
+
+def main_compression(options):
+    data = []
+    for path in options.results:
+        f = gzip.open(path, "rb")
+        try:
+            data.append(f.read())
+        finally:
+            f.close()
+    data = "".join(data)
+    if not data:
+        print "The result files are empty"
+        return
+
+    print "%i bytes of results, %i lines" % (len(data), data.count("\n"))
+    print "%-6s %5s %10s %7s %9s %10s" % ("codec", "level", "bytes", "ratio",
+        "MB/sec", "CPU ms/MB")
+    for backend in compression.backends():
+        for level in COMPRESSION_LEVELS[backend]:
+            stats = benchmark_compression(data, backend, level)
+            print "%-6s %5i %10i %7.3f %9.1f %10.1f" % (backend, level,
+                stats["size"], stats["ratio"], stats["rate"] / 1000000,
+                stats["cpu"] * 1000 * 1000000 / len(data))
+
+class _CountingFile:
+    """
+    Output file that only counts the bytes written
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+def main():
+    options = parse_options()
+    if options.parse:
+        main_parse(options)
+        return
+    if options.compression:
+        main_compression(options)
+        return
+
+    addresses = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(options, addresses))
+    server.daemon = True
+    server.start()
+    address = addresses.get()
+
+    print "%-12s %8s %10s %9s %9s %11s  %s" % ("service", "codes",
+        "codes/sec", "p50 ms", "p99 ms", "CPU us/code", "outcomes")
+    try:
+        for name in options.services:
+            stats = benchmark(name, address, options)
+            outcomes = ", ".join("%s: %i" % item for item in sorted(stats["outcomes"].items()))
+            print "%-12s %8i %10.1f %9.2f %9.2f %11.1f  %s" % (name,
+                stats["codes"], stats["rate"], stats["p50"] * 1000,
+                stats["p99"] * 1000, stats["cpu"] * 1000000, outcomes)
+    finally:
+        server.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Convert results between gzipped "code|url" lines and compact archives
+
+Without options, the gzipped results in INPUT are converted to a compact
+archive. With --extract, the compact archive in INPUT is converted back.
+With --lookup, the given codes are looked up in the compact archive INPUT.
+"""
+
+import optparse
+import sys
+
+from tinyback import compact
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options] INPUT [OUTPUT]")
+
+    parser.add_option("-x", "--extract", dest="extract", action="store_true",
+        default=False, help="Convert a compact archive to gzipped results")
+    parser.add_option("-l", "--lookup", dest="lookup", action="append",
+        default=[], help="Print the URL of CODE in the compact archive; may "
+        "be given several times", metavar="CODE")
+    parser.add_option("-b", "--block-size", dest="block_size", type="int",
+        default=compact.BLOCK_SIZE, help="Store N records per block "
+        "(default: %default)", metavar="N")
+
+    options, args = parser.parse_args()
+    if options.lookup:
+        if len(args) != 1:
+            parser.error("--lookup needs exactly one archive")
+    elif len(args) != 2:
+        parser.error("INPUT and OUTPUT are required")
+    return options, args
+
+def main():
+    options, args = parse_options()
+    source = open(args[0], "rb")
+    try:
+        if options.lookup:
+            reader = compact.CompactReader(source)
+            missing = False
+            for code in options.lookup:
+                url = reader.lookup(code)
+                if url is None:
+                    print "%s is not in the archive" % code
+                    missing = True
+                else:
+                    print "%s|%s" % (code, url)
+            if missing:
+                sys.exit(1)
+            return
+
+        destination = open(args[1], "wb")
+        try:
+            if options.extract:
+                count = compact.to_gzip(source, destination)
+            else:
+                count = compact.from_gzip(source, destination, options.block_size)
+        finally:
+            destination.close()
+    finally:
+        source.close()
+    sys.stderr.write("Converted %i results\n" % count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Query a result store written by run.py --store
+
+Prints what the given codes resolve to, all results in a range of codes, or
+exports the results of a task in the upload format of the tracker.
+"""
+
+import json
+import optparse
+import sys
+
+from tinyback import store
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options] DATABASE SERVICE [CODE...]")
+
+    parser.add_option("-r", "--range", dest="range",
+        help="Print all URLs of codes from START to STOP (byte order)",
+        metavar="START:STOP")
+    parser.add_option("-e", "--export", dest="export",
+        help="Export the results of the task in the JSON file TASK; SERVICE "
+        "is taken from the task", metavar="TASK")
+    parser.add_option("-o", "--output", dest="output",
+        help="Write the export to FILE (default: stdout)", metavar="FILE")
+
+    options, args = parser.parse_args()
+    if len(args) < 2 and not (options.export and len(args) == 1):
+        parser.error("DATABASE and SERVICE are required")
+    if options.range and ":" not in options.range:
+        parser.error("Bad range %s" % options.range)
+    return options, args
+
+def main():
+    options, args = parse_options()
+    results = store.ResultStore(args[0])
+
+    if options.export:
+        with open(options.export, "r") as f:
+            task = json.load(f)
+        if options.output:
+            output = open(options.output, "wb")
+        else:
+            output = sys.stdout
+        missing = results.export(task, output)
+        if options.output:
+            output.close()
+        if missing:
+            sys.stderr.write("%i codes of task %s are not in the store\n" % (missing, task["id"]))
+            sys.exit(1)
+        return
+
+    service = args[1]
+    if options.range:
+        start, stop = options.range.split(":", 1)
+        for code, url in results.scan(service, start or None, stop or None):
+            if url is not None:
+                print "%s|%s" % (code, url)
+
+    for code in args[2:]:
+        known, url = results.lookup(service, code)
+        if not known:
+            print "%s is not in the store" % code
+        elif url is None:
+            print "%s does not exist" % code
+        else:
+            print "%s|%s" % (code, url)
+
+if __name__ == "__main__":
+    main()
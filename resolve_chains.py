@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Resolve long URLs in result files that are short URLs of another service
+
+Reads gzipped "code|url" results as written by the Reaper and writes
+"code|url|final" lines, where final is the destination after following all
+short URLs of known services.
+"""
+
+import gzip
+import logging
+import optparse
+import sys
+
+from tinyback import chains
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options] RESULTS...")
+
+    parser.add_option("-o", "--output", dest="output",
+        help="Write gzipped results to FILE instead of plain text to stdout",
+        metavar="FILE")
+    parser.add_option("-c", "--cache", dest="cache",
+        help="Keep resolved codes in FILE across runs", metavar="FILE")
+    parser.add_option("--cache-size", dest="cache_size", type="int",
+        default=chains.CACHE_SIZE, help="Keep up to N resolved codes "
+        "(default: %i)" % chains.CACHE_SIZE, metavar="N")
+    parser.add_option("-d", "--depth", dest="depth", type="int",
+        default=chains.MAX_DEPTH, help="Follow up to N short URLs per result "
+        "(default: %i)" % chains.MAX_DEPTH, metavar="N")
+    parser.add_option("--debug", dest="debug", action="store_true",
+        default=False, help="Enable debug output")
+
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("No result files given")
+    return options, args
+
+def main():
+    options, args = parse_options()
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    resolver = chains.ChainResolver(options.cache, options.cache_size, options.depth)
+    if options.output:
+        output = gzip.open(options.output, "wb")
+    else:
+        output = sys.stdout
+
+    count = 0
+    try:
+        for filename in args:
+            with gzip.open(filename, "rb") as results:
+                for line in results:
+                    code, url = line.rstrip("\n").split("|", 1)
+                    output.write("%s|%s|%s\n" % (code, url, resolver.resolve(url)))
+                    count += 1
+    finally:
+        resolver.close()
+        if options.output:
+            output.close()
+
+    logging.info("Resolved %i results, %i cache hits, %i codes fetched" % (count, resolver.hits, resolver.misses))
+
+if __name__ == "__main__":
+    main()
@@ -16,13 +16,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import Queue
+import collections
+import multiprocessing
 import optparse
 import logging
+import os
+import shutil
+import signal
 import sys
+import tempfile
 import threading
 import time
 
 import tinyback
+import tinyback.aio
+import tinyback.checkpoint
+import tinyback.compact
+import tinyback.deadcodes
+import tinyback.metrics
+import tinyback.ratelimit
+import tinyback.store
 import tinyback.tracker
 
 def parse_options():
@@ -35,11 +49,54 @@ def parse_options():
         help="Clear all pending tasks from tracker")
     parser.add_option("-n", "--num-threads", dest="num_threads", type="int",
         default=1, help="Use N threads", metavar="N")
+    parser.add_option("-w", "--window", dest="window", type="int", default=1,
+        help="Keep N codes in flight per task (default: 1)", metavar="N")
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+        default=0, help="Run N supervised worker processes, each using "
+        "--num-threads threads or an event loop", metavar="N")
+    parser.add_option("-e", "--event-loop", dest="event_loop",
+        action="store_true", help="Reap all tasks (see --num-threads) on a "
+        "single event loop instead of one thread per task")
+    parser.add_option("-b", "--batch", dest="batch", type="int", default=1,
+        help="Lease up to N tasks from the tracker at once (default: 1)",
+        metavar="N")
     parser.add_option("-s", "--sleep", dest="sleep", type="int", default=300,
         help="Sleep for N seconds when idle (default: 5 minutes)",
         metavar="N")
     parser.add_option("--temp-dir", dest="temp_dir",
         help="Set directory for temporary files to DIR", metavar="DIR")
+    parser.add_option("--checkpoint", dest="checkpoint", action="store_true",
+        help="Checkpoint tasks in the temporary directory and resume them "
+        "after a restart")
+    parser.add_option("--stream-upload", dest="stream_upload",
+        action="store_true", help="Send results to the tracker while "
+        "reaping instead of uploading them at the end of a task")
+    parser.add_option("--compress-level", dest="compress_level", type="int",
+        help="Compress results with gzip level N from 1 (fast) to 9 (small, "
+        "default)", metavar="N")
+    parser.add_option("--store", dest="store",
+        help="Keep all results in the SQLite database FILE, skip codes that "
+        "are already in it and keep tasks whose upload failed for later",
+        metavar="FILE")
+    parser.add_option("--archive", dest="archive",
+        help="Keep the results of every task as a compact archive in DIR",
+        metavar="DIR")
+    parser.add_option("--dead-codes", dest="dead_codes",
+        help="Keep filters of codes that do not exist in DIR and skip those "
+        "codes until they are checked again", metavar="DIR")
+    parser.add_option("--recheck-age", dest="recheck_age", type="float",
+        default=tinyback.deadcodes.MAX_AGE / 86400.0, help="Check codes "
+        "that did not exist again after N days (default: %default)",
+        metavar="N")
+    parser.add_option("--rate-limit-dir", dest="rate_limit_dir",
+        help="Share rate limits with other processes through files in DIR",
+        metavar="DIR")
+    parser.add_option("--adaptive-rate", dest="rate_file",
+        help="Adapt rate limits to the services and keep the learned rates "
+        "in FILE", metavar="FILE")
+    parser.add_option("--metrics-port", dest="metrics_port", type="int",
+        help="Serve metrics in Prometheus format on "
+        "http://127.0.0.1:PORT/metrics", metavar="PORT")
     parser.add_option("-u", "--username", dest="username",
         help="Set tracker username")
     parser.add_option("-d", "--debug", action="store_const", dest="loglevel",
@@ -48,57 +105,556 @@ def parse_options():
     options, args = parser.parse_args()
     if args:
         parser.error("Unexpected argument %s" % args[0])
+    if options.stream_upload and options.checkpoint:
+        parser.error("--stream-upload cannot be combined with --checkpoint")
+    if options.store and not tinyback.store.sqlite3:
+        parser.error("--store requires the sqlite3 module")
+    if options.compress_level is not None and not 1 <= options.compress_level <= 9:
+        parser.error("The compression level must be from 1 to 9")
+    if options.archive and options.stream_upload:
+        parser.error("--archive cannot be combined with --stream-upload")
+    if options.archive and not os.path.isdir(options.archive):
+        parser.error("%s is not a directory" % options.archive)
+    if options.dead_codes and not os.path.isdir(options.dead_codes):
+        parser.error("%s is not a directory" % options.dead_codes)
 
     return options
 
-def run_thread(options, tracker):
-    log = logging.getLogger("run_thread")
-    while True:
+RESTART_DELAY = 10
+"""Seconds a restarted worker process waits before it starts working"""
+
+STATS_INTERVAL = 300
+"""Seconds between two reports of the aggregated counters"""
+
+LEASE_RENEW_MARGIN = 120
+"""Leases are renewed when they expire in less than this many seconds"""
+
+LEASE_CHECK_INTERVAL = 10
+"""Seconds between two checks for leases to renew"""
+
+METRICS_INTERVAL = 10
+"""Seconds between two metrics snapshots sent by a worker process"""
+
+draining = threading.Event()
+"""Set on SIGTERM: finish the current tasks, but do not start new ones"""
+
+store = None
+"""tinyback.store.ResultStore shared by all Reapers of the process, or None"""
+
+counters = None
+"""multiprocessing.Queue receiving ("totals", (tasks, codes, URLs)) per reaped
+task and ("metrics", pid, snapshot) from time to time in a worker process, or
+None"""
+
+def report(task, reaper):
+    tinyback.metrics.count("tinyback_tasks_total", {"service": task["service"]})
+    if counters:
+        counters.put(("totals", (1, reaper.codes_tried, reaper.urls_found)))
+
+def send_metrics():
+    """
+    Send a metrics snapshot of this worker process to the supervisor
+    """
+    counters.put(("metrics", os.getpid(), tinyback.metrics.snapshot()))
+
+class TaskQueue:
+    """
+    Local queue of tasks leased from the tracker
+
+    Tasks with a checkpoint left over from an earlier run come first, followed
+    by tasks whose upload failed and which were kept in the store. Other
+    tasks are taken from a local queue, which is refilled with up to
+    options.batch tasks per tracker call by whichever thread finds it empty.
+    Leases of queued and running tasks are renewed in the background until
+    release is called for the task. Once draining, queued tasks are dropped
+    and their leases are no longer renewed, so the tracker hands them out
+    again when the leases expire.
+    """
+
+    def __init__(self, options, tracker):
+        self._log = logging.getLogger("TaskQueue")
+        self._options = options
+        self._tracker = tracker
+
+        self._checkpoints = Queue.Queue()
+        if options.checkpoint:
+            for checkpoint in tinyback.checkpoint.find(options.temp_dir):
+                self._checkpoints.put(checkpoint)
+
+        self._queue = collections.deque()
+        self._leases = {}
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+
+        thread = threading.Thread(target=self._renew_leases)
+        thread.daemon = True
+        thread.start()
+
+    def fetch(self):
+        """
+        Returns the next task and its checkpoint
+
+        Returns (None, None) if the tracker has no tasks or once draining,
+        and raises an exception if the tracker cannot be reached. The
+        checkpoint is None if checkpointing is disabled.
+        """
+        if draining.is_set():
+            self._drop_queued()
+            return None, None
+
+        try:
+            checkpoint = self._checkpoints.get_nowait()
+        except Queue.Empty:
+            pass
+        else:
+            return checkpoint.task, checkpoint
+
+        task = store and store.claim_failed_task()
+        if task:
+            self._log.info("Submitting task %s from the store again" % task["id"])
+            with self._lock:
+                self._claimed.add(task["id"])
+            return task, self._new_checkpoint(task)
+
+        with self._refill_lock:
+            # Draining may have started while waiting for the lock
+            if draining.is_set():
+                self._drop_queued()
+                return None, None
+            if not self._queue:
+                leased = self._tracker.fetch_batch(self._options.batch)
+                with self._lock:
+                    for task, lease in leased:
+                        self._queue.append(task)
+                        if lease:
+                            self._leases[task["id"]] = [task, time.time() + lease]
+            with self._lock:
+                if not self._queue:
+                    return None, None
+                task = self._queue.popleft()
+
+        return task, self._new_checkpoint(task)
+
+    def _new_checkpoint(self, task):
+        if self._options.checkpoint:
+            return tinyback.checkpoint.Checkpoint(self._options.temp_dir, task)
+        return None
+
+    def requeue(self, checkpoint):
+        """
+        Hand out a checkpointed task again
+        """
+        self._checkpoints.put(checkpoint)
+
+    def release(self, task):
+        """
+        Stop renewing the lease of a task
+        """
+        with self._lock:
+            self._leases.pop(task["id"], None)
+            self._claimed.discard(task["id"])
+
+    def put_back(self, task, checkpoint):
+        """
+        Give up a task that was fetched, but is not going to be run
+
+        A task from the store goes back to the store, a checkpoint left over
+        from an earlier run stays where it is and the lease of any other task
+        is no longer renewed.
+        """
+        with self._lock:
+            claimed = task["id"] in self._claimed
+        if claimed:
+            store.save_failed_task(task, failed=False)
+        self._log.info("Not running task %s" % task["id"])
+        self.release(task)
+
+    def _drop_queued(self):
+        """
+        Give up the queued tasks, which are not going to be run
+        """
+        with self._lock:
+            if self._queue:
+                self._log.info("Dropping %i queued tasks" % len(self._queue))
+            for task in self._queue:
+                self._leases.pop(task["id"], None)
+            self._queue.clear()
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(LEASE_CHECK_INTERVAL)
+            if draining.is_set():
+                self._drop_queued()
+            now = time.time()
+            with self._lock:
+                due = [task for task, expires in self._leases.values() if expires - now < LEASE_RENEW_MARGIN]
+            for task in due:
+                try:
+                    lease = self._tracker.renew(task)
+                except Exception, e:
+                    self._log.warn("Could not renew lease of task %s: %s" % (task["id"], e))
+                    continue
+                with self._lock:
+                    if task["id"] in self._leases:
+                        self._leases[task["id"]][1] = time.time() + lease
+
+def wait_for_task(options, tasks):
+    """
+    Like TaskQueue.fetch, but retries and sleeps until there is a task
+
+    Returns (None, None) once draining.
+    """
+    log = logging.getLogger("wait_for_task")
+    while not draining.is_set():
         try:
-            task = tracker.fetch()
+            task, checkpoint = tasks.fetch()
         except:
             log.info("Error contacting tracker - Sleeping for 60 seconds")
-            time.sleep(60)
+            draining.wait(60)
             continue
 
+        if task:
+            return task, checkpoint
+        log.debug("Sleeping for %i seconds" % options.sleep)
+        draining.wait(options.sleep)
+    return None, None
+
+def prefetch_task(options, tasks):
+    """
+    Start fetching the next task in the background
+
+    Returns a Queue that receives the (task, checkpoint) tuple.
+    """
+    result = Queue.Queue(1)
+    thread = threading.Thread(target=lambda: result.put(wait_for_task(options, tasks)))
+    thread.daemon = True
+    thread.start()
+    return result
+
+def open_upload(options, tracker, task):
+    """
+    Returns the streaming upload for the task, or None
+    """
+    if options.stream_upload:
+        return tracker.upload(task, options.username, options.temp_dir)
+    return None
+
+def save_archive(options, task, fileobj):
+    """
+    Keep the results of the task as a compact archive in options.archive
+    """
+    path = os.path.join(options.archive, "%s.tbc" % task["id"])
+    try:
+        fileobj.seek(0)
+        f = open(path, "wb")
+        try:
+            tinyback.compact.from_gzip(fileobj, f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError), e:
+        logging.getLogger("save_archive").warn("Could not archive task %s: %s" % (task["id"], e))
+
+def upload_thread(options, tracker, tasks, uploads):
+    """
+    Upload finished tasks from the uploads Queue
+
+    Tracker.put retries an upload itself (see tinyback.tracker.RETRIES), so
+    every task is submitted once. If that fails, a checkpointed task is
+    queued again so its results get uploaded later. Otherwise the task is
+    kept in the store, if there is one, and reaped from the store later;
+    without a store the results are dropped.
+    """
+    log = logging.getLogger("upload_thread")
+    while True:
+        task, fileobj, checkpoint = uploads.get()
+        try:
+            if options.archive:
+                save_archive(options, task, fileobj)
+            try:
+                tracker.put(task, fileobj, options.username)
+            except Exception, e:
+                log.error("Giving up on uploading task %s: %s" % (task["id"], e))
+                if checkpoint:
+                    tasks.requeue(checkpoint)
+                elif store:
+                    store.save_failed_task(task)
+            else:
+                if checkpoint:
+                    checkpoint.remove()
+        finally:
+            tasks.release(task)
+            fileobj.close()
+            uploads.task_done()
+
+def start_uploader(options, tracker, tasks):
+    """
+    Start the upload thread, returns the Queue feeding it
+    """
+    uploads = Queue.Queue(max(options.num_threads, 1))
+    thread = threading.Thread(target=upload_thread, args=(options, tracker, tasks, uploads))
+    thread.daemon = True
+    thread.start()
+    return uploads
+
+def run_thread(options, tracker, tasks, uploads):
+    """
+    Reap tasks one after another
+
+    The next task is fetched while the current one is being reaped, and the
+    results are handed to the upload thread, so the Reaper does not wait for
+    the tracker. Returns once draining, after the current task; a task that
+    was prefetched by then is put back.
+    """
+    upcoming = prefetch_task(options, tasks)
+    while True:
+        try:
+            # Wait with a timeout, so signals are handled in the main thread
+            task, checkpoint = upcoming.get(True, 1)
+        except Queue.Empty:
+            continue
+        if not task:
+            return
+        if draining.is_set():
+            tasks.put_back(task, checkpoint)
+            return
+        upcoming = prefetch_task(options, tasks)
+
+        reaper = tinyback.Reaper(task, window=options.window, checkpoint=checkpoint, store=store,
+            compress_level=options.compress_level)
+        fileobj = reaper.run(options.temp_dir, open_upload(options, tracker, task))
+        uploads.put((task, fileobj, checkpoint))
+        report(task, reaper)
+
+def run_event_loop(options, tracker, tasks, uploads):
+    """
+    Reap options.num_threads tasks at once from a single thread
+
+    Results are uploaded by the upload thread, but fetching tasks is still
+    blocking and briefly stalls the loop. Returns once draining, after the
+    current tasks.
+    """
+    log = logging.getLogger("run_event_loop")
+    loop = tinyback.aio.EventLoop()
+
+    def start_task():
+        if draining.is_set():
+            return
+        try:
+            task, checkpoint = tasks.fetch()
+        except:
+            log.info("Error contacting tracker - Sleeping for 60 seconds")
+            start_later(time.time() + 60)
+            return
+
         if not task:
             log.debug("Sleeping for %i seconds" % options.sleep)
-            time.sleep(options.sleep)
+            start_later(time.time() + options.sleep)
         else:
-            reaper = tinyback.Reaper(task)
-            fileobj = reaper.run(options.temp_dir)
-            try:
-                tracker.put(task, fileobj, options.username)
-            except:
-                time.sleep(60)
-                log.info("Error contacting tracker - Sleeping for 60 seconds")
-                continue
-            finally:
-                fileobj.close()
+            reaper = tinyback.AsyncReaper(task, loop, window=options.window, checkpoint=checkpoint,
+                store=store, compress_level=options.compress_level)
+            reaper.start(lambda fileobj: finish_task(reaper, task, checkpoint, fileobj),
+                options.temp_dir, open_upload(options, tracker, task))
 
-def main():
-    options = parse_options()
+    def start_later(when):
+        # Sleep in steps of one second to notice draining early
+        if draining.is_set():
+            return
+        if time.time() < when:
+            loop.call_later(1, start_later, when)
+        else:
+            start_task()
 
-    logging.basicConfig(level=options.loglevel,
-        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    def finish_task(reaper, task, checkpoint, fileobj):
+        uploads.put((task, fileobj, checkpoint))
+        report(task, reaper)
+        loop.call_soon(start_task)
+
+    for i in range(options.num_threads):
+        loop.call_later(i, start_task)
+    loop.run()
+
+def run_worker(options):
+    """
+    Reap tasks with threads or an event loop until draining
+    """
+    global store
+    tinyback.ratelimit.STATE_DIR = options.rate_limit_dir
+    tinyback.ratelimit.RATE_FILE = options.rate_file
+    tinyback.deadcodes.DIRECTORY = options.dead_codes
+    tinyback.deadcodes.MAX_AGE = options.recheck_age * 86400
+    if options.store:
+        store = tinyback.store.ResultStore(options.store)
 
     tracker = tinyback.tracker.Tracker(options.tracker)
-    if options.clear:
-        tracker.clear()
 
-    if options.num_threads == 1:
-        run_thread(options, tracker)
+    tasks = TaskQueue(options, tracker)
+    uploads = start_uploader(options, tracker, tasks)
+    if options.event_loop:
+        run_event_loop(options, tracker, tasks, uploads)
+    elif options.num_threads == 1:
+        run_thread(options, tracker, tasks, uploads)
     else:
         threads = []
 
         for i in range(options.num_threads):
-            thread = threading.Thread(target=run_thread,args=(options, tracker))
+            thread = threading.Thread(target=run_thread,args=(options, tracker, tasks, uploads))
             time.sleep(1)
             thread.start()
             threads.append(thread)
 
         for thread in threads:
-            thread.join()
+            while thread.is_alive():
+                thread.join(1)
+
+    logging.getLogger("run_worker").info("Waiting for uploads to finish")
+    uploads.join()
+    if store:
+        store.close()
+
+def worker_process(options, index, counters_queue, delay):
+    """
+    Entry point of a worker process started by supervise
+    """
+    global counters
+    counters = counters_queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: draining.set())
+    # Ctrl-C reaches the whole process group; the supervisor turns it into
+    # SIGTERM for the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Every worker keeps its checkpoints in a directory of its own, so a
+    # restarted worker resumes its own tasks and nobody else's
+    options.temp_dir = os.path.join(options.temp_dir or tempfile.gettempdir(), "tinyback-worker-%i" % index)
+    if not os.path.isdir(options.temp_dir):
+        os.makedirs(options.temp_dir)
+
+    if options.metrics_port:
+        def metrics_thread():
+            while True:
+                time.sleep(METRICS_INTERVAL)
+                send_metrics()
+        thread = threading.Thread(target=metrics_thread)
+        thread.daemon = True
+        thread.start()
+
+    draining.wait(delay)
+    run_worker(options)
+    if options.metrics_port:
+        send_metrics()
+
+def supervise(options):
+    """
+    Run options.processes worker processes
+
+    Workers that exit while not draining are restarted. On SIGTERM or SIGINT,
+    all workers are told to drain and the supervisor waits for them. Counters
+    reported by the workers are summed up and logged every STATS_INTERVAL
+    seconds and at exit. The metrics endpoint serves the sum of the last
+    snapshots of all worker processes, including those that exited.
+    """
+    log = logging.getLogger("supervise")
+
+    created = None
+    if not options.rate_limit_dir:
+        # Keep the rate limits of all workers together
+        created = tempfile.mkdtemp(prefix="tinyback-ratelimit-", dir=options.temp_dir)
+        options.rate_limit_dir = created
+
+    try:
+        counters_queue = multiprocessing.Queue()
+        totals = [0, 0, 0]
+        restarts = 0
+        snapshots = {}
+
+        if options.metrics_port:
+            tinyback.metrics.serve(("127.0.0.1", options.metrics_port),
+                lambda: tinyback.metrics.merge(snapshots.values()))
+
+        def receive(message):
+            if message[0] == "totals":
+                totals[:] = [total + value for total, value in zip(totals, message[1])]
+            elif message[0] == "metrics":
+                snapshots[message[1]] = message[2]
+
+        def start(index, delay):
+            process = multiprocessing.Process(target=worker_process,
+                args=(options, index, counters_queue, delay))
+            process.start()
+            log.info("Started worker %i (pid %i)" % (index, process.pid))
+            return process
+
+        def log_totals():
+            log.info("Totals: %i tasks, %i codes, %i URLs, %i restarts" % (totals[0], totals[1], totals[2], restarts))
+
+        def drain(signum, frame):
+            draining.set()
+        signal.signal(signal.SIGTERM, drain)
+        signal.signal(signal.SIGINT, drain)
+
+        workers = {}
+        for index in range(options.processes):
+            workers[index] = start(index, index)
+
+        terminated = False
+        last_stats = time.time()
+        while workers:
+            try:
+                receive(counters_queue.get(True, 1))
+            except Queue.Empty:
+                pass
+            except IOError:
+                # Interrupted by a signal
+                pass
+
+            if draining.is_set() and not terminated:
+                log.info("Draining workers")
+                for process in workers.values():
+                    process.terminate()
+                terminated = True
+
+            for index, process in workers.items():
+                if process.is_alive():
+                    continue
+                process.join()
+                if draining.is_set():
+                    log.info("Worker %i finished" % index)
+                    del workers[index]
+                else:
+                    log.warn("Worker %i died with exit code %i - Restarting" % (index, process.exitcode))
+                    restarts += 1
+                    workers[index] = start(index, RESTART_DELAY)
+
+            if time.time() - last_stats >= STATS_INTERVAL:
+                log_totals()
+                last_stats = time.time()
+
+        while True:
+            try:
+                receive(counters_queue.get(True, 0.1))
+            except Queue.Empty:
+                break
+        log_totals()
+    finally:
+        if created:
+            shutil.rmtree(created, ignore_errors=True)
+
+def main():
+    options = parse_options()
+
+    logging.basicConfig(level=options.loglevel,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    if options.clear:
+        tinyback.tracker.Tracker(options.tracker).clear()
+
+    if options.processes > 0:
+        supervise(options)
+    else:
+        if options.metrics_port:
+            tinyback.metrics.serve(("127.0.0.1", options.metrics_port))
+        signal.signal(signal.SIGTERM, lambda signum, frame: draining.set())
+        run_worker(options)
 
 if __name__ == "__main__":
     main()
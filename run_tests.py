@@ -16,19 +16,120 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+Test all services against the expected results in test-definitions
+
+By default the codes are fetched from the real URL shorteners. With --record
+the exchanges are saved to one cassette per service, with --replay the
+cassettes are served from a local server instead, so no network access is
+needed. Services are tested in parallel.
+"""
+
+import Queue
 import logging
+import optparse
 import os
 import re
+import sys
+import threading
 
 import tinyback
+from tinyback import cassette, mockserver
+
+def parse_options(tests_path):
+    parser = optparse.OptionParser(usage="%prog [options] [SERVICE...]")
+
+    parser.add_option("-r", "--record", dest="record", action="store_true",
+        default=False, help="Record the exchanges with the real services")
+    parser.add_option("-p", "--replay", dest="replay", action="store_true",
+        default=False, help="Replay recorded exchanges instead of using the "
+        "network")
+    parser.add_option("-c", "--cassettes", dest="cassettes",
+        default=os.path.join(tests_path, "cassettes"), help="Keep the "
+        "cassettes in DIR (default: %default)", metavar="DIR")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=0,
+        help="Test up to N services at once (default: all)", metavar="N")
+    parser.add_option("-q", "--quiet", dest="quiet", action="store_true",
+        default=False, help="Only report unexpected results")
+
+    options, args = parser.parse_args()
+    if options.record and options.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    return options, args
+
+def worker(tests, results, options, address):
+    while True:
+        try:
+            name, fixtures = tests.get_nowait()
+        except Queue.Empty:
+            return
+        service = fetch = recorder = None
+        if address:
+            service = mockserver.mock_service(name, address)
+        if options.record:
+            recorder = cassette.Cassette(os.path.join(options.cassettes, name + ".json"), load=False)
+            fetch = lambda service, code: cassette.record(service, code, recorder)
+        try:
+            failures = tinyback.ServiceTester(name, fixtures, service, fetch).run()
+            if recorder:
+                recorder.save()
+        except Exception:
+            logging.exception("Testing %s failed" % name)
+            failures = 1
+        results.put((name, failures))
+
+def main():
+    tests_path = os.path.join(os.path.dirname(__file__), "test-definitions")
+    options, args = parse_options(tests_path)
+
+    logging.basicConfig(level=logging.INFO if options.quiet else logging.DEBUG,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    tests = Queue.Queue()
+    cassettes = {}
+    for filename in sorted(os.listdir(tests_path)):
+        match = re.match("^([a-z0-9]+)\.txt", filename)
+        if not match:
+            continue
+        name = match.group(1)
+        if args and name not in args:
+            continue
+        if options.replay:
+            path = os.path.join(options.cassettes, name + ".json")
+            if not os.path.exists(path):
+                logging.warn("No cassette for %s, skipping" % name)
+                continue
+            cassettes[name] = cassette.Cassette(path)
+        tests.put((name, os.path.join(tests_path, filename)))
+
+    if options.record and not os.path.isdir(options.cassettes):
+        os.makedirs(options.cassettes)
+    address = None
+    if options.replay:
+        server = cassette.CassetteServer(cassettes)
+        server.start()
+        address = server.server_address
+
+    count = tests.qsize()
+    results = Queue.Queue()
+    threads = []
+    for i in range(min(count, options.jobs or count)):
+        thread = threading.Thread(target=worker, args=(tests, results, options, address))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
 
-logging.basicConfig(level=logging.DEBUG)
+    failed = 0
+    while not results.empty():
+        name, failures = results.get()
+        if failures:
+            logging.warn("%s: %i unexpected results" % (name, failures))
+            failed += 1
+    logging.info("Tested %i services, %i failed" % (count, failed))
+    if failed:
+        sys.exit(1)
 
-tests_path = os.path.join(os.path.dirname(__file__), "test-definitions")
-for filename in os.listdir(tests_path):
-    match = re.match("^([a-z0-9]+)\.txt", filename)
-    if not match:
-        continue
-    name = match.group(1)
-    fixtures = os.path.join(tests_path, filename)
-    tinyback.ServiceTester(name, fixtures).run()
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ import sys
 import time
 
 import tinyback
+import tinyback.checkpoint
 import tinyback.tracker
 
 username = tmp_dir = None
@@ -68,28 +69,31 @@ logger = logging.getLogger()
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
-tracker = tinyback.tracker.Tracker(tracker)
-try:
-    task = tracker.fetch()
-except:
-    sys.exit(1)
-if not task:
-    time.sleep(300)
-    sys.exit(0)
-
-reaper = tinyback.Reaper(task, progress=True)
-fileobj = reaper.run(tmp_dir)
+tracker = tinyback.tracker.Tracker(tracker, retries=max_submission_retries)
 
-tries = 0
-while tries < max_submission_retries:
+# Resume a task that was interrupted in an earlier run
+checkpoints = tmp_dir and tinyback.checkpoint.find(tmp_dir)
+if checkpoints:
+    checkpoint = checkpoints[0]
+    task = checkpoint.task
+else:
     try:
-        tracker.put(task, fileobj, username)
-        break
-    except Exception, e:
-        wait = 2 ** (tries+1)
-        logger.warn(e)
-        if tries < max_submission_retries:
-            logger.warn("Sleeping for %d seconds..." % wait)
-            time.sleep(wait)
-    tries += 1
+        task = tracker.fetch()
+    except:
+        sys.exit(1)
+    if not task:
+        time.sleep(300)
+        sys.exit(0)
+    checkpoint = tmp_dir and tinyback.checkpoint.Checkpoint(tmp_dir, task)
+
+reaper = tinyback.Reaper(task, progress=True, checkpoint=checkpoint)
+fileobj = reaper.run(tmp_dir)
+
+try:
+    tracker.put(task, fileobj, username)
+except Exception, e:
+    logger.warn(e)
+else:
+    if checkpoint:
+        checkpoint.remove()
 fileobj.close()
@@ -0,0 +1,62 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import socket
+import unittest
+
+import tinyback
+from tinyback import cassette, mockserver
+
+TESTS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test-definitions")
+
+class ReplayTest(unittest.TestCase):
+    """
+    Replay every recorded cassette against the fixtures of its service
+    """
+
+    def setUp(self):
+        self._create_connection = socket.create_connection
+        def create_connection(address, *args, **kwargs):
+            if address[0] != "127.0.0.1":
+                raise AssertionError("Connection to %s:%i during replay" % address)
+            return self._create_connection(address, *args, **kwargs)
+        socket.create_connection = create_connection
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        socket.create_connection = self._create_connection
+        logging.disable(logging.NOTSET)
+
+    def test_replay(self):
+        path = os.path.join(TESTS_PATH, "cassettes")
+        names = sorted(filename[:-len(".json")] for filename in os.listdir(path) if filename.endswith(".json"))
+        self.assertTrue(names)
+        cassettes = dict((name, cassette.Cassette(os.path.join(path, name + ".json"))) for name in names)
+        server = cassette.CassetteServer(cassettes)
+        server.start()
+        try:
+            for name in names:
+                service = mockserver.mock_service(name, server.server_address)
+                tester = tinyback.ServiceTester(name, os.path.join(TESTS_PATH, name + ".txt"), service)
+                self.assertEqual(tester.run(), 0, name)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import gzip
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from tinyback import compact, generators
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "compact_results.py")
+
+RECORDS = [("%04x" % i, "http://example.org/%i?q=%i" % (i % 7, i)) for i in range(1000)] + [
+    ("0000", "http://example.com/second"),
+    ("dup", "http://example.com/first"),
+    ("dup", "http://example.com/second"),
+    ("nohost", "mailto:someone@example.org"),
+    ("0001", "http://example.com/third"),
+]
+
+HOSTS = ["http://www.example.org/", "https://blog.example.com/", "http://news.example.net/",
+    "http://shop.example.de/", "https://video.example.tv/"]
+
+def sequence_results(rand):
+    """
+    Results of a sequence task, where most codes exist
+    """
+    records = []
+    options = {"charset": "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ", "start": "aaaa", "stop": "acZZ"}
+    for code in generators.factory("sequence", options):
+        if rand.random() < 0.9:
+            records.append((code, "%s%i/%02i/%s.html" % (rand.choice(HOSTS), rand.randint(2008, 2013),
+                rand.randint(1, 12), hashlib.md5(code).hexdigest()[:rand.randint(6, 20)])))
+    return records
+
+def random_results(rand):
+    """
+    Results of a chain task, where codes are random
+    """
+    records = []
+    for i in range(5000):
+        code = "".join(rand.choice("0123456789abcdefghijklmnopqrstuvwxyz") for j in range(6))
+        records.append((code, rand.choice(HOSTS) + hashlib.sha1(code).hexdigest()[:rand.randint(4, 30)]
+            + rand.choice(["", "?utm_source=twitter", "/index.html"])))
+    return records
+
+def gzipped(records, level=9):
+    fileobj = StringIO.StringIO()
+    gzip_fileobj = gzip.GzipFile(mode="wb", fileobj=fileobj, compresslevel=level)
+    for code, url in records:
+        gzip_fileobj.write("%s|%s\n" % (code, url))
+    gzip_fileobj.close()
+    fileobj.seek(0)
+    return fileobj
+
+def gunzipped(fileobj):
+    fileobj.seek(0)
+    return gzip.GzipFile(mode="rb", fileobj=fileobj).read()
+
+class CompactTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        archive = StringIO.StringIO()
+        self.assertEqual(compact.from_gzip(gzipped(RECORDS), archive, block_size=100), len(RECORDS))
+        reader = compact.CompactReader(archive)
+        self.assertEqual(len(reader), len(RECORDS))
+        self.assertEqual(list(reader), RECORDS)
+
+        output = StringIO.StringIO()
+        self.assertEqual(compact.to_gzip(archive, output), len(RECORDS))
+        self.assertEqual(gunzipped(output), gunzipped(gzipped(RECORDS)))
+
+    def test_lookup(self):
+        archive = StringIO.StringIO()
+        compact.from_gzip(gzipped(RECORDS), archive, block_size=100)
+        reader = compact.CompactReader(archive)
+        for code, url in RECORDS[:1000:37]:
+            self.assertEqual(reader.lookup(code), url)
+        self.assertEqual(reader.lookup("nohost"), "mailto:someone@example.org")
+        self.assertEqual(reader.lookup("missing"), None)
+
+    def test_first_occurrence(self):
+        archive = StringIO.StringIO()
+        compact.from_gzip(gzipped(RECORDS), archive, block_size=100)
+        reader = compact.CompactReader(archive)
+        # Duplicates within the last block
+        self.assertEqual(reader.lookup("dup"), "http://example.com/first")
+        # Duplicates in different blocks
+        self.assertEqual(reader.lookup("0000"), "http://example.org/0?q=0")
+        self.assertEqual(reader.lookup("0001"), "http://example.org/1?q=1")
+
+    def test_size(self):
+        rand = random.Random(1)
+        for records, block_size in [(sequence_results(rand), compact.BLOCK_SIZE),
+                (random_results(rand), compact.BLOCK_SIZE), (random_results(rand), 1000)]:
+            archive = StringIO.StringIO()
+            compact.from_gzip(gzipped(records), archive, block_size)
+            self.assertEqual(list(compact.CompactReader(archive)), records)
+            size = len(archive.getvalue())
+            gzip_size = len(gzipped(records).getvalue())
+            self.assertTrue(size < gzip_size, "%i bytes, gzip -9 has %i" % (size, gzip_size))
+
+class CompactResultsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _run(self, *args):
+        process = subprocess.Popen([sys.executable, SCRIPT] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        return process.returncode, stdout
+
+    def test_convert(self):
+        results = os.path.join(self._directory, "results.gz")
+        archive = os.path.join(self._directory, "results.tbc")
+        extracted = os.path.join(self._directory, "extracted.gz")
+        f = open(results, "wb")
+        f.write(gzipped(RECORDS).getvalue())
+        f.close()
+
+        self.assertEqual(self._run("-b", "100", results, archive)[0], 0)
+        self.assertEqual(self._run("-x", archive, extracted)[0], 0)
+        f = open(extracted, "rb")
+        try:
+            self.assertEqual(gunzipped(f), gunzipped(gzipped(RECORDS)))
+        finally:
+            f.close()
+
+        status, output = self._run("-l", "dup", "-l", "0010", archive)
+        self.assertEqual(status, 0)
+        self.assertEqual(output, "dup|http://example.com/first\n0010|http://example.org/2?q=16\n")
+        status, output = self._run("-l", "missing", archive)
+        self.assertEqual(status, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import gzip
+import threading
+import unittest
+
+from tinyback import compression
+
+LINES = ["code%i|http://example.org/%i\n" % (i, i * i) for i in range(20000)]
+
+class StalledFile:
+    """
+    File whose write blocks until release is set
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.data = StringIO.StringIO()
+
+    def write(self, data):
+        self.release.wait()
+        self.data.write(data)
+
+def decompress(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+class CompressedWriterTest(unittest.TestCase):
+
+    def test_gzip(self):
+        fileobj = StringIO.StringIO()
+        writer = compression.CompressedWriter(fileobj)
+        for line in LINES:
+            writer.write(line)
+        writer.close()
+        self.assertEqual(decompress(fileobj.getvalue()), "".join(LINES))
+
+    def test_members(self):
+        # Every checkpoint ends a gzip member and starts a new one in the same file
+        fileobj = StringIO.StringIO()
+        for start in range(0, len(LINES), 7000):
+            writer = compression.CompressedWriter(fileobj)
+            for line in LINES[start:start + 7000]:
+                writer.write(line)
+            writer.close()
+        writer = compression.CompressedWriter(fileobj)
+        writer.close()
+        self.assertEqual(decompress(fileobj.getvalue()), "".join(LINES))
+
+    def test_non_blocking(self):
+        fileobj = StalledFile()
+        writer = compression.CompressedWriter(fileobj, block=False)
+        for line in LINES * 3:
+            writer.write(line)
+        self.assertTrue(writer.full())
+        self.assertFalse(writer.idle())
+        fileobj.release.set()
+        writer.close()
+        self.assertEqual(decompress(fileobj.data.getvalue()), "".join(LINES * 3))
+
+    def test_abort(self):
+        fileobj = StalledFile()
+        writer = compression.CompressedWriter(fileobj, block=False)
+        thread = writer._thread
+        for line in LINES * 3:
+            writer.write(line)
+        writer.abort()
+        fileobj.release.set()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertRaises(ValueError, writer.write, LINES[0])
+        writer.close()
+
+    def test_error(self):
+        writer = compression.CompressedWriter(None)
+        writer.write("a" * compression.CHUNK_SIZE)
+        self.assertRaises(AttributeError, writer.close)
+
+if __name__ == "__main__":
+    unittest.main()
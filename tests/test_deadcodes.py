@@ -0,0 +1,79 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinyback import deadcodes
+
+CAPACITY = 2000
+
+PROBES = 50000
+
+class DeadCodeFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+        logging.disable(logging.NOTSET)
+
+    def _filter(self):
+        return deadcodes.DeadCodeFilter(os.path.join(self._directory, "test.bloom"), capacity=CAPACITY)
+
+    def test_false_positive_rate(self):
+        dead_codes = self._filter()
+        # Filling a generation starts the next one
+        for i in xrange(deadcodes.GENERATIONS * CAPACITY):
+            dead_codes.add("dead%i" % i)
+        self.assertEqual(len(dead_codes._generations), deadcodes.GENERATIONS)
+        for i in xrange(0, deadcodes.GENERATIONS * CAPACITY, 97):
+            self.assertTrue("dead%i" % i in dead_codes)
+
+        false_positives = sum(1 for i in xrange(PROBES) if "alive%i" % i in dead_codes)
+        # Allow for about three standard deviations
+        self.assertTrue(false_positives < PROBES * deadcodes.ERROR_RATE * 1.3,
+            "%i false positives in %i codes" % (false_positives, PROBES))
+
+    def test_shared_generation(self):
+        filters = [self._filter() for i in range(4)]
+        for i, dead_codes in enumerate(filters):
+            dead_codes.add("dead%i" % i)
+            dead_codes.save()
+        dead_codes = self._filter()
+        self.assertEqual(len(dead_codes._generations), 1)
+        for i in range(4):
+            self.assertTrue("dead%i" % i in dead_codes)
+
+    def test_save(self):
+        dead_codes = self._filter()
+        for i in xrange(100):
+            dead_codes.add("dead%i" % i)
+        dead_codes.save()
+        other = self._filter()
+        other.add("other")
+        other.save()
+        dead_codes.save()
+        self.assertTrue("other" in dead_codes)
+        self.assertTrue("dead99" in other)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from tinyback import generators
+
+CHARSET = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+GENERATORS = [
+    ("chain", {"charset": CHARSET, "count": 500, "length": 5, "seed": "test"}),
+    ("sequence", {"charset": CHARSET, "start": "0", "stop": "dz"}),
+    ("list", {"list": ["code%i" % i for i in range(100)]}),
+]
+
+class ShardTest(unittest.TestCase):
+
+    def test_union(self):
+        for generator_type, options in GENERATORS:
+            codes = list(generators.factory(generator_type, options))
+            for stride in (False, True):
+                shards = generators.split(generator_type, options, 7, stride)
+                union = []
+                for shard in shards:
+                    union.extend(shard)
+                self.assertEqual(sorted(union), sorted(codes), generator_type)
+
+    def test_merge(self):
+        for generator_type, options in GENERATORS:
+            codes = list(generators.factory(generator_type, options))
+            for stride in (False, True):
+                shards = generators.split(generator_type, options, 7, stride)
+                merged = list(generators.merge([shard.enumerate() for shard in shards]))
+                self.assertEqual(merged, codes, "%s, stride %s" % (generator_type, stride))
+
+    def test_len(self):
+        for generator_type, options in GENERATORS:
+            total = generators.length(generator_type, options)
+            for stride in (False, True):
+                shards = generators.split(generator_type, options, 7, stride)
+                for shard in shards:
+                    self.assertEqual(len(shard), len(list(shard)))
+                self.assertEqual(sum(len(shard) for shard in shards), total)
+
+    def test_skip(self):
+        for generator_type, options in GENERATORS:
+            for stride in (False, True):
+                for shard in generators.split(generator_type, options, 3, stride):
+                    codes = list(shard)
+                    for skip in (0, 1, len(codes) // 2, len(codes)):
+                        self.assertEqual(list(shard.codes(skip)), codes[skip:])
+                        self.assertEqual([position for position, code in shard.enumerate(skip)],
+                            [shard.position(index) for index in range(skip, len(codes))])
+
+    def test_more_shards_than_codes(self):
+        for generator_type, options in [("list", {"list": ["a", "b", "c"]}),
+                ("sequence", {"charset": CHARSET, "start": "a", "stop": "c"})]:
+            for stride in (False, True):
+                shards = generators.split(generator_type, options, 5, stride)
+                self.assertEqual(len(shards), 5)
+                self.assertEqual([len(shard) for shard in shards].count(0), 2)
+                for shard in shards:
+                    if not len(shard):
+                        self.assertEqual(list(shard), [])
+                merged = list(generators.merge([shard.enumerate() for shard in shards]))
+                self.assertEqual(merged, ["a", "b", "c"])
+
+if __name__ == "__main__":
+    unittest.main()
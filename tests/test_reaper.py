@@ -0,0 +1,120 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import tinyback
+from tinyback import deadcodes, mockserver, services, store
+
+TASK = {"id": "1", "service": "isgd", "generator_type": "list", "generator_options": {"list": []}}
+
+class StoreAndDeadCodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._saved = deadcodes.DIRECTORY, deadcodes.MAX_AGE, deadcodes._filters
+        deadcodes.DIRECTORY = self._directory
+        deadcodes.MAX_AGE = 3600
+        deadcodes._filters = {}
+        # Reapers resolve the host of the service, which needs the network
+        self._factory = services.factory
+        services.factory = lambda name: mockserver.mock_service(name, ("127.0.0.1", 80))
+        self._store = store.ResultStore(os.path.join(self._directory, "results.db"))
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        self._store.close()
+        services.factory = self._factory
+        deadcodes.DIRECTORY, deadcodes.MAX_AGE, deadcodes._filters = self._saved
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self._directory)
+
+    def _age(self, code, seconds):
+        self._store.commit()
+        self._store._db.execute("UPDATE results SET fetched = ? WHERE code = ?", (time.time() - seconds, code))
+
+    def test_recheck(self):
+        reaper = tinyback.Reaper(TASK, store=self._store)
+        reaper._save("recent", None)
+        reaper._save("old", None)
+        reaper._save("found", "http://example.org/")
+        self._age("old", 7200)
+        self._age("found", 7200)
+        # Forget the dead codes, as if their generation had expired
+        deadcodes._filters = {}
+        reaper = tinyback.Reaper(TASK, store=self._store)
+
+        self.assertEqual(reaper._lookup("recent"), (True, None))
+        self.assertEqual(reaper._lookup("old"), (False, None))
+        self.assertEqual(reaper._lookup("found"), (True, "http://example.org/"))
+
+    def test_filter_after_store(self):
+        reaper = tinyback.Reaper(TASK, store=self._store)
+        reaper._save("old", None)
+        self._age("old", 7200)
+        # Still in the dead code filter, which decides on its own
+        self.assertEqual(reaper._lookup("old"), (True, None))
+
+class OutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self._factory = services.factory
+        services.factory = lambda name: mockserver.mock_service(name, ("127.0.0.1", 80))
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        services.factory = self._factory
+        logging.disable(logging.NOTSET)
+
+    def _reaper(self, cls, codes, **kwargs):
+        task = dict(TASK, generator_options={"list": codes})
+        reaper = cls(task, **kwargs)
+        reaper.writers = []
+        open_compressed = reaper._open_compressed
+        def record(fileobj):
+            reaper.writers.append(open_compressed(fileobj))
+            return reaper.writers[-1]
+        reaper._open_compressed = record
+        return reaper
+
+    def test_async_output(self):
+        codes = ["code%i" % i for i in range(20000)]
+        reaper = self._reaper(tinyback.AsyncReaper, codes, window=4)
+        reaper._lookup = lambda code: (True, "http://example.org/" + code)
+        fileobj = reaper.run()
+        fileobj.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fileobj, mode="rb").read(),
+            "".join("%s|http://example.org/%s\n" % (code, code) for code in codes))
+
+    def test_abort_on_error(self):
+        def lookup(code):
+            if code == "code100":
+                raise RuntimeError("lookup failed")
+            return (True, "http://example.org/" + code)
+        for cls in (tinyback.Reaper, tinyback.AsyncReaper):
+            reaper = self._reaper(cls, ["code%i" % i for i in range(200)])
+            reaper._lookup = lookup
+            self.assertRaises(RuntimeError, reaper.run)
+            self.assertEqual(reaper.writers[-1]._thread, None, cls.__name__)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from tinyback import aio, exceptions, generators, mockserver
+
+class BodyRateTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = mockserver.MockServer()
+        self._server.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def test_async_matches_sync(self):
+        sync = mockserver.mock_service("isgd", self._server.server_address)
+        async = mockserver.mock_service("isgd", self._server.server_address)
+        codes = list(generators.factory("sequence", {"charset": sync.charset, "start": "a", "stop": "bz"}))
+        loop = aio.EventLoop()
+        results = []
+        for code in codes:
+            try:
+                sync.fetch(code)
+            except exceptions.ServiceException:
+                pass
+            async.fetch_async(code, loop, lambda result, exc_info: results.append(exc_info))
+            loop.run()
+        self.assertEqual(len(results), len(codes))
+        self.assertTrue(sync._body_rate > 0)
+        self.assertAlmostEqual(async._body_rate, sync._body_rate)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from tinyback import store
+
+TASK = {"id": "1", "service": "isgd"}
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._path = os.path.join(self._directory, "results.db")
+        self._retry_delay = store.RETRY_DELAY
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        store.RETRY_DELAY = self._retry_delay
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self._directory)
+
+    def test_lookup_max_age(self):
+        results = store.ResultStore(self._path)
+        results.put("isgd", "dead", None)
+        results.put("isgd", "alive", "http://example.org/")
+        self.assertEqual(results.lookup("isgd", "dead", 3600), (True, None))
+        results.commit()
+        results._db.execute("UPDATE results SET fetched = ?", (time.time() - 7200,))
+        self.assertEqual(results.lookup("isgd", "dead"), (True, None))
+        self.assertEqual(results.lookup("isgd", "dead", 3600), (False, None))
+        self.assertEqual(results.lookup("isgd", "alive", 3600), (True, "http://example.org/"))
+        self.assertEqual(results.lookup("isgd", "missing", 3600), (False, None))
+        results.close()
+
+    def test_failed_task_backoff(self):
+        results = store.ResultStore(self._path)
+        self.assertTrue(results.save_failed_task(TASK))
+        self.assertEqual(results.claim_failed_task(), None)
+
+        results._db.execute("UPDATE failed_tasks SET not_before = 0")
+        store.RETRY_DELAY = 0
+        for attempt in range(2, store.MAX_ATTEMPTS):
+            self.assertEqual(results.claim_failed_task(), TASK)
+            self.assertTrue(results.save_failed_task(TASK))
+        self.assertEqual(results.claim_failed_task(), TASK)
+        # Putting a task back does not count as an attempt
+        self.assertTrue(results.save_failed_task(TASK, failed=False))
+        self.assertEqual(results.claim_failed_task(), TASK)
+        self.assertFalse(results.save_failed_task(TASK))
+        self.assertEqual(results.claim_failed_task(), None)
+        results.close()
+
+    def test_old_database(self):
+        db = sqlite3.connect(self._path)
+        db.execute("CREATE TABLE failed_tasks (id TEXT PRIMARY KEY, task TEXT NOT NULL, failed REAL NOT NULL)")
+        db.execute("INSERT INTO failed_tasks (id, task, failed) VALUES (?, ?, ?)",
+            ("1", '{"id": "1", "service": "isgd"}', time.time()))
+        db.commit()
+        db.close()
+        results = store.ResultStore(self._path)
+        self.assertEqual(results.claim_failed_task(), TASK)
+        results.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import BaseHTTPServer
+import logging
+import threading
+import unittest
+import urlparse
+
+from tinyback import tracker
+
+TASK = {"id": "1", "service": "isgd"}
+
+class StubTracker:
+    """
+    Tracker whose put_chunk and put_offset fail with the given exceptions
+    """
+
+    def __init__(self, chunk_error=None, offset_error=None):
+        self.chunk_error = chunk_error
+        self.offset_error = offset_error
+        self.chunks = 0
+        self.offsets = 0
+        self.put_data = None
+
+    def put_chunk(self, task, offset, data, final=False, username=None):
+        self.chunks += 1
+        if self.chunk_error:
+            raise self.chunk_error
+        return offset + len(data)
+
+    def put_offset(self, task):
+        self.offsets += 1
+        if self.offset_error:
+            raise self.offset_error
+        return 0
+
+    def put(self, task, data, username=None):
+        if hasattr(data, "read"):
+            data.seek(0)
+            data = data.read()
+        self.put_data = data
+
+class NotFoundHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Tracker without task/put_chunk and task/put_offset
+    """
+
+    def do_GET(self):
+        self._reply(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if urlparse.urlparse(self.path).path == "/task/put":
+            self.server.put_data = body
+            self._reply(200)
+        else:
+            self._reply(404)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self._resume_delay = tracker.RESUME_DELAY
+        self._chunk_size = tracker.CHUNK_SIZE
+        self._max_buffer = tracker.MAX_BUFFER
+        tracker.RESUME_DELAY = 0
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        tracker.RESUME_DELAY = self._resume_delay
+        tracker.CHUNK_SIZE = self._chunk_size
+        tracker.MAX_BUFFER = self._max_buffer
+        logging.disable(logging.NOTSET)
+
+    def test_complete(self):
+        stub = StubTracker()
+        upload = tracker.Upload(stub, TASK)
+        upload.write("a|http://example.org/\n")
+        upload.finish()
+        self.assertEqual(stub.chunks, 1)
+        self.assertEqual(stub.put_data, None)
+
+    def test_tracker_down(self):
+        stub = StubTracker(Exception("down"), Exception("down"))
+        upload = tracker.Upload(stub, TASK)
+        upload.write("a|http://example.org/\n")
+        self.assertRaises(Exception, upload.finish)
+        self.assertEqual(stub.chunks, 1)
+        self.assertEqual(stub.offsets, tracker.MAX_RESUMES - 1)
+        # Writes after giving up are dropped
+        upload.write("b|http://example.org/\n")
+
+    def test_chunks_unsupported(self):
+        stub = StubTracker(tracker.StreamingUnsupported("404"))
+        upload = tracker.Upload(stub, TASK)
+        upload.write("a|http://example.org/\n")
+        upload.write("b|http://example.org/\n")
+        upload.finish()
+        self.assertEqual(stub.put_data, "a|http://example.org/\nb|http://example.org/\n")
+
+    def test_offset_unsupported(self):
+        stub = StubTracker(Exception("down"), tracker.StreamingUnsupported("404"))
+        upload = tracker.Upload(stub, TASK)
+        upload.write("a|http://example.org/\n")
+        upload.finish()
+        self.assertEqual(stub.put_data, "a|http://example.org/\n")
+
+    def test_unsupported_spill(self):
+        self._small_buffer()
+        stub = StubTracker(tracker.StreamingUnsupported("404"))
+        upload = tracker.Upload(stub, TASK)
+        lines = ["%i|http://example.org/\n" % i for i in range(100)]
+        for line in lines:
+            upload.write(line)
+        self.assertTrue(upload._spill is not None)
+        self.assertTrue(len(upload._chunks) <= 1)
+        self.assertEqual(upload.tell(), len("".join(lines)))
+        upload.finish()
+        self.assertEqual(stub.put_data, "".join(lines))
+        self.assertEqual(upload._spill, None)
+
+    def test_not_found(self):
+        self._not_found(["a|http://example.org/\n"])
+
+    def test_not_found_spill(self):
+        self._small_buffer()
+        self._not_found(["%i|http://example.org/\n" % i for i in range(100)])
+
+    def _small_buffer(self):
+        tracker.CHUNK_SIZE = 50
+        tracker.MAX_BUFFER = 100
+
+    def _not_found(self, lines):
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), NotFoundHandler)
+        server.put_data = None
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = tracker.Tracker("http://127.0.0.1:%i/" % server.server_port, retries=1)
+            upload = client.upload(TASK)
+            for line in lines:
+                upload.write(line)
+            client.put(TASK, upload)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(server.put_data, "".join(lines))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,26 +16,40 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import gzip
+import Queue
 import hashlib
 import logging
 import sys
 import tempfile
+import threading
 import time
 
-from tinyback import exceptions, generators, services
+from tinyback import aio, compression, deadcodes, exceptions, generators, metrics, ratelimit, services
 
 __version__ = "2.13"
 
 class ServiceTester:
+    """
+    Check a service against the expected results in a fixtures file
 
-    def __init__(self, name, fixtures):
+    By default the codes are fetched from the real URL shortener. service
+    replaces the instance of the named service, for example by one talking
+    to a local server. fetch is called with the service and a code instead of
+    the fetch method of the service, for example to record the exchanges.
+    """
+
+    def __init__(self, name, fixtures, service=None, fetch=None):
         self._log = logging.getLogger("tinyback.ServiceTester.%s" % name)
-        self._service = services.factory(name)
+        self._service = service or services.factory(name)
         self._fixtures = fixtures
+        self._fetch = fetch
 
     def run(self):
+        """
+        Test all codes, returns the number of codes with unexpected results
+        """
         self._log.info("Testing service")
+        failures = 0
         f = open(self._fixtures, "r")
 
         for line in f:
@@ -54,100 +68,499 @@ class ServiceTester:
 
             success = False
             try:
-                result = self._service.fetch(code)
+                if self._fetch:
+                    result = self._fetch(self._service, code)
+                else:
+                    result = self._service.fetch(code)
                 success = isinstance(expected, str) and result == expected
             except exceptions.ServiceException, e:
                 result = e
                 success = (not isinstance(expected, str)) and issubclass(expected, exceptions.ServiceException) and isinstance(result, expected)
 
             if not success:
+                failures += 1
                 self._log.warn("Code %s, Expected: %s, Result: %s" % (code, expected, result))
             else:
                 self._log.debug("Code %s, Expected: %s, Result: %s" % (code, expected, result))
 
         f.close()
         self._log.info("Finished testing")
+        return failures
 
 class Reaper:
 
     MAX_TRIES = 3
 
-    def __init__(self, task, progress=False):
+    def __init__(self, task, progress=False, window=1, checkpoint=None, store=None,
+            compression="gzip", compress_level=None):
         self._log = logging.getLogger("tinyback.Reaper")
         self._task = task
         self._service = services.factory(self._task["service"])
         self._progress = progress
+        self._window = max(1, window)
+        self._checkpoint = checkpoint
+        self._store = store
+        self._compression = compression
+        self._compress_level = compress_level
+        self._dead_codes = deadcodes.get_filter(self._task["service"])
 
         self._codes_tried = 0
         self._urls_found = 0
+        self._labels = {"service": self._task["service"]}
 
+        self._rate_limiter = None
         if self._service.rate_limit:
             self._log.info("Rate limit: %i requests per %i seconds" % self._service.rate_limit)
-            self._rate_limit_bucket = 0
-            self._rate_limit_next = time.time()
+            self._rate_limiter = ratelimit.get_bucket(self._task["service"], self._service.rate_limit)
+
+    @property
+    def codes_tried(self):
+        return self._codes_tried
+
+    @property
+    def urls_found(self):
+        return self._urls_found
 
-    def run(self, temp_dir=None):
+    def run(self, temp_dir=None, output=None):
+        """
+        Reap the task, returns the file with the gzipped results
+
+        If output is given, the results are written to that file-like object
+        instead of a temporary file. The results are compressed on a separate
+        thread, with the backend given to the constructor.
+        """
         self._log.info("Starting Reaper")
-        fileobj = tempfile.TemporaryFile(dir=temp_dir)
-        gzip_fileobj = gzip.GzipFile(mode="wb", fileobj=fileobj)
-
-        for code in generators.factory(self._task["generator_type"], self._task["generator_options"]):
-            self._codes_tried += 1
-            blocked = 0
-            tries = 0
-            while tries < (self.MAX_TRIES + blocked):
-                tries += 1
-                self._rate_limit()
-                self._log.debug("Fetching code %s, try %i" % (code, tries))
-                try:
-                    result = self._service.fetch(code)
-                except exceptions.NoRedirectException:
-                    self._log.debug("Code %s does not exist" % code)
-                    break
-                except exceptions.BlockedException:
-                    if self._service.rate_limit:
-                        self._rate_limit_bucket = 0
-                    blocked += 1
-                    wait = (min(5 ** blocked, 3600))
-                    self._log.info("Service blocked us %i times, backing off for %i seconds" % (blocked, wait))
-                    time.sleep(wait)
-                except exceptions.ServiceException, e:
-                    self._log.warn("ServiceException(%s) on code %s" % (e, code))
-                else:
-                    if "\n" in result or "\r" in result:
-                        self._log.warn("URL for code %s contains newline" % code)
-                    else:
-                        self._urls_found += 1
-                        self._log.debug("Code %s leads to URL '%s'" % (code, result.decode("ascii", "replace")))
-                        self._print_progress()
-                        gzip_fileobj.write(code + "|")
-                        gzip_fileobj.write(result)
-                        gzip_fileobj.write("\n")
-                    break
+        fileobj = self._open_output(temp_dir, output)
+        if self._checkpoint and self._checkpoint.complete:
+            self._log.info("Task was already reaped before")
+            return fileobj
+        gzip_fileobj = self._open_compressed(fileobj)
 
-        gzip_fileobj.close()
+        try:
+            codes = generators.factory(self._task["generator_type"], self._task["generator_options"], self._codes_tried)
+            if self._window > 1:
+                self._log.info("Keeping up to %i codes in flight" % self._window)
+                results = self._run_concurrent(codes)
+            else:
+                results = self._run_serial(codes)
+
+            for code, result in results:
+                self._write(gzip_fileobj, code, result)
+                gzip_fileobj = self._save_checkpoint(fileobj, gzip_fileobj)
+
+            gzip_fileobj.close()
+        finally:
+            # Stops the compression thread if reaping failed
+            gzip_fileobj.abort()
+        self._commit()
+        if self._checkpoint:
+            self._checkpoint.save(fileobj, self._codes_tried, self._urls_found, True)
         self._log.info("Reaper examined %d codes and found %d URLs" % (self._codes_tried, self._urls_found))
         return fileobj
 
-    def _rate_limit(self):
-        if not self._service.rate_limit:
-            return
+    def _open_output(self, temp_dir, output):
+        """
+        Returns the file for the output, continuing after the last checkpoint
+        if there is one
+        """
+        if output is not None:
+            return output
+        if not self._checkpoint:
+            return tempfile.TemporaryFile(dir=temp_dir)
+        self._codes_tried = self._checkpoint.codes_tried
+        self._urls_found = self._checkpoint.urls_found
+        return self._checkpoint.open()
+
+    def _open_compressed(self, fileobj):
+        """
+        Returns a file-like object compressing into fileobj
+        """
+        return compression.CompressedWriter(fileobj, self._compression, self._compress_level)
 
-        if self._rate_limit_bucket > 0:
-            self._rate_limit_bucket -= 1
+    def _save_checkpoint(self, fileobj, gzip_fileobj):
+        """
+        Saves a checkpoint if one is due
+
+        Finishes the current gzip member for the checkpoint and returns the
+        gzip file to continue writing to.
+        """
+        if not self._checkpoint or not self._checkpoint.due():
+            return gzip_fileobj
+        gzip_fileobj.close()
+        self._checkpoint.save(fileobj, self._codes_tried, self._urls_found)
+        return self._open_compressed(fileobj)
+
+    def _write(self, gzip_fileobj, code, result):
+        self._codes_tried += 1
+        metrics.count("tinyback_codes_total", self._labels)
+        if result is None:
             return
+        if "\n" in result or "\r" in result:
+            self._log.warn("URL for code %s contains newline" % code)
+        else:
+            self._urls_found += 1
+            metrics.count("tinyback_urls_total", self._labels)
+            self._log.debug("Code %s leads to URL '%s'" % (code, result.decode("ascii", "replace")))
+            self._print_progress()
+            gzip_fileobj.write(code + "|")
+            gzip_fileobj.write(result)
+            gzip_fileobj.write("\n")
+
+    def _run_serial(self, codes):
+        for code in codes:
+            yield code, self._fetch(self._service, code)
+
+    def _run_concurrent(self, codes):
+        """
+        Fetch codes using a sliding window of worker threads
+
+        Every worker thread has its own service instance (and thus its own
+        connection). Results are yielded in generator order, so the output is
+        identical to the serial mode. At most window codes are outstanding
+        between the oldest unwritten code and the newest dispatched one.
+        """
+        inbox = Queue.Queue()
+        outbox = Queue.Queue()
+        workers = []
+        for i in range(self._window):
+            worker = threading.Thread(target=self._worker, args=(inbox, outbox))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        codes = enumerate(codes)
+        pending = {}
+        dispatched = 0
+        written = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and dispatched - written < self._window:
+                    try:
+                        index, code = codes.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    inbox.put((index, code))
+                    dispatched += 1
+                if written == dispatched:
+                    break
+
+                index, code, result, exc_info = outbox.get()
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                pending[index] = (code, result)
+                while written in pending:
+                    yield pending.pop(written)
+                    written += 1
+        finally:
+            for worker in workers:
+                inbox.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _worker(self, inbox, outbox):
+        service = None
+        while True:
+            item = inbox.get()
+            if item is None:
+                return
+            index, code = item
+            try:
+                if not service:
+                    service = services.factory(self._task["service"])
+                outbox.put((index, code, self._fetch(service, code), None))
+            except Exception:
+                outbox.put((index, code, None, sys.exc_info()))
+
+    def _fetch(self, service, code):
+        """
+        Fetch a single code, retrying on errors
+
+        Returns the long URL or None if the code does not exist or could not
+        be fetched.
+        """
+        known, url = self._lookup(code)
+        if known:
+            return url
+
+        blocked = 0
+        tries = 0
+        while tries < (self.MAX_TRIES + blocked):
+            tries += 1
+            self._rate_limit()
+            self._log.debug("Fetching code %s, try %i" % (code, tries))
+            start = time.time()
+            try:
+                result = service.fetch(code)
+            except exceptions.NoRedirectException, e:
+                self._record(tries, start, e)
+                self._log.debug("Code %s does not exist" % code)
+                self._rate_limit_success()
+                self._save(code, None)
+                return None
+            except exceptions.BlockedException, e:
+                self._record(tries, start, e)
+                if self._rate_limiter:
+                    self._rate_limiter.blocked()
+                blocked += 1
+                wait = (min(5 ** blocked, 3600))
+                self._log.info("Service blocked us %i times, backing off for %i seconds" % (blocked, wait))
+                metrics.count("tinyback_backoff_sleep_seconds_total", self._labels, wait)
+                time.sleep(wait)
+            except exceptions.ServiceException, e:
+                self._record(tries, start, e)
+                self._log.warn("ServiceException(%s) on code %s" % (e, code))
+            else:
+                self._record(tries, start)
+                self._rate_limit_success()
+                self._save(code, result)
+                return result
+        return None
+
+    def _lookup(self, code):
+        """
+        Returns (True, result) if the code is in the store or known to be
+        dead, (False, None) otherwise
+
+        Codes that did not exist are checked again after deadcodes.MAX_AGE
+        seconds, whether they are in the store or in the dead code filter.
+        """
+        if self._store:
+            known, url = self._store.lookup(self._task["service"], code, deadcodes.MAX_AGE)
+            if known:
+                metrics.count("tinyback_store_hits_total", self._labels)
+                return known, url
+        if self._dead_codes is not None and code in self._dead_codes:
+            metrics.count("tinyback_dead_code_skips_total", self._labels)
+            return True, None
+        return False, None
+
+    def _save(self, code, result):
+        if self._store:
+            self._store.put(self._task["service"], code, result)
+        if self._dead_codes is not None and result is None:
+            self._dead_codes.add(code)
 
-        wait = self._rate_limit_next - time.time()
+    def _commit(self):
+        """
+        Write out the store and the dead code filter at the end of the task
+        """
+        if self._store:
+            self._store.commit()
+        if self._dead_codes is not None:
+            self._dead_codes.save()
+
+    def _record(self, tries, start, error=None):
+        """
+        Update the metrics after a fetch attempt that started at start
+        """
+        if error is None:
+            outcome = "redirect"
+        elif isinstance(error, exceptions.CodeBlockedException):
+            outcome = "code_blocked"
+        elif isinstance(error, exceptions.NoRedirectException):
+            outcome = "no_redirect"
+        elif isinstance(error, exceptions.BlockedException):
+            outcome = "blocked"
+        else:
+            outcome = "error"
+        metrics.count("tinyback_requests_total", dict(self._labels, outcome=outcome))
+        metrics.observe("tinyback_request_seconds", self._labels, time.time() - start)
+        if tries > 1:
+            metrics.count("tinyback_retries_total", self._labels)
+
+    def _rate_limit(self):
+        wait = self._rate_limit_reserve()
         if wait > 0:
             self._log.debug("Sleeping for %f seconds to satisfy rate limit" % wait)
+            metrics.count("tinyback_rate_limit_sleep_seconds_total", self._labels, wait)
             time.sleep(wait)
 
-        settings = self._service.rate_limit
-        self._rate_limit_bucket = settings[0] - 1
-        self._rate_limit_next = time.time() + settings[1]
+    def _rate_limit_reserve(self):
+        """
+        Reserve one request from the rate limit shared by all Reapers of the
+        service
+
+        Returns the number of seconds to wait before the request may be sent.
+        """
+        if not self._rate_limiter:
+            return 0
+        return self._rate_limiter.reserve()
+
+    def _rate_limit_success(self):
+        if self._rate_limiter:
+            self._rate_limiter.success()
 
     def _print_progress(self):
         """Print progress for use in Seesaw"""
         if self._progress and self._codes_tried % 10 == 0:
             self._log.info('Found %d URLs of %d examined so far',
                 self._urls_found, self._codes_tried, extra={'progress': True})
+
+class AsyncReaper(Reaper):
+    """
+    Event-loop driven Reaper
+
+    Works like a Reaper with a window, except that all requests are issued
+    through Service.fetch_async on an aio.EventLoop. Many AsyncReapers can
+    share one loop, so a single thread can keep requests for several tasks in
+    flight. The output is identical to the one of the serial Reaper.
+
+    Writing never blocks the loop: while the compression thread is behind, no
+    new codes are dispatched, and checkpoints and the end of the task wait
+    until it has caught up.
+    """
+
+    WRITER_POLL = 0.1
+
+    def __init__(self, task, loop=None, progress=False, window=8, checkpoint=None, store=None,
+            compression="gzip", compress_level=None):
+        Reaper.__init__(self, task, progress, window, checkpoint, store, compression, compress_level)
+        self._loop = loop or aio.EventLoop()
+
+    def run(self, temp_dir=None, output=None):
+        result = []
+        self.start(result.append, temp_dir, output)
+        while not result:
+            self._loop.run_once()
+        return result[0]
+
+    def start(self, callback, temp_dir=None, output=None):
+        """
+        Start reaping on the event loop
+
+        Calls callback(fileobj) from the loop once the task is done.
+        """
+        self._log.info("Starting AsyncReaper, keeping up to %i codes in flight" % self._window)
+        self._callback = callback
+        self._fileobj = self._open_output(temp_dir, output)
+        if self._checkpoint and self._checkpoint.complete:
+            self._log.info("Task was already reaped before")
+            self._loop.call_soon(callback, self._fileobj)
+            return
+        self._gzip_fileobj = self._open_compressed(self._fileobj)
+
+        self._pending = {}
+        self._dispatched = 0
+        self._written = 0
+        self._exhausted = False
+        self._stalled = False
+        self._guard(self._start)
+
+    def _start(self):
+        self._codes = enumerate(generators.factory(self._task["generator_type"], self._task["generator_options"], self._codes_tried))
+        self._dispatch()
+
+    def _open_compressed(self, fileobj):
+        return compression.CompressedWriter(fileobj, self._compression, self._compress_level, block=False)
+
+    def _save_checkpoint(self, fileobj, gzip_fileobj):
+        # Closing the gzip member must not wait for the compression thread
+        if not gzip_fileobj.idle():
+            return gzip_fileobj
+        return Reaper._save_checkpoint(self, fileobj, gzip_fileobj)
+
+    def _guard(self, callback, *args):
+        """
+        Run callback(*args), stopping the compression thread if it raises
+        """
+        try:
+            callback(*args)
+        except:
+            self._gzip_fileobj.abort()
+            raise
+
+    def _call_later(self, delay, callback, *args):
+        self._loop.call_later(delay, self._guard, callback, *args)
+
+    def _resume(self):
+        self._stalled = False
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._stalled:
+            return
+        if self._gzip_fileobj.full() or (self._exhausted and self._written == self._dispatched
+                and not self._gzip_fileobj.idle()):
+            self._stalled = True
+            self._call_later(self.WRITER_POLL, self._resume)
+            return
+
+        while not self._exhausted and self._dispatched - self._written < self._window:
+            try:
+                index, code = self._codes.next()
+            except StopIteration:
+                self._exhausted = True
+                break
+            self._dispatched += 1
+            known, url = self._lookup(code)
+            if known:
+                # Not called directly, which would recurse into _dispatch
+                self._call_later(0, self._complete, index, code, url)
+            else:
+                self._try(index, code, 1, 0)
+
+        if self._exhausted and self._written == self._dispatched:
+            self._gzip_fileobj.close()
+            self._commit()
+            if self._checkpoint:
+                self._checkpoint.save(self._fileobj, self._codes_tried, self._urls_found, True)
+            self._log.info("Reaper examined %d codes and found %d URLs" % (self._codes_tried, self._urls_found))
+            self._callback(self._fileobj)
+
+    def _try(self, index, code, tries, blocked):
+        wait = self._rate_limit_reserve()
+        if wait > 0:
+            metrics.count("tinyback_rate_limit_sleep_seconds_total", self._labels, wait)
+            self._call_later(wait, self._fetch_async, index, code, tries, blocked)
+        else:
+            self._fetch_async(index, code, tries, blocked)
+
+    def _fetch_async(self, index, code, tries, blocked):
+        self._log.debug("Fetching code %s, try %i" % (code, tries))
+        start = time.time()
+        self._service.fetch_async(code, self._loop,
+            lambda result, exc_info: self._guard(self._fetched, index, code, tries, blocked, start, result, exc_info))
+
+    def _fetched(self, index, code, tries, blocked, start, result, exc_info):
+        self._record(tries, start, exc_info and exc_info[1])
+        if not exc_info:
+            self._rate_limit_success()
+            self._save(code, result)
+            self._complete(index, code, result)
+            return
+
+        e = exc_info[1]
+        if isinstance(e, exceptions.NoRedirectException):
+            self._log.debug("Code %s does not exist" % code)
+            self._rate_limit_success()
+            self._save(code, None)
+            self._complete(index, code, None)
+            return
+        elif isinstance(e, exceptions.BlockedException):
+            if self._rate_limiter:
+                self._rate_limiter.blocked()
+            blocked += 1
+            wait = (min(5 ** blocked, 3600))
+            self._log.info("Service blocked us %i times, backing off for %i seconds" % (blocked, wait))
+            metrics.count("tinyback_backoff_sleep_seconds_total", self._labels, wait)
+        elif isinstance(e, exceptions.ServiceException):
+            self._log.warn("ServiceException(%s) on code %s" % (e, code))
+            wait = 0
+        else:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        if tries < (self.MAX_TRIES + blocked):
+            self._call_later(wait, self._try, index, code, tries + 1, blocked)
+        else:
+            self._complete(index, code, None)
+
+    def _complete(self, index, code, result):
+        self._pending[index] = (code, result)
+        while self._written in self._pending:
+            code, result = self._pending.pop(self._written)
+            self._write(self._gzip_fileobj, code, result)
+            self._gzip_fileobj = self._save_checkpoint(self._fileobj, self._gzip_fileobj)
+            self._written += 1
+        self._dispatch()
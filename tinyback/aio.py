@@ -0,0 +1,274 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.aio - Non-blocking HTTP requests
+
+Python 2 has no asyncio, so this module provides a small event loop on top of
+asyncore together with a non-blocking HTTP client. It is used by
+Service.fetch_async and the AsyncReaper to keep many requests outstanding from
+a single thread.
+"""
+
+import StringIO
+import asyncore
+import errno
+import heapq
+import httplib
+import select
+import socket
+import ssl
+import sys
+import time
+
+from tinyback import exceptions
+
+class EventLoop:
+    """
+    Asyncore-based event loop with timers
+
+    All callbacks are run from EventLoop.run_once, never from inside an
+    asyncore handler, so exceptions raised by callbacks propagate to the
+    caller instead of being swallowed by asyncore.
+    """
+
+    def __init__(self, timeout=30):
+        self.map = {}
+        self.timeout = timeout
+        self._timers = []
+        self._sequence = 0
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run callback(*args) after delay seconds
+        """
+        heapq.heappush(self._timers, (time.time() + delay, self._sequence, callback, args))
+        self._sequence += 1
+
+    def call_soon(self, callback, *args):
+        """
+        Run callback(*args) on the next iteration of the loop
+        """
+        self.call_later(0, callback, *args)
+
+    def run(self):
+        """
+        Run the loop until there are neither open requests nor timers left
+        """
+        while self.map or self._timers:
+            self.run_once()
+
+    def run_once(self):
+        """
+        Wait for socket events or the next timer and process them
+        """
+        timeout = 1.0
+        if self._timers:
+            timeout = max(0, min(timeout, self._timers[0][0] - time.time()))
+
+        if self.map:
+            asyncore.loop(timeout, hasattr(select, "poll"), self.map, 1)
+        elif timeout > 0:
+            time.sleep(timeout)
+
+        now = time.time()
+        for channel in self.map.values():
+            channel.check_timeout(now)
+        while self._timers and self._timers[0][0] <= now:
+            when, sequence, callback, args = heapq.heappop(self._timers)
+            callback(*args)
+
+class HTTPRequest(asyncore.dispatcher):
+    """
+    Single non-blocking HTTP request
+
+    The request is sent with "Connection: close" and the response is read
+    until the server closes the connection. Once done, callback(response,
+    exc_info) is scheduled on the loop, where response is a (HTTPResponse,
+    body) tuple just like the one returned by HTTPService._http_fetch.
+    """
+
+    def __init__(self, loop, address, hostname, scheme, method, path, headers, callback):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self._loop = loop
+        self._hostname = hostname
+        self._ssl = scheme == "https"
+        self._method = method
+        self._callback = callback
+        self._deadline = time.time() + loop.timeout
+        self._handshaking = False
+        self._want_write = False
+        self._eof = False
+
+        headers = dict(headers)
+        headers["Connection"] = "close"
+        headers.setdefault("Host", hostname)
+        lines = ["%s %s HTTP/1.1" % (method, path)]
+        lines.extend("%s: %s" % header for header in headers.items())
+        self._outbuf = "\r\n".join(lines) + "\r\n\r\n"
+        self._inbuf = []
+
+        if ":" in address[0]:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+        self.create_socket(family, socket.SOCK_STREAM)
+        try:
+            self.connect(address)
+        except socket.error:
+            self.handle_error()
+
+    def check_timeout(self, now):
+        if now > self._deadline:
+            self.close()
+            self._finish(None, exceptions.ServiceException("Timeout after %i seconds" % self._loop.timeout))
+
+    def readable(self):
+        return not self._handshaking or not self._want_write
+
+    def writable(self):
+        if not self.connected:
+            return True
+        if self._handshaking:
+            return self._want_write
+        return bool(self._outbuf)
+
+    def handle_connect(self):
+        if not self._ssl:
+            return
+
+        sock = self.socket
+        self.del_channel()
+        if hasattr(ssl, "create_default_context"):
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=self._hostname,
+                do_handshake_on_connect=False)
+        else:
+            sock = ssl.wrap_socket(sock, do_handshake_on_connect=False)
+        self.set_socket(sock)
+        self._handshaking = True
+        self._handshake()
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+        elif self._drain():
+            self.handle_close()
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+            return
+
+        try:
+            sent = self.socket.send(self._outbuf)
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self._outbuf = self._outbuf[sent:]
+
+    def handle_close(self):
+        if self.connected and not self._handshaking and not self._eof:
+            self._drain()
+        self.close()
+
+        data = "".join(self._inbuf)
+        if not data:
+            self._finish(None, exceptions.ServiceException("Connection closed without response"))
+            return
+        try:
+            resp = httplib.HTTPResponse(_BufferSocket(data), method=self._method)
+            resp.begin()
+            body = resp.read()
+        except httplib.HTTPException, e:
+            self._finish(None, exceptions.ServiceException("HTTP exception: %s" % e))
+        else:
+            self._finish((resp, body), None)
+
+    def handle_expt(self):
+        self.handle_close()
+
+    def handle_error(self):
+        e = sys.exc_info()[1]
+        self.close()
+        self._finish(None, exceptions.ServiceException("Socket error: %s" % e))
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._want_write = False
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._want_write = True
+            else:
+                raise
+        else:
+            self._handshaking = False
+
+    def _drain(self):
+        """
+        Read everything that is available, returns True on end of stream
+        """
+        while not self._eof:
+            try:
+                data = self.socket.recv(65536)
+            except ssl.SSLError, e:
+                if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                    return False
+                # Servers often close without close_notify after
+                # "Connection: close"; truncation is caught by httplib
+                if e.args[0] == ssl.SSL_ERROR_EOF or "unexpected eof" in str(e).lower():
+                    self._eof = True
+                    break
+                raise
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                if e.args[0] in asyncore._DISCONNECTED:
+                    self._eof = True
+                    break
+                raise
+            if not data:
+                self._eof = True
+                break
+            self._inbuf.append(data)
+        return True
+
+    def _finish(self, response, error):
+        callback = self._callback
+        if not callback:
+            return
+        self._callback = None
+        if error:
+            error = (error.__class__, error, None)
+        self._loop.call_soon(callback, response, error)
+
+class _BufferSocket:
+    """
+    Socket stand-in that lets httplib.HTTPResponse parse a buffered response
+    """
+
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, mode, bufsize=0):
+        return StringIO.StringIO(self._data)
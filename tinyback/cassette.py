@@ -0,0 +1,184 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.cassette - Recorded HTTP exchanges for offline tests
+
+A Cassette holds the raw HTTP responses a service received for each code of
+its test fixtures. record fetches a code from the real URL shortener and adds
+every exchange to the cassette. CassetteServer serves the recorded responses
+of several services on a local port, under /<service>/... just like the mock
+server, so mockserver.mock_service gives a service instance that replays
+them without network access.
+
+Responses are stored as sent by the service except that the body is no
+longer chunked: Transfer-Encoding is dropped and Content-Length describes the
+stored body.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+from tinyback import services
+
+class Cassette:
+    """
+    Recorded exchanges of a single service, stored as JSON in path
+    """
+
+    def __init__(self, path, load=True):
+        self.path = path
+        self._fixtures = {}
+        self._responses = {}
+        if load:
+            f = open(path, "r")
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            for code, exchanges in data["fixtures"].iteritems():
+                for exchange in exchanges:
+                    self.add(code.encode("utf-8"), exchange["method"].encode("utf-8"),
+                        exchange["path"].encode("utf-8"), exchange["response"].encode("latin-1"))
+
+    def add(self, code, method, path, response):
+        """
+        Record the raw response to the request made for the code
+        """
+        self._fixtures.setdefault(code, []).append((method, path))
+        self._responses[(method, path)] = response
+
+    def response(self, method, path):
+        """
+        Returns the raw response to the request, or None if it was not
+        recorded
+
+        A HEAD request is answered from a recorded GET of the same path.
+        """
+        response = self._responses.get((method, path))
+        if response is None and method == "HEAD":
+            response = self._responses.get(("GET", path))
+            if response is not None:
+                response = response.split("\r\n\r\n", 1)[0] + "\r\n\r\n"
+        return response
+
+    def save(self):
+        fixtures = {}
+        for code, requests in self._fixtures.iteritems():
+            fixtures[code] = [{"method": method, "path": path,
+                "response": self._responses[(method, path)].decode("latin-1")}
+                for method, path in requests]
+        f = open(self.path + ".tmp", "w")
+        try:
+            json.dump({"fixtures": fixtures}, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(self.path + ".tmp", self.path)
+
+def record(service, code, cassette):
+    """
+    Fetch the code from the real service, recording every exchange
+
+    Returns the result of service.fetch; exceptions are passed on.
+    """
+    responses = {}
+    while True:
+        try:
+            return service._replay_fetch(code, responses)
+        except services._PendingRequest, e:
+            # Read the whole body, the replay may need more than this fetch
+            resp, body = service._http_request(e.method, e.path, e.headers)
+            responses[(e.method, e.path)] = (resp, body)
+            cassette.add(code, e.method, e.path, dump_response(e.method, resp, body))
+
+def dump_response(method, resp, body):
+    """
+    Returns the raw HTTP response for the parsed response and its body
+    """
+    lines = ["HTTP/%s %i %s\r\n" % ("1.0" if resp.version == 10 else "1.1", resp.status, resp.reason)]
+    skip = False
+    for line in resp.msg.headers:
+        if line[0] not in " \t":
+            name = line.split(":", 1)[0].strip().lower()
+            skip = name == "transfer-encoding" or (name == "content-length" and method != "HEAD")
+        if not skip:
+            lines.append(line.rstrip("\r\n") + "\r\n")
+    if method != "HEAD":
+        lines.append("Content-Length: %i\r\n" % len(body))
+    return "".join(lines) + "\r\n" + body
+
+class CassetteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server replaying the cassettes of several services
+
+    cassettes maps service names to Cassette instances. Requests that were
+    not recorded are answered with HTTP status 404.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, cassettes, address=("127.0.0.1", 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, CassetteRequestHandler)
+        self.cassettes = cassettes
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class CassetteRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method):
+        response = None
+        parts = self.path.split("/", 2)
+        if len(parts) == 3 and parts[1] in self.server.cassettes:
+            response = self.server.cassettes[parts[1]].response(method, "/" + parts[2])
+        if response is None:
+            logging.getLogger("tinyback.CassetteServer").warn("Not recorded: %s %s" % (method, self.path))
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.wfile.write(response)
@@ -0,0 +1,256 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.chains - Resolve long URLs that are short URLs of another service
+
+Many long URLs point to another URL shortener. ChainResolver recognizes short
+URLs of the services in services._factory_map and follows them to their final
+destination. Every code it fetched is memoized in an LRU cache that can be
+kept in a file across runs, so popular intermediate codes are only fetched
+once.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+import urlparse
+
+from tinyback import exceptions, ratelimit, services
+
+CACHE_SIZE = 100000
+"""Number of resolved codes kept in memory and in the cache file"""
+
+MAX_DEPTH = 5
+"""Maximum number of short URLs followed for a single long URL"""
+
+class ChainResolver:
+    """
+    Follows chains of short URLs, caching the result of every code
+
+    The cache file holds one "service|code|url" line per code, with an empty
+    url for codes that do not exist. New results are appended and the file is
+    rewritten from memory when it grows to twice the cache size.
+
+    Codes that could not be fetched because of a block or an error are not
+    cached; resolution stops at the last URL reached.
+    """
+
+    def __init__(self, cache_file=None, cache_size=CACHE_SIZE, max_depth=MAX_DEPTH, factory_map=None):
+        self._log = logging.getLogger("tinyback.ChainResolver")
+        self._cache_file = cache_file
+        self._cache_size = max(1, cache_size)
+        self._max_depth = max_depth
+
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._lines = 0
+        self._fileobj = None
+
+        self.hits = 0
+        self.misses = 0
+
+        if factory_map is None:
+            factory_map = services._factory_map
+        self._factory_map = factory_map
+        self._prefixes = []
+        for name in sorted(factory_map):
+            service = factory_map[name].__new__(factory_map[name])
+            url = urlparse.urlparse(service.short_url)
+            path = url.path
+            if not path.endswith("/"):
+                path += "/"
+            self._prefixes.append((self._normalize_host(url.netloc), path, name, service.charset))
+
+        if self._cache_file:
+            self._load()
+
+    def match(self, url):
+        """
+        Returns (service name, code) if the URL is a short URL of a known
+        service, or None otherwise
+
+        If several services use the same short URLs, the first name in sorted
+        order wins.
+        """
+        try:
+            url = urlparse.urlparse(url)
+        except ValueError:
+            return None
+        if url.scheme not in ("http", "https"):
+            return None
+        host = self._normalize_host(url.netloc)
+        for prefix_host, prefix_path, name, charset in self._prefixes:
+            if host != prefix_host or not url.path.startswith(prefix_path):
+                continue
+            code = url.path[len(prefix_path):]
+            if code.endswith("/"):
+                code = code[:-1]
+            if code and all(c in charset for c in code):
+                return (name, code)
+        return None
+
+    def resolve(self, url):
+        """
+        Returns the final destination of the URL
+
+        URLs that are not short URLs of a known service are returned as they
+        are. If a code in the chain does not exist, the short URL pointing to
+        it is the final destination.
+        """
+        seen = set()
+        for depth in range(self._max_depth):
+            match = self.match(url)
+            if not match:
+                return url
+            if match in seen:
+                self._log.warn("Loop of short URLs at %s" % url)
+                return url
+            seen.add(match)
+
+            try:
+                result = self.lookup(*match)
+            except exceptions.ServiceException, e:
+                self._log.warn("Could not resolve %s: %s" % (url, e))
+                return url
+            if result is None:
+                return url
+            url = result
+
+        if self.match(url):
+            self._log.warn("Chain of short URLs longer than %i at %s" % (self._max_depth, url))
+        return url
+
+    def lookup(self, name, code):
+        """
+        Returns the long URL of the code, or None if it does not exist
+
+        Raises ServiceException if the code could not be fetched.
+        """
+        key = (name, code)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                result = self._cache.pop(key)
+                self._cache[key] = result
+                return result
+            self.misses += 1
+
+        result = self._fetch(name, code)
+        if result is not None and ("\n" in result or "\r" in result):
+            raise exceptions.ServiceException("URL contains newline")
+        with self._lock:
+            self._store(key, result)
+            self._append(key, result)
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._fileobj:
+                self._fileobj.close()
+                self._fileobj = None
+
+    def _fetch(self, name, code):
+        service_map = getattr(self._local, "services", None)
+        if service_map is None:
+            service_map = self._local.services = {}
+        service = service_map.get(name)
+        if not service:
+            try:
+                service = service_map[name] = self._factory_map[name]()
+            except Exception, e:
+                raise exceptions.ServiceException("Could not set up service %s: %s" % (name, e))
+
+        bucket = None
+        if service.rate_limit:
+            bucket = ratelimit.get_bucket(name, service.rate_limit)
+            wait = bucket.reserve()
+            if wait > 0:
+                self._log.debug("Sleeping for %f seconds to satisfy rate limit" % wait)
+                time.sleep(wait)
+
+        self._log.debug("Fetching code %s of service %s" % (code, name))
+        try:
+            result = service.fetch(code)
+        except exceptions.NoRedirectException:
+            result = None
+        except exceptions.BlockedException:
+            if bucket:
+                bucket.blocked()
+            raise
+        if bucket:
+            bucket.success()
+        return result
+
+    def _store(self, key, result):
+        self._cache.pop(key, None)
+        self._cache[key] = result
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(False)
+
+    def _append(self, key, result):
+        if not self._cache_file:
+            return
+        if self._lines >= 2 * self._cache_size:
+            self._compact()
+        if not self._fileobj:
+            self._fileobj = open(self._cache_file, "ab")
+        self._fileobj.write(self._format(key, result))
+        self._fileobj.flush()
+        self._lines += 1
+
+    def _load(self):
+        if not os.path.exists(self._cache_file):
+            return
+        with open(self._cache_file, "rb") as fileobj:
+            for line in fileobj:
+                if not line.endswith("\n"):
+                    # Partial line of an interrupted run
+                    continue
+                fields = line[:-1].split("|", 2)
+                if len(fields) != 3:
+                    continue
+                self._store((fields[0], fields[1]), fields[2] or None)
+                self._lines += 1
+        self._log.info("Loaded %i resolved codes from %s" % (len(self._cache), self._cache_file))
+        if self._lines >= 2 * self._cache_size or self._lines > len(self._cache):
+            self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the cache file with the entries kept in memory
+        """
+        if self._fileobj:
+            self._fileobj.close()
+            self._fileobj = None
+        temp_file = self._cache_file + ".tmp"
+        with open(temp_file, "wb") as fileobj:
+            for key, result in self._cache.iteritems():
+                fileobj.write(self._format(key, result))
+        os.rename(temp_file, self._cache_file)
+        self._lines = len(self._cache)
+
+    def _format(self, key, result):
+        return "%s|%s|%s\n" % (key[0], key[1], result or "")
+
+    def _normalize_host(self, netloc):
+        host = netloc.lower()
+        if host.startswith("www."):
+            host = host[4:]
+        return host
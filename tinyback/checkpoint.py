@@ -0,0 +1,143 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.checkpoint - Resumable task state
+
+A checkpointed Reaper writes its output to a data file next to a small JSON
+state file instead of an anonymous temporary file. At every checkpoint the
+current gzip member is finished and flushed to disk and the state file is
+replaced with the number of codes examined so far, the number of URLs found
+and the size of the data file. A Reaper restarted with the checkpoint cuts
+the data file back to that size and continues with the next code; the
+result is a multi-member gzip file with the same lines as an uninterrupted
+run.
+"""
+
+import glob
+import json
+import logging
+import os
+import tempfile
+import time
+
+INTERVAL = 60
+"""Seconds between two checkpoints"""
+
+def find(directory=None):
+    """
+    Returns all checkpoints found in the given directory
+    """
+    checkpoints = []
+    for path in glob.glob(os.path.join(directory or tempfile.gettempdir(), "tinyback-*.json")):
+        try:
+            f = open(path, "r")
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            continue
+        checkpoints.append(Checkpoint(directory, state["task"]))
+    return checkpoints
+
+class Checkpoint:
+    """
+    Checkpoint of a single task in the given directory
+    """
+
+    def __init__(self, directory, task):
+        self._log = logging.getLogger("tinyback.Checkpoint")
+        self.task = task
+        base = os.path.join(directory or tempfile.gettempdir(), "tinyback-%s" % task["id"])
+        self._state_path = base + ".json"
+        self._data_path = base + ".gz"
+
+        self.codes_tried = 0
+        self.urls_found = 0
+        self.complete = False
+        self._size = 0
+        self._saved = time.time()
+
+        if os.path.exists(self._state_path) and os.path.exists(self._data_path):
+            f = open(self._state_path, "r")
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            if state["task"] == task:
+                self.codes_tried = state["codes_tried"]
+                self.urls_found = state["urls_found"]
+                self.complete = state["complete"]
+                self._size = state["size"]
+                self._log.info("Resuming task %s after %i codes" % (task["id"], self.codes_tried))
+
+    def open(self):
+        """
+        Open the data file, positioned after the last checkpoint
+        """
+        if os.path.exists(self._data_path):
+            fileobj = open(self._data_path, "r+b")
+        else:
+            fileobj = open(self._data_path, "w+b")
+        fileobj.truncate(self._size)
+        fileobj.seek(0, os.SEEK_END)
+        return fileobj
+
+    def due(self):
+        """
+        Whether it is time for the next checkpoint
+        """
+        return time.time() - self._saved >= INTERVAL
+
+    def save(self, fileobj, codes_tried, urls_found, complete=False):
+        """
+        Record the state after a finished gzip member
+        """
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+
+        self.codes_tried = codes_tried
+        self.urls_found = urls_found
+        self.complete = complete
+        self._size = fileobj.tell()
+        self._saved = time.time()
+
+        state = {
+            "task": self.task,
+            "codes_tried": codes_tried,
+            "urls_found": urls_found,
+            "complete": complete,
+            "size": self._size,
+        }
+        temp_path = self._state_path + ".tmp"
+        f = open(temp_path, "w")
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(temp_path, self._state_path)
+        self._log.debug("Checkpoint for task %s after %i codes" % (self.task["id"], codes_tried))
+
+    def remove(self):
+        """
+        Delete the checkpoint once the results have been submitted
+        """
+        for path in (self._state_path, self._data_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,342 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.compact - Compact archive format for results
+
+The results of a Reaper are gzipped "code|url" lines, which have to be
+decompressed from the start to find a single code. A compact archive stores
+the same results in blocks of BLOCK_SIZE records that are compressed
+independently, plus an index of all blocks, so a code can be looked up by
+decompressing only the blocks that may contain it.
+
+Most URLs share a handful of hosts, so every URL is split into a prefix
+(scheme and host) and the rest. Prefixes are stored once in a table and
+records refer to them by number. Within a block the records are stored by
+column, which compresses better than interleaved records. Each code is
+stored as the number of leading bytes it shares with the previous code of
+the block and the rest, so the codes of sequence tasks take little more
+than a byte each. Lengths are kept apart from the bytes they describe.
+
+Layout of a file; numbers are unsigned LEB128 varints, strings are a varint
+length followed by the bytes:
+
+    MAGIC
+    block*      zlib(count, shared length*, rest length*, rest bytes,
+                     prefix number*, suffix length*, suffix bytes)
+    footer      zlib(prefix count, prefix*, block count,
+                     (offset, size, count, first code, last code)*)
+    trailer     footer offset as 8 byte little-endian integer, MAGIC
+
+first code and last code are the smallest and largest code of the block in
+byte order. Records keep the order they were written in, so converting an
+archive back to lines gives the original results. If a code was written more
+than once, a lookup returns the URL of its first record.
+"""
+
+import collections
+import gzip
+import struct
+import zlib
+
+MAGIC = "TBC2"
+"""First and last bytes of every compact archive"""
+
+BLOCK_SIZE = 4096
+"""Number of records per block"""
+
+LEVEL = 9
+"""zlib compression level of blocks and footer"""
+
+CACHE_BLOCKS = 8
+"""Number of decoded blocks a reader keeps for lookups"""
+
+MAX_PREFIXES = 65536
+"""Maximum size of the prefix table; further URLs are stored whole"""
+
+_TRAILER = struct.Struct("<Q4s")
+
+def from_gzip(source, destination, block_size=BLOCK_SIZE, level=LEVEL):
+    """
+    Convert gzipped results read from the file object source to a compact
+    archive written to the file object destination
+
+    Returns the number of records.
+    """
+    writer = CompactWriter(destination, block_size, level)
+    gzip_fileobj = gzip.GzipFile(mode="rb", fileobj=source)
+    for line in gzip_fileobj:
+        code, url = line.rstrip("\n").split("|", 1)
+        writer.write(code, url)
+    gzip_fileobj.close()
+    writer.close()
+    return writer.count
+
+def to_gzip(source, destination):
+    """
+    Convert the compact archive read from the file object source to gzipped
+    results written to the file object destination
+
+    Returns the number of records.
+    """
+    count = 0
+    gzip_fileobj = gzip.GzipFile(mode="wb", fileobj=destination)
+    for code, url in CompactReader(source):
+        gzip_fileobj.write("%s|%s\n" % (code, url))
+        count += 1
+    gzip_fileobj.close()
+    return count
+
+class CompactWriter:
+    """
+    Write records to a compact archive in the file object fileobj
+
+    The file object only needs to support write. close writes the index but
+    does not close the file object.
+    """
+
+    def __init__(self, fileobj, block_size=BLOCK_SIZE, level=LEVEL):
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._level = level
+        self._prefixes = {"": 0}
+        self._blocks = []
+        self._records = []
+        self._offset = len(MAGIC)
+        self.count = 0
+        fileobj.write(MAGIC)
+
+    def write(self, code, url):
+        self._records.append((code, url))
+        self.count += 1
+        if len(self._records) >= self._block_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        prefixes = sorted(self._prefixes, key=self._prefixes.get)
+        footer = [_varint(len(prefixes))]
+        footer.extend(_string(prefix) for prefix in prefixes)
+        footer.append(_varint(len(self._blocks)))
+        for offset, size, count, first, last in self._blocks:
+            footer.append("".join((_varint(offset), _varint(size), _varint(count), _string(first), _string(last))))
+        data = zlib.compress("".join(footer), self._level)
+        self._fileobj.write(data)
+        self._fileobj.write(_TRAILER.pack(self._offset, MAGIC))
+
+    def _flush(self):
+        if not self._records:
+            return
+        shared_lengths = []
+        rest_lengths = []
+        rests = []
+        numbers = []
+        suffix_lengths = []
+        suffixes = []
+        previous = ""
+        for code, url in self._records:
+            shared = _shared_length(previous, code)
+            previous = code
+            prefix, suffix = _split_url(url)
+            number = self._prefixes.get(prefix)
+            if number is None:
+                if len(self._prefixes) < MAX_PREFIXES:
+                    number = self._prefixes[prefix] = len(self._prefixes)
+                else:
+                    number, suffix = 0, url
+            shared_lengths.append(_varint(shared))
+            rest_lengths.append(_varint(len(code) - shared))
+            rests.append(code[shared:])
+            numbers.append(_varint(number))
+            suffix_lengths.append(_varint(len(suffix)))
+            suffixes.append(suffix)
+        columns = [_varint(len(self._records))]
+        for column in (shared_lengths, rest_lengths, rests, numbers, suffix_lengths, suffixes):
+            columns.append("".join(column))
+        data = zlib.compress("".join(columns), self._level)
+        block_codes = [code for code, url in self._records]
+        self._blocks.append((self._offset, len(data), len(self._records), min(block_codes), max(block_codes)))
+        self._fileobj.write(data)
+        self._offset += len(data)
+        self._records = []
+
+class CompactReader:
+    """
+    Read a compact archive from the seekable file object fileobj
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        fileobj.seek(0)
+        if fileobj.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a compact archive")
+        fileobj.seek(-_TRAILER.size, 2)
+        footer_offset, magic = _TRAILER.unpack(fileobj.read(_TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("Truncated compact archive")
+        end = fileobj.tell() - _TRAILER.size
+        fileobj.seek(footer_offset)
+        footer = zlib.decompress(fileobj.read(end - footer_offset))
+
+        count, pos = _read_varint(footer, 0)
+        self._prefixes = []
+        for i in xrange(count):
+            prefix, pos = _read_string(footer, pos)
+            self._prefixes.append(prefix)
+        count, pos = _read_varint(footer, pos)
+        self._blocks = []
+        for i in xrange(count):
+            offset, pos = _read_varint(footer, pos)
+            size, pos = _read_varint(footer, pos)
+            records, pos = _read_varint(footer, pos)
+            first, pos = _read_string(footer, pos)
+            last, pos = _read_string(footer, pos)
+            self._blocks.append((offset, size, records, first, last))
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return sum(block[2] for block in self._blocks)
+
+    def __iter__(self):
+        """
+        Yields all (code, url) records in the order they were written
+        """
+        for index in xrange(len(self._blocks)):
+            for record in self._block(index):
+                yield record
+
+    def lookup(self, code):
+        """
+        Returns the URL of the code, or None if it is not in the archive
+
+        If the code occurs more than once, the URL of its first record is
+        returned. Only blocks whose range of codes includes the code are
+        decompressed. For sequence tasks that is usually a single block; codes
+        of chain tasks are spread over all blocks.
+        """
+        for index, (offset, size, records, first, last) in enumerate(self._blocks):
+            if first <= code <= last:
+                urls = self._urls(index)
+                if code in urls:
+                    return urls[code]
+        return None
+
+    def _urls(self, index):
+        """
+        Returns a dictionary of the URLs in the block with the given index,
+        holding the first URL of codes that occur more than once
+
+        The dictionaries of the last CACHE_BLOCKS blocks are kept.
+        """
+        urls = self._cache.pop(index, None)
+        if urls is None:
+            urls = {}
+            for code, url in self._block(index):
+                urls.setdefault(code, url)
+            if len(self._cache) >= CACHE_BLOCKS:
+                self._cache.popitem(False)
+        self._cache[index] = urls
+        return urls
+
+    def _block(self, index):
+        """
+        Returns the records of the block with the given index
+        """
+        offset, size, count, first, last = self._blocks[index]
+        self._fileobj.seek(offset)
+        return self._decode(zlib.decompress(self._fileobj.read(size)))
+
+    def _decode(self, data):
+        count, pos = _read_varint(data, 0)
+        shared_lengths, pos = _read_varints(data, pos, count)
+        rest_lengths, pos = _read_varints(data, pos, count)
+        codes = []
+        previous = ""
+        for i in xrange(count):
+            end = pos + rest_lengths[i]
+            previous = previous[:shared_lengths[i]] + data[pos:end]
+            codes.append(previous)
+            pos = end
+        numbers, pos = _read_varints(data, pos, count)
+        suffix_lengths, pos = _read_varints(data, pos, count)
+        records = []
+        for i in xrange(count):
+            end = pos + suffix_lengths[i]
+            records.append((codes[i], self._prefixes[numbers[i]] + data[pos:end]))
+            pos = end
+        return records
+
+def _split_url(url):
+    """
+    Returns the scheme and host part of the URL including the following
+    slash, and the rest
+    """
+    start = url.find("://")
+    if start == -1:
+        return "", url
+    end = url.find("/", start + 3)
+    if end == -1:
+        return "", url
+    return url[:end + 1], url[end + 1:]
+
+def _shared_length(a, b):
+    """
+    Returns the number of leading bytes a and b have in common
+    """
+    length = min(len(a), len(b))
+    for i in xrange(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+def _varint(value):
+    data = []
+    while value > 0x7f:
+        data.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    data.append(chr(value))
+    return "".join(data)
+
+def _string(value):
+    return _varint(len(value)) + value
+
+def _read_varint(data, pos):
+    """
+    Returns the varint at pos and the position after it
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def _read_varints(data, pos, count):
+    """
+    Returns a list of the count varints at pos and the position after them
+    """
+    values = []
+    for i in xrange(count):
+        value, pos = _read_varint(data, pos)
+        values.append(value)
+    return values, pos
+
+def _read_string(data, pos):
+    length, pos = _read_varint(data, pos)
+    return data[pos:pos + length], pos + length
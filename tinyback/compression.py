@@ -0,0 +1,251 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.compression - Compression of Reaper output on a separate thread
+
+A CompressedWriter collects the lines written by a Reaper into chunks of
+CHUNK_SIZE bytes and hands them to a thread of its own through a queue of
+QUEUE_SIZE chunks. That thread compresses them and writes them to the
+output, so compression runs alongside the requests instead of between them.
+When the queue is full, write blocks until the thread catches up. Writers
+created with block=False keep such chunks themselves instead, so an event
+loop can check full and idle and wait for the thread without stalling.
+
+The backend is chosen by name:
+
+    gzip    gzip member, readable by gzip.GzipFile (levels 0-9)
+    zlib    zlib stream with the largest window and memory level (0-9)
+    xz      xz stream, if the lzma module is available (0-9)
+    zstd    zstandard frame, if the zstandard module is available (1-22)
+    lz4     lz4 frame, if the lz4 module is available (0-16)
+
+The tracker only accepts gzip.
+"""
+
+import Queue
+import sys
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+CHUNK_SIZE = 64 * 1024
+"""Bytes collected before they are handed to the compression thread"""
+
+QUEUE_SIZE = 16
+"""Number of chunks waiting for the compression thread at most"""
+
+DEFAULT_LEVELS = {"gzip": 9, "zlib": 9, "xz": 6, "zstd": 3, "lz4": 0}
+"""Levels used if none is given; gzip matches gzip.GzipFile"""
+
+def backends():
+    """
+    Returns the names of the backends that are available
+    """
+    names = ["gzip", "zlib"]
+    if lzma:
+        names.append("xz")
+    if zstandard:
+        names.append("zstd")
+    if lz4_frame:
+        names.append("lz4")
+    return names
+
+def compressor(backend="gzip", level=None):
+    """
+    Returns a new compressor object of the backend
+
+    Like zlib compression objects, it has a compress method returning the
+    compressed data available so far and a flush method ending the stream.
+    """
+    if level is None:
+        level = DEFAULT_LEVELS.get(backend)
+    if backend == "gzip":
+        # A window size of 16 + 15 makes zlib write a gzip header and trailer
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif backend == "zlib":
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9)
+    elif backend == "xz" and lzma:
+        return lzma.LZMACompressor(lzma.FORMAT_XZ, preset=level)
+    elif backend == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    elif backend == "lz4" and lz4_frame:
+        return _LZ4Compressor(level)
+    raise ValueError("Unknown or unavailable compression backend %s" % backend)
+
+class CompressedWriter:
+    """
+    File-like object compressing everything written to it into fileobj
+
+    close ends the compressed stream and waits for the compression thread,
+    but does not close fileobj. abort stops the thread without ending the
+    stream. Errors of the thread are raised by the next call of write or
+    close.
+    """
+
+    def __init__(self, fileobj, backend="gzip", level=None, block=True):
+        self._fileobj = fileobj
+        self._compressor = compressor(backend, level)
+        self._block = block
+        self._buffer = []
+        self._size = 0
+        self._waiting = []
+        self._chunks = Queue.Queue(QUEUE_SIZE)
+        self._handed = 0
+        self._done = 0
+        self._aborted = False
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        if self._thread is None:
+            raise ValueError("I/O operation on closed CompressedWriter")
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= CHUNK_SIZE:
+            self._hand_over()
+
+    def full(self):
+        """
+        Whether chunks are kept back because the queue is full
+        """
+        self._check()
+        self._put_waiting()
+        return bool(self._waiting)
+
+    def idle(self):
+        """
+        Whether the thread has written all chunks handed over so far
+        """
+        self._check()
+        self._put_waiting()
+        return not self._waiting and self._done == self._handed
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._hand_over()
+        for chunk in self._waiting:
+            self._chunks.put(chunk)
+        self._waiting = []
+        self._chunks.put(None)
+        self._thread.join()
+        self._thread = None
+        self._check()
+
+    def abort(self):
+        """
+        Stop the thread, dropping all data not yet compressed
+
+        Does not wait for the thread, which may be stuck writing to fileobj.
+        Does nothing if the writer was already closed.
+        """
+        if self._thread is None:
+            return
+        self._aborted = True
+        self._buffer = []
+        self._waiting = []
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except Queue.Empty:
+                break
+        # Only this thread puts chunks, so there is room for the None now
+        self._chunks.put(None)
+        self._thread = None
+
+    def _hand_over(self):
+        self._check()
+        if self._buffer:
+            self._waiting.append("".join(self._buffer))
+            self._handed += 1
+            self._buffer = []
+            self._size = 0
+        if self._block:
+            for chunk in self._waiting:
+                self._chunks.put(chunk)
+            self._waiting = []
+        else:
+            self._put_waiting()
+
+    def _put_waiting(self):
+        while self._waiting:
+            try:
+                self._chunks.put_nowait(self._waiting[0])
+            except Queue.Full:
+                return
+            self._waiting.pop(0)
+
+    def _check(self):
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def _run(self):
+        while True:
+            chunk = self._chunks.get()
+            if self._exc_info or self._aborted:
+                # Keep taking chunks, so write does not block forever
+                if chunk is None:
+                    return
+                continue
+            try:
+                if chunk is None:
+                    self._fileobj.write(self._compressor.flush())
+                    return
+                data = self._compressor.compress(chunk)
+                if data:
+                    self._fileobj.write(data)
+                self._done += 1
+            except Exception:
+                self._exc_info = sys.exc_info()
+                if chunk is None:
+                    return
+
+class _LZ4Compressor:
+    """
+    Compressor object interface for lz4 frames
+    """
+
+    def __init__(self, level):
+        self._compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, ""
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        header, self._header = self._header, ""
+        return header + self._compressor.flush()
@@ -0,0 +1,236 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.deadcodes - Bloom filters of codes that do not exist
+
+If DIRECTORY is set, every service gets a DeadCodeFilter kept in that
+directory. Reapers skip codes found in the filter and add every code the
+service answered with NoRedirectException, so repeated sweeps over the same
+range only spend requests on codes that might have been created since.
+
+A Bloom filter cannot forget single codes. Instead, codes are added to the
+newest of several generations, and a new generation is started every
+MAX_AGE / GENERATIONS seconds. Generations start at multiples of that
+period, so all processes sharing a filter fill the same generation. Generations older than MAX_AGE are dropped,
+so a dead code is checked again after between MAX_AGE * (1 - 1 /
+GENERATIONS) and MAX_AGE seconds. A code is looked up in every generation,
+so each one is sized for ERROR_RATE / GENERATIONS; a Reaper then skips a code
+that might exist with a probability of about ERROR_RATE at most. A generation
+that reaches CAPACITY codes early is followed by a new one right away, which
+raises the rate by ERROR_RATE / GENERATIONS for every extra generation.
+"""
+
+import binascii
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DIRECTORY = None
+"""Directory for the filters of all services, or None to disable them"""
+
+MAX_AGE = 30 * 24 * 3600
+"""Seconds after which a dead code is checked again"""
+
+GENERATIONS = 4
+"""Number of generations a code is kept in over MAX_AGE"""
+
+CAPACITY = 1000000
+"""Number of codes per generation the filters are sized for"""
+
+ERROR_RATE = 0.01
+"""False positive rate of all generations together, each holding CAPACITY codes"""
+
+_filters = {}
+_filters_lock = threading.Lock()
+
+def get_filter(name):
+    """
+    Returns the filter for the service with the given name, or None if
+    DIRECTORY is not set
+    """
+    if not DIRECTORY:
+        return None
+    with _filters_lock:
+        dead_codes = _filters.get(name)
+        if not dead_codes:
+            path = os.path.join(DIRECTORY, name + ".bloom")
+            dead_codes = _filters[name] = DeadCodeFilter(path, MAX_AGE, CAPACITY, ERROR_RATE)
+        return dead_codes
+
+class DeadCodeFilter:
+    """
+    Generational Bloom filter of dead codes kept in the file at path
+
+    Each generation is sized for capacity codes and a false positive rate of
+    error_rate / GENERATIONS.
+
+    save merges the generations in the file into the filter before writing
+    it, so several processes can share the file. The file is locked with
+    flock while it is updated.
+    """
+
+    def __init__(self, path, max_age=MAX_AGE, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self._log = logging.getLogger("tinyback.DeadCodeFilter")
+        self._path = path
+        self._max_age = max_age
+        self._capacity = capacity
+        generation_rate = float(error_rate) / GENERATIONS
+        self._bits = int(math.ceil(-capacity * math.log(generation_rate) / math.log(2) ** 2))
+        self._bits = (self._bits + 7) // 8 * 8
+        self._hashes = max(1, int(round(self._bits * math.log(2) / capacity)))
+        self._lock = threading.Lock()
+        # Lists of [start time, number of codes, bytearray], oldest first
+        self._generations = []
+
+        with self._lock:
+            self._merge(self._load())
+        self._log.info("Loaded %i dead codes in %i generations from %s" % (len(self), len(self._generations), path))
+
+    def __len__(self):
+        return sum(generation[1] for generation in self._generations)
+
+    def __contains__(self, code):
+        positions = self._positions(code)
+        with self._lock:
+            self._expire()
+            for start, count, bits in self._generations:
+                for position in positions:
+                    if not bits[position >> 3] & (1 << (position & 7)):
+                        break
+                else:
+                    return True
+        return False
+
+    def add(self, code):
+        """
+        Remember that the code does not exist
+        """
+        positions = self._positions(code)
+        with self._lock:
+            self._expire()
+            period = float(self._max_age) / GENERATIONS
+            start = math.floor(time.time() / period) * period
+            generation = self._generations and self._generations[-1]
+            if not generation or generation[0] < start or generation[1] >= self._capacity:
+                if generation and generation[0] >= start:
+                    # The generation filled up early; processes whose
+                    # generation fills up as well pick the same start
+                    start = generation[0] + 1
+                generation = [start, 0, bytearray(self._bits // 8)]
+                self._generations.append(generation)
+            bits = generation[2]
+            for position in positions:
+                bits[position >> 3] |= 1 << (position & 7)
+            generation[1] += 1
+
+    def save(self):
+        """
+        Write the filter to its file, together with codes added to the file
+        by other processes since it was loaded
+        """
+        with self._lock:
+            fd = os.open(self._path + ".lock", os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                self._merge(self._load())
+                self._expire()
+                temp_path = "%s.%i.tmp" % (self._path, os.getpid())
+                f = open(temp_path, "wb")
+                try:
+                    header = {
+                        "bits": self._bits,
+                        "hashes": self._hashes,
+                        "generations": [[start, count] for start, count, bits in self._generations],
+                    }
+                    f.write(json.dumps(header) + "\n")
+                    for start, count, bits in self._generations:
+                        f.write(bits)
+                finally:
+                    f.close()
+                os.rename(temp_path, self._path)
+            finally:
+                os.close(fd)
+
+    def _positions(self, code):
+        """
+        Returns the bit positions of the code using double hashing
+        """
+        a, b = struct.unpack("<QQ", hashlib.md5(code).digest())
+        b |= 1
+        return [(a + i * b) % self._bits for i in range(self._hashes)]
+
+    def _expire(self):
+        limit = time.time() - self._max_age
+        while self._generations and self._generations[0][0] < limit:
+            self._generations.pop(0)
+
+    def _load(self):
+        """
+        Returns the generations in the file
+        """
+        try:
+            f = open(self._path, "rb")
+        except IOError:
+            return []
+        try:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                self._log.warn("Ignoring malformed filter %s" % self._path)
+                return []
+            if header["bits"] != self._bits or header["hashes"] != self._hashes:
+                self._log.warn("Ignoring filter %s with different size" % self._path)
+                return []
+            generations = []
+            for start, count in header["generations"]:
+                bits = bytearray(f.read(self._bits // 8))
+                if len(bits) != self._bits // 8:
+                    self._log.warn("Ignoring truncated filter %s" % self._path)
+                    return []
+                generations.append([start, count, bits])
+            return generations
+        finally:
+            f.close()
+
+    def _merge(self, generations):
+        """
+        Add the codes of the given generations, which are matched by their
+        start time
+        """
+        own = dict((generation[0], generation) for generation in self._generations)
+        for start, count, bits in generations:
+            generation = own.get(start)
+            if not generation:
+                self._generations.append([start, count, bits])
+                continue
+            # Both sides may have added codes since the last save; the count
+            # only estimates the number of codes in the generation
+            generation[1] = max(generation[1], count)
+            merged = int(binascii.hexlify(generation[2]), 16) | int(binascii.hexlify(bits), 16)
+            generation[2] = bytearray(binascii.unhexlify("%0*x" % (len(bits) * 2, merged)))
+        self._generations.sort(key=lambda generation: generation[0])
@@ -0,0 +1,67 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.extract - Extract URLs from HTML pages
+
+Services that parse pages keep their patterns compiled as class attributes
+and use search to get the unescaped target URL. unescape works on UTF-8
+bytestrings directly and gives the same result as HTMLParser.unescape
+followed by encode("utf-8"), without creating a parser object and without
+decoding strings that contain no entities at all.
+"""
+
+import htmlentitydefs
+import re
+
+_ENTITY_RE = re.compile(r"&(#?[xX]?(?:[0-9a-fA-F]+|\w{1,8}));")
+
+_ENTITIES = dict((name, unichr(codepoint).encode("utf-8"))
+    for name, codepoint in htmlentitydefs.name2codepoint.iteritems())
+_ENTITIES["apos"] = "'"
+
+def search(pattern, data):
+    """
+    Returns the unescaped first group of the compiled pattern in the page,
+    or None if the pattern does not match
+    """
+    match = pattern.search(data)
+    if not match:
+        return None
+    return unescape(match.group(1))
+
+def unescape(data):
+    """
+    Replace HTML entities in the bytestring with their UTF-8 encoding
+
+    Unknown entities are left alone.
+    """
+    if "&" not in data:
+        return data
+    return _ENTITY_RE.sub(_replace_entity, data)
+
+def _replace_entity(match):
+    name = match.group(1)
+    if name[0] != "#":
+        return _ENTITIES.get(name, match.group(0))
+    try:
+        if name[1] in "xX":
+            codepoint = int(name[2:], 16)
+        else:
+            codepoint = int(name[1:])
+        return unichr(codepoint).encode("utf-8")
+    except (ValueError, OverflowError):
+        return match.group(0)
@@ -20,26 +20,126 @@ tinyback.generators - Module to generate lists of shortcodes
 To ensure that each task always consists of the same shortcodes, tinyback uses
 different generators that - given one set of input parameters - will always
 yield the same sequence of shortcodes.
+
+A task can be divided among several workers with split; merge puts the
+results of the shards back into the order of the whole sequence.
 """
 
 import hashlib
+import heapq
+import itertools
 
-def factory(generator_type, generator_options):
+def factory(generator_type, generator_options, start=0):
     """
     Creates a new generator
 
     Returns a generator of the given type initialized with the specified
-    options. Valid types are: chain, list and sequence.
+    options. Valid types are: chain, list and sequence. The first start
+    shortcodes are skipped, which allows to restart a generator where a
+    previous one left off.
     """
     if generator_type == "chain":
-        return chain_generator(generator_options)
+        generator = ChainGenerator(generator_options)
     elif generator_type == "sequence":
-        return sequence_generator(generator_options)
+        generator = SequenceGenerator(generator_options)
     elif generator_type == "list":
-        return generator_options["list"].__iter__()
+        return generator_options["list"][start:].__iter__()
     else:
         raise ValueError("Unknown generator %s" % generator_type)
 
+    generator.seek(start)
+    return generator
+
+def length(generator_type, generator_options):
+    """
+    Returns the number of shortcodes the generator yields
+    """
+    if generator_type == "list":
+        return len(generator_options["list"])
+    return len(factory(generator_type, generator_options))
+
+def split(generator_type, generator_options, count, stride=False):
+    """
+    Split the shortcodes of a generator into count disjoint shards
+
+    By default every shard is a contiguous range of positions, so shard i
+    starts where shard i - 1 ends. With stride, shard i gets positions i,
+    i + count, i + 2 * count and so on, which spreads codes that are close to
+    each other over all shards. Returns a list of count Shard instances, some
+    of which may be empty; together they cover every position exactly once.
+    """
+    if count < 1:
+        raise ValueError("Need at least one shard")
+    total = length(generator_type, generator_options)
+    shards = []
+    for i in range(count):
+        if stride:
+            shards.append(Shard(generator_type, generator_options, i, total, count))
+        else:
+            shards.append(Shard(generator_type, generator_options, total * i // count, total * (i + 1) // count))
+    return shards
+
+def merge(results):
+    """
+    Merge the results of several shards into the order of the generator
+
+    results is a list with one iterable per shard, each yielding (position,
+    item) tuples in ascending order of position, as done by iterating over
+    Shard.enumerate. Yields the items ordered by position, which is the
+    order a single consumer of the whole generator would have produced.
+    """
+    for position, item in heapq.merge(*results):
+        yield item
+
+class Shard(object):
+    """
+    Part of a generator: the shortcodes at positions start, start + step,
+    ... up to but not including stop
+
+    Shards only hold their parameters, so they can be pickled and sent to
+    other processes. Every iteration creates a new generator; for the chain
+    generator this recomputes the chain up to start, and with a step greater
+    than 1 the whole chain.
+    """
+
+    def __init__(self, generator_type, generator_options, start, stop, step=1):
+        self.generator_type = generator_type
+        self.generator_options = generator_options
+        self.start = start
+        self.stop = stop
+        self.step = step
+
+    def __len__(self):
+        return max(0, (self.stop - self.start + self.step - 1) // self.step)
+
+    def __iter__(self):
+        return self.codes()
+
+    def position(self, index):
+        """
+        Returns the position in the generator of the index-th code of the shard
+        """
+        return self.start + index * self.step
+
+    def codes(self, skip=0):
+        """
+        Returns an iterator over the codes of the shard, leaving out the
+        first skip codes
+        """
+        start = self.position(skip)
+        if start >= self.stop:
+            return iter(())
+        if self.generator_type == "list":
+            return iter(self.generator_options["list"][start:self.stop:self.step])
+        generator = factory(self.generator_type, self.generator_options, start)
+        return itertools.islice(generator, 0, self.stop - start, self.step)
+
+    def enumerate(self, skip=0):
+        """
+        Returns an iterator over (position, code) tuples, suitable for merge
+        """
+        return itertools.izip(itertools.count(self.position(skip), self.step), self.codes(skip))
+
 def chain_generator(options):
     """
     Chain generator - Pseudorandom shortcode generation
@@ -54,27 +154,94 @@ def chain_generator(options):
     length: Length for each generated shortcode
     seed: Random seed for shortcode generation
     """
-    if options["length"] > hashlib.md5().digest_size:
-        raise ValueError("Length must be shorter than digest size")
+    return ChainGenerator(options)
 
-    m = 256 - (256 % len(options["charset"]))
-    digest = options["seed"]
-    count = 0
+class ChainGenerator(object):
+    """
+    Table-driven implementation of the chain generator
 
-    while count < options["count"]:
-        md5 = hashlib.md5()
-        md5.update(digest)
-        digest = md5.digest()
+    Each digest byte is mapped to a charset character with a precomputed
+    256-entry translation table; bytes above the rejection threshold are
+    deleted by the same str.translate call, so no Python code runs per byte.
+    The chain state (last digest and number of codes generated) can be saved
+    with state() and restored later to continue mid-chain.
+    """
 
-        code = ""
-        for byte in map(ord, digest):
-            if byte > m:
-                continue
-            code += options["charset"][byte % len(options["charset"])]
-            if len(code) == options["length"]:
-                count += 1
-                yield code
-                break
+    def __init__(self, options):
+        if options["length"] > hashlib.md5().digest_size:
+            raise ValueError("Length must be shorter than digest size")
+
+        charset = options["charset"]
+        if isinstance(charset, unicode):
+            charset = charset.encode("ascii")
+        m = 256 - (256 % len(charset))
+        self._table = "".join(charset[byte % len(charset)] for byte in range(256))
+        self._rejected = "".join(chr(byte) for byte in range(256) if byte > m)
+
+        self._length = options["length"]
+        self._total = options["count"]
+        self._seed = options["seed"]
+        self.restore({"digest": None, "count": 0})
+
+    def __len__(self):
+        return self._total
+
+    def __iter__(self):
+        return self._codes
+
+    def next(self):
+        return self._codes.next()
+
+    def seek(self, position):
+        """
+        Continue the chain with the code at the given position
+
+        The chain has to be recomputed from the seed, which costs one MD5
+        calculation per skipped code. Iterators obtained before the call are
+        not affected.
+        """
+        self.restore({"digest": None, "count": 0})
+        next(itertools.islice(self._codes, position, position), None)
+
+    def batch(self, size):
+        """
+        Returns a list with the next size codes (or less at the end)
+        """
+        return list(itertools.islice(self._codes, size))
+
+    def state(self):
+        """
+        Returns the chain state after the last code handed out
+        """
+        if self._count == 0:
+            digest = None
+        else:
+            digest = self._digest.encode("hex")
+        return {"digest": digest, "count": self._count}
+
+    def restore(self, state):
+        """
+        Continue the chain from a state returned by state()
+        """
+        if state["digest"] is None:
+            self._digest = self._seed
+        else:
+            self._digest = state["digest"].decode("hex")
+        self._count = state["count"]
+        self._codes = self._generate()
+
+    def _generate(self):
+        md5 = hashlib.md5
+        table = self._table
+        rejected = self._rejected
+        length = self._length
+
+        while self._count < self._total:
+            self._digest = md5(self._digest).digest()
+            code = self._digest.translate(table, rejected)
+            if len(code) >= length:
+                self._count += 1
+                yield code[:length]
 
 def sequence_generator(options):
     """
@@ -91,16 +258,108 @@ def sequence_generator(options):
     start: Start sequence with this code
     stop: End sequence with this code
     """
-    code = options["start"]
-    yield code
-    while code != options["stop"]:
-        for i in range(len(code) - 1, -1, -1):
-            if code[i] == options["charset"][-1]:
-                code = code[0:i] + options["charset"][0] + code[i+1:len(code)]
-            else:
-                code = code[0:i] + options["charset"][options["charset"].index(code[i]) + 1] + code[i+1:len(code)]
+    return SequenceGenerator(options)
+
+class SequenceGenerator(object):
+    """
+    Seekable implementation of the sequence generator
+
+    Codes are mapped to integers: all codes of one length come before all
+    longer codes and codes of the same length are numbers in the base of the
+    charset. This allows to jump to any position of the sequence, to compute
+    its length and to split it into shards. Codes are emitted by appending
+    each character of the charset to a common prefix, so each code costs a
+    single string concatenation.
+    """
+
+    def __init__(self, options):
+        self._charset = options["charset"]
+        self._base = len(self._charset)
+        self._digits = dict((char, i) for i, char in enumerate(self._charset))
+        self._first = self.rank(options["start"])
+        self._last = self.rank(options["stop"])
+        self._codes = None
+        self.seek(0)
+
+    def __len__(self):
+        return max(0, self._last - self._first + 1)
+
+    def __iter__(self):
+        # Handing out the underlying generator saves a method call per code
+        return self._codes
+
+    def next(self):
+        return self._codes.next()
+
+    def seek(self, position):
+        """
+        Continue the sequence with the code at the given position
+
+        Iterators obtained before the call are not affected.
+        """
+        self._codes = self._generate(self._first + position)
+
+    def split(self, count):
+        """
+        Split the sequence into count shards of (almost) equal length
+
+        Returns a list of generator options, one for each non-empty shard, in
+        sequence order.
+        """
+        shards = []
+        length = len(self)
+        for i in range(count):
+            first = self._first + length * i // count
+            last = self._first + length * (i + 1) // count - 1
+            if first <= last:
+                shards.append({
+                    "charset": self._charset,
+                    "start": self.unrank(first),
+                    "stop": self.unrank(last),
+                })
+        return shards
+
+    def rank(self, code):
+        """
+        Returns the integer corresponding to the given code
+        """
+        value = 0
+        for char in code:
+            value = value * self._base + self._digits[char]
+        return self._offset(len(code)) + value
+
+    def unrank(self, rank):
+        """
+        Returns the code corresponding to the given integer
+        """
+        length = 0
+        while rank >= self._base ** length:
+            rank -= self._base ** length
+            length += 1
+
+        code = []
+        for i in range(length):
+            rank, digit = divmod(rank, self._base)
+            code.append(self._charset[digit])
+        return "".join(reversed(code))
+
+    def _offset(self, length):
+        """
+        Returns the number of codes shorter than length
+        """
+        return sum(self._base ** i for i in range(length))
+
+    def _generate(self, rank):
+        charset = self._charset
+        while rank <= self._last:
+            code = self.unrank(rank)
+            if not code:
                 yield code
-                break
-        else:
-            code = options["charset"][0] + code
-            yield code
+                rank += 1
+                continue
+            prefix = code[:-1]
+            digit = self._digits[code[-1]]
+            count = min(self._base - digit, self._last - rank + 1)
+            for char in charset[digit:digit + count]:
+                yield prefix + char
+            rank += count
@@ -0,0 +1,177 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.metrics - Process-wide counters and histograms
+
+Reapers and services record what they do with count and observe. snapshot
+returns the current values, which can be merged with the snapshots of other
+processes and rendered in the Prometheus text format. serve exposes them
+over HTTP.
+"""
+
+import BaseHTTPServer
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Upper bounds of the latency histogram buckets in seconds"""
+
+COUNTERS = {
+    "tinyback_requests_total": "Fetch attempts by service and outcome",
+    "tinyback_retries_total": "Fetch attempts that repeated an earlier attempt",
+    "tinyback_response_bytes_total": "Bytes of response bodies read",
+    "tinyback_rate_limit_sleep_seconds_total": "Seconds codes waited for the rate limit",
+    "tinyback_backoff_sleep_seconds_total": "Seconds codes waited after the service blocked us",
+    "tinyback_codes_total": "Codes examined",
+    "tinyback_urls_total": "URLs found",
+    "tinyback_tasks_total": "Tasks reaped",
+    "tinyback_store_hits_total": "Codes answered from the result store",
+    "tinyback_dead_code_skips_total": "Codes skipped because they were recently found dead",
+}
+"""Names and descriptions of the counters"""
+
+HISTOGRAMS = {
+    "tinyback_request_seconds": "Duration of fetch attempts in seconds",
+}
+"""Names and descriptions of the histograms, which use LATENCY_BUCKETS"""
+
+_counters = {}
+_histograms = {}
+_lock = threading.Lock()
+
+def count(name, labels, value=1):
+    """
+    Add value to the counter with the given labels dictionary
+    """
+    if name not in COUNTERS:
+        raise ValueError("Unknown counter %s" % name)
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, labels, value):
+    """
+    Record value in the histogram with the given labels dictionary
+    """
+    if name not in HISTOGRAMS:
+        raise ValueError("Unknown histogram %s" % name)
+    key = (name, tuple(sorted(labels.items())))
+    bucket = bisect.bisect_left(LATENCY_BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if not histogram:
+            histogram = _histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+        histogram[0][bucket] += 1
+        histogram[1] += value
+
+def snapshot():
+    """
+    Returns a picklable copy of all values
+    """
+    with _lock:
+        return (dict(_counters), dict((key, [list(buckets), total]) for key, (buckets, total) in _histograms.iteritems()))
+
+def merge(snapshots):
+    """
+    Returns the sum of the given snapshots
+    """
+    counters = {}
+    histograms = {}
+    for snapshot_counters, snapshot_histograms in snapshots:
+        for key, value in snapshot_counters.iteritems():
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, total) in snapshot_histograms.iteritems():
+            histogram = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+    return counters, histograms
+
+def render(snapshot):
+    """
+    Returns the snapshot in the Prometheus text exposition format
+    """
+    counters, histograms = snapshot
+    lines = []
+    for name in sorted(COUNTERS):
+        keys = sorted(key for key in counters if key[0] == name)
+        if not keys:
+            continue
+        lines.append("# HELP %s %s" % (name, COUNTERS[name]))
+        lines.append("# TYPE %s counter" % name)
+        for key in keys:
+            lines.append("%s%s %s" % (name, _format_labels(key[1]), _format_value(counters[key])))
+
+    for name in sorted(HISTOGRAMS):
+        keys = sorted(key for key in histograms if key[0] == name)
+        if not keys:
+            continue
+        lines.append("# HELP %s %s" % (name, HISTOGRAMS[name]))
+        lines.append("# TYPE %s histogram" % name)
+        for key in keys:
+            buckets, total = histograms[key]
+            cumulative = 0
+            for bound, value in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += value
+                labels = _format_labels(key[1] + (("le", str(bound)),))
+                lines.append("%s_bucket%s %i" % (name, labels, cumulative))
+            labels = _format_labels(key[1])
+            lines.append("%s_sum%s %s" % (name, labels, _format_value(total)))
+            lines.append("%s_count%s %i" % (name, labels, cumulative))
+    return "".join(line + "\n" for line in lines)
+
+def serve(address, source=snapshot):
+    """
+    Serve the metrics on /metrics at the (host, port) address
+
+    source is called for every request and returns the snapshot to render.
+    The server runs in a daemon thread; returns the server.
+    """
+    server = BaseHTTPServer.HTTPServer(address, _MetricsHandler)
+    server.source = source
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (name, _escape(value)) for name, value in labels)
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render(self.server.source())
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,333 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.mockserver - Local stand-in for the supported URL shorteners
+
+The mock server answers requests for every service in services._factory_map
+under /<service>/..., emulating the responses the service classes know how
+to parse: plain redirects, missing and blocked codes, Bitly bundles and
+warning pages, is.gd preview/disabled/rate limit pages, TinyURL errorhelp,
+preview and TinyURL-to-TinyURL pages, the goo.gl JSON API and the Yourls
+"simple" API. The outcome for a code is derived from its MD5 hash, so it is
+the same on every run. Latency, errors and a rate limit can be configured.
+
+Use mock_service to get a service instance that talks to the mock server.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+from tinyback import services
+
+PAGE_SIZE = 16 * 1024
+"""Bytes of markup following the interesting part of every HTML page"""
+
+_PAGE_PADDING = ("<p>" + "x" * 60 + "</p>\n") * (PAGE_SIZE // 68)
+
+def mock_service(name, address):
+    """
+    Returns an instance of the named service that uses the mock server at
+    the given (host, port) address instead of the real URL shortener
+    """
+    klass = services._factory_map[name]
+    url = urlparse.urlparse(klass.__new__(klass).url)
+    mock_url = "http://%s:%i/%s%s" % (address[0], address[1], name, url.path or "/")
+    if url.query:
+        mock_url += "?" + url.query
+    # Keep the class name, which services use as their metrics label
+    mock_klass = type(klass.__name__, (klass,), {"url": mock_url})
+    return mock_klass()
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server emulating the URL shorteners
+
+    latency: Seconds to wait before answering each request
+    error_rate: Fraction of requests answered with HTTP status 503
+    rate_limit: (requests, seconds) tuple per service or None; requests over
+        the limit get the "blocked" answer of the service
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0, error_rate=0, rate_limit=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockRequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def handle_error(self, request, client_address):
+        # Clients close the connection after reading just enough of a page
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def over_limit(self, service):
+        """
+        Counts a request for the service, returns True if it is over the limit
+        """
+        if not self.rate_limit:
+            return False
+        requests, period = self.rate_limit
+        now = time.time()
+        with self._lock:
+            start, count = self._windows.get(service, (now, 0))
+            if now - start >= period:
+                start, count = now, 0
+            self._windows[service] = (start, count + 1)
+        return count >= requests
+
+class MockRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Send each response in one segment, otherwise Nagle's algorithm and
+    # delayed ACKs add 40ms to every keep-alive request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_HEAD(self):
+        self._handle(False)
+
+    def do_GET(self):
+        self._handle(True)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, send_body):
+        route = _route(self.path)
+        if not route:
+            self._respond(404, None, {}, "")
+            return
+        service, url = route
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self._respond(503, None, {}, "Service Unavailable", send_body)
+            return
+
+        handler, blocked = _handlers[service]
+        if self.server.over_limit(service):
+            status, reason, headers, body = blocked(url.path)
+        else:
+            status, reason, headers, body = handler(url.path, url.query)
+        self._respond(status, reason, headers, body, send_body)
+
+    def _respond(self, status, reason, headers, body, send_body=True):
+        self.send_response(status, reason)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+def capture(method, path):
+    """
+    Returns the raw HTTP response the mock server sends for the request,
+    without latency, errors and rate limit
+
+    This allows benchmarking the parsing of responses without sockets.
+    """
+    route = _route(path)
+    if route:
+        service, url = route
+        status, reason, headers, body = _handlers[service][0](url.path, url.query)
+    else:
+        status, reason, headers, body = 404, None, {}, ""
+    if reason is None:
+        reason = MockRequestHandler.responses[status][0]
+
+    lines = ["HTTP/1.1 %i %s" % (status, reason)]
+    lines.extend("%s: %s" % item for item in headers.items())
+    lines.append("Content-Length: %i" % len(body))
+    if method == "HEAD":
+        body = ""
+    return "\r\n".join(lines) + "\r\n\r\n" + body
+
+def _route(path):
+    """
+    Returns the service and the parsed rest of the request path, or None
+    """
+    parts = path.split("/", 2)
+    if len(parts) < 3 or parts[1] not in _handlers:
+        return None
+    return parts[1], urlparse.urlparse(parts[2])
+
+def _outcome(code):
+    """
+    Returns a number in [0, 100) that decides what a code resolves to
+    """
+    return ord(hashlib.md5(code).digest()[0]) * 100 // 256
+
+def _long_url(code):
+    return "http://example.com/%s?q=%s&x=1" % (code, hashlib.md5(code).hexdigest()[:8])
+
+def _escaped_url(code):
+    return _long_url(code).replace("&", "&amp;")
+
+def _quoted_url(code):
+    return _long_url(code).replace("&", "%26")
+
+def _status(status, headers={}, reason=None):
+    return lambda code: (status, reason, headers, "")
+
+def _page(status, body):
+    return status, None, {"Content-Type": "text/html"}, body + _PAGE_PADDING
+
+def _simple(redirect=301, not_found=404, code_blocked=410, blocked=403, special=None):
+    """
+    Returns the (handler, blocked handler) pair for a SimpleService
+
+    70% of the codes redirect, 20% do not exist, 5% are blocked and 5% are
+    answered by the special handler. not_found, code_blocked and special are
+    either a status code or a function taking the code.
+    """
+    answers = []
+    for answer in (not_found, code_blocked or not_found, special or not_found):
+        if not callable(answer):
+            answer = _status(answer)
+        answers.append(answer)
+
+    def handler(code, query):
+        outcome = _outcome(code)
+        if outcome < 70:
+            return redirect, None, {"Location": _long_url(code)}, ""
+        elif outcome < 90:
+            return answers[0](code)
+        elif outcome < 95:
+            return answers[1](code)
+        return answers[2](code)
+
+    return handler, _status(blocked)
+
+def _owly_preview(code):
+    return _page(200, "<html><a class=\"btn ignore\" href=\"%s\" title=\"Ignore\">" % _escaped_url(code))
+
+def _snipurl_preview(code):
+    return _page(500, "<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>%s</div> <br />" % _escaped_url(code))
+
+def _visibli_frame(code):
+    return _page(200, "<html><iframe id=\"frame\" src=\"%s\"></iframe>" % _escaped_url(code))
+
+def _bitly(code, query):
+    outcome = _outcome(code)
+    if outcome < 65:
+        return 301, "Moved", {"Location": _long_url(code)}, ""
+    elif outcome < 70:
+        location = "http://bit.ly/a/warning?hash=%s&url=%s" % (code, _quoted_url(code))
+        return 302, None, {"Location": location}, ""
+    elif outcome < 90:
+        return 404, None, {}, ""
+    elif outcome < 95:
+        return 301, "Moved Permanently", {"Location": "http://bitly.com/bundles/o_1/1", "Connection": "close"}, ""
+    return 410, None, {}, ""
+
+def _isgd(code, query):
+    outcome = _outcome(code)
+    if outcome < 70:
+        return 301, None, {"Location": _long_url(code)}, ""
+    elif outcome < 90:
+        return 404, None, {}, ""
+    elif outcome < 93:
+        return 502, None, {}, ""
+    elif outcome < 97:
+        return _page(200, "<div id=\"disabled\"><h2>Link Disabled</h2><p>For reference and to help those fighting spam the original destination of this URL is given below (we strongly recommend you don't visit it since it may damage your PC): -<br />%s</p><h2>is.gd</h2><p>is.gd is a free service used to shorten long URLs." % _escaped_url(code))
+    return _page(200, "<p>The full original link is shown below. <b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"%s\" class=\"biglink\">" % _escaped_url(code))
+
+def _isgd_blocked(code):
+    return _page(200, "<div id=\"main\"><p>Rate limit exceeded - please wait 1 minute before accessing more shortened URLs</p></div>")
+
+def _tinyurl(code, query):
+    if code == "preview.php":
+        code = cgi.parse_qs(query)["num"][0]
+        return _page(200, "<a id=\"redirecturl\" href=\"%s\">Proceed to this site.</a>" % _escaped_url(code))
+
+    outcome = _outcome(code)
+    if outcome < 65:
+        return 301, None, {"Location": _long_url(code)}, ""
+    elif outcome < 70:
+        location = "http://redirect.tinyurl.com/api/click?out=%s" % _quoted_url(code)
+        return 301, None, {"Location": location, "X-tiny": "aff"}, ""
+    elif outcome < 90:
+        return 404, None, {}, ""
+    elif outcome < 93:
+        return 302, None, {"Location": "http://tinyurl.com/"}, ""
+    elif outcome < 97:
+        return _page(200, "<title>Redirecting...</title><meta http-equiv=\"refresh\" content=\"0;url=http://tinyurl.com/errorb.php?url=%s&path=/%s\">" % (_quoted_url(code), code))
+    return _page(200, "Error: TinyURL redirects to a TinyURL.<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site. The URL it redirects to is <a href=\"http://tinyurl.com/%s\">" % code)
+
+def _googl(path, query):
+    code = query.rsplit("/", 1)[-1]
+    outcome = _outcome(code)
+    data = {"kind": "urlshortener#url", "id": "http://goo.gl/" + code}
+    if outcome < 70:
+        data.update({"longUrl": _long_url(code), "status": "OK"})
+    elif outcome < 95:
+        data = {"error": {"code": 404, "message": "Not Found"}}
+        return 404, None, {"Content-Type": "application/json"}, json.dumps(data)
+    else:
+        data["status"] = "MALWARE"
+    return 200, None, {"Content-Type": "application/json"}, json.dumps(data)
+
+def _yourls(path, query):
+    code = cgi.parse_qs(query)["shorturl"][0]
+    if _outcome(code) < 70:
+        return 200, None, {}, _long_url(code)
+    return 200, None, {}, "not found"
+
+_handlers = {
+    "bitly": (_bitly, _status(403)),
+    "isgd": (_isgd, _isgd_blocked),
+    "tinyurl": (_tinyurl, _status(500)),
+    "googl": (_googl, _status(403)),
+    "vbly": (_yourls, _status(503)),
+    "arsehat": (_yourls, _status(503)),
+    "owly": _simple(special=_owly_preview),
+    "ur1ca": _simple(not_found=200, code_blocked=None),
+    "snipurl": _simple(not_found=410, code_blocked=None, special=_snipurl_preview),
+    "postly": _simple(not_found=302, code_blocked=None),
+    "wpme": _simple(),
+    "pixorial": _simple(),
+    "twitter": _simple(),
+    "trim": _simple(),
+    "trimnew": _simple(not_found=_status(301, {"Location": "http://tr.im/404"}), code_blocked=None, blocked=404),
+    "visibli": _simple(not_found=_status(302, {"Location": "http://sharedby.co/"}), special=_visibli_frame),
+    "visiblihex": _simple(not_found=_status(302, {"Location": "http://sharedby.co/"}), special=_visibli_frame),
+}
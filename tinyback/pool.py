@@ -0,0 +1,118 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.pool - Process-wide HTTP connection pools
+
+Services borrow httplib connections from a pool shared by all services and
+threads talking to the same (scheme, host, port), so keep-alive connections
+survive from one task to the next.
+"""
+
+import select
+import threading
+import time
+
+MAX_SIZE = 8
+"""Maximum number of idle connections kept per pool"""
+
+IDLE_TIMEOUT = 60
+"""Idle connections older than this many seconds are closed"""
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(scheme, host, port, factory):
+    """
+    Returns the pool for the given (scheme, host, port)
+
+    The pool is created on first use; factory is a callable without arguments
+    returning a new httplib connection.
+    """
+    key = (scheme, host, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if not pool:
+            pool = _pools[key] = ConnectionPool(factory, MAX_SIZE, IDLE_TIMEOUT)
+        return pool
+
+def clear():
+    """
+    Close all idle connections of all pools
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.clear()
+
+class ConnectionPool:
+    """
+    Thread-safe pool of idle keep-alive connections
+
+    Connections are handed out most recently used first. Before a connection
+    is handed out, it is checked for its idle time and whether the server has
+    closed it in the meantime.
+    """
+
+    def __init__(self, factory, max_size, idle_timeout):
+        self._factory = factory
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Borrow a connection, creating a new one if no idle one is usable
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if time.time() - last_used < self._idle_timeout and self._healthy(conn):
+                return conn
+            conn.close()
+        return self._factory()
+
+    def put(self, conn):
+        """
+        Return a connection that is ready to send the next request
+        """
+        with self._lock:
+            if len(self._idle) < self._max_size:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn, last_used in idle:
+            conn.close()
+
+    def _healthy(self, conn):
+        """
+        An idle connection is healthy if its socket is open and has nothing
+        to read: readable means either EOF or unsolicited data.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, ValueError):
+            return False
+        return not readable
@@ -0,0 +1,271 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.ratelimit - Rate limits shared by all Reapers of a service
+
+Every Reaper working on the same service consults the same token bucket, so
+the aggregate request rate of all threads stays within Service.rate_limit.
+If STATE_DIR is set, the bucket state is kept in a locked file in that
+directory and shared between processes as well.
+
+If RATE_FILE is set, the rate of every bucket is adapted with an AIMD
+controller and the learned rates are kept in that file across runs.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STATE_DIR = None
+"""Directory for bucket state shared between processes, or None"""
+
+RATE_FILE = None
+"""JSON file with learned rates for adaptive rate control, or None"""
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(name, rate_limit):
+    """
+    Returns the token bucket for the service with the given name
+
+    rate_limit is a Service.rate_limit tuple; it is only used when the bucket
+    is created.
+    """
+    with _buckets_lock:
+        bucket = _buckets.get(name)
+        if not bucket:
+            requests, period = rate_limit
+            controller = None
+            if RATE_FILE:
+                controller = AIMDController(name, float(requests) / period, RATE_FILE)
+            if STATE_DIR and fcntl:
+                path = os.path.join(STATE_DIR, name + ".bucket")
+                bucket = FileTokenBucket(path, requests, period, controller=controller)
+            else:
+                bucket = TokenBucket(requests, period, controller=controller)
+            _buckets[name] = bucket
+        return bucket
+
+class TokenBucket:
+    """
+    Thread-safe token bucket with continuous refill
+
+    Tokens are added at a rate of requests / period per second, up to burst
+    tokens. Requests are reserved in advance: reserve() always takes a token,
+    letting the bucket go negative, and returns how long the caller has to
+    wait before the token is actually available. This spaces requests evenly
+    instead of sending them in bursts.
+
+    If a controller is given, the rate is taken from and adjusted by it.
+    """
+
+    def __init__(self, requests, period, burst=1, controller=None):
+        self.rate = float(requests) / period
+        self.burst = burst
+        self._controller = controller
+        if controller:
+            self.rate = controller.rate
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take one token, returns the number of seconds to wait before using it
+        """
+        with self._lock:
+            return self._reserve()
+
+    def drain(self):
+        """
+        Drop all available tokens
+        """
+        with self._lock:
+            self._drain()
+
+    def success(self):
+        """
+        Called when the service answered a request normally
+        """
+        if not self._controller:
+            return
+        with self._lock:
+            if self._controller.success():
+                self._refill()
+                self.rate = self._controller.rate
+
+    def blocked(self):
+        """
+        Called when the service blocked us
+        """
+        if self._controller:
+            with self._lock:
+                self._controller.blocked()
+                self._refill()
+                self.rate = self._controller.rate
+        self.drain()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserve(self):
+        self._refill()
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+    def _drain(self):
+        self._refill()
+        self._tokens = min(self._tokens, 0)
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket whose state is shared between processes through a file
+
+    The file is locked with flock while the state is updated.
+    """
+
+    def __init__(self, path, requests, period, burst=1, controller=None):
+        TokenBucket.__init__(self, requests, period, burst, controller)
+        self._path = path
+
+    def reserve(self):
+        return self._with_state(self._reserve)
+
+    def drain(self):
+        self._with_state(self._drain)
+
+    def _with_state(self, func):
+        with self._lock:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.read(fd, 64)
+                try:
+                    self._tokens, self._updated = [float(value) for value in data.split()]
+                except ValueError:
+                    pass
+                result = func()
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, "%r %r" % (self._tokens, self._updated))
+                return result
+            finally:
+                os.close(fd)
+
+class AIMDController:
+    """
+    Additive-increase/multiplicative-decrease control of a request rate
+
+    Starts at the rate learned in a previous run or at the declared rate of the
+    service. After every INTERVAL seconds worth of requests without a block,
+    the rate is raised by INCREASE times the declared rate. When the service
+    blocks us, the rate is multiplied by DECREASE; further blocks within
+    HOLDOFF seconds are attributed to the same event, as concurrent requests
+    tend to get blocked together. The rate stays between
+    MIN_FACTOR and MAX_FACTOR times the declared rate. Rates are written to
+    the JSON file at path whenever they change.
+    """
+
+    INCREASE = 0.1
+    DECREASE = 0.5
+    INTERVAL = 30
+    HOLDOFF = 10
+    MIN_FACTOR = 0.05
+    MAX_FACTOR = 10
+
+    _file_lock = threading.Lock()
+
+    def __init__(self, name, declared_rate, path):
+        self._log = logging.getLogger("tinyback.AIMDController")
+        self._name = name
+        self._declared_rate = declared_rate
+        self._path = path
+        self._successes = 0
+        self._last_decrease = 0
+
+        self.rate = self._load().get(name, declared_rate)
+        self.rate = self._clamp(self.rate)
+        self._log.info("Starting %s at %f requests per second" % (name, self.rate))
+
+    def success(self):
+        """
+        Count a normal answer, returns True if the rate was raised
+        """
+        self._successes += 1
+        if self._successes < self.rate * self.INTERVAL:
+            return False
+        self._successes = 0
+
+        rate = self._clamp(self.rate + self.INCREASE * self._declared_rate)
+        if rate == self.rate:
+            return False
+        self.rate = rate
+        self._log.info("Raising rate for %s to %f requests per second" % (self._name, self.rate))
+        self._save()
+        return True
+
+    def blocked(self):
+        """
+        Back off after the service blocked us
+        """
+        self._successes = 0
+        if time.time() - self._last_decrease < self.HOLDOFF:
+            return
+        self._last_decrease = time.time()
+        self.rate = self._clamp(self.rate * self.DECREASE)
+        self._log.info("Lowering rate for %s to %f requests per second" % (self._name, self.rate))
+        self._save()
+
+    def _clamp(self, rate):
+        return max(self.MIN_FACTOR * self._declared_rate, min(self.MAX_FACTOR * self._declared_rate, rate))
+
+    def _load(self):
+        try:
+            f = open(self._path, "r")
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        except ValueError:
+            self._log.warn("Ignoring malformed rate file %s" % self._path)
+            return {}
+        finally:
+            f.close()
+
+    def _save(self):
+        with self._file_lock:
+            rates = self._load()
+            rates[self._name] = self.rate
+            temp_path = "%s.%i.tmp" % (self._path, os.getpid())
+            f = open(temp_path, "w")
+            try:
+                json.dump(rates, f)
+            finally:
+                f.close()
+            os.rename(temp_path, self._path)
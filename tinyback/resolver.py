@@ -0,0 +1,122 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.resolver - Process-wide DNS cache with address rotation
+
+Resolved addresses are cached for TTL seconds, as getaddrinfo does not tell
+the real TTL. New connections are spread over all A and AAAA records of a host
+in turn; an address that failed is skipped for FAILURE_TIMEOUT seconds unless
+all addresses of the host failed.
+"""
+
+import logging
+import socket
+import threading
+import time
+
+TTL = 300
+"""Seconds resolved addresses are kept"""
+
+FAILURE_TIMEOUT = 60
+"""Seconds an address is skipped after a connection to it failed"""
+
+_hosts = {}
+_lock = threading.Lock()
+_log = logging.getLogger("tinyback.resolver")
+
+def resolve(hostname, port):
+    """
+    Returns all IPv4 and IPv6 addresses of the host
+    """
+    return _get_host(hostname, port).addresses
+
+def next_address(hostname, port):
+    """
+    Returns the address to use for the next connection to the host
+    """
+    return _get_host(hostname, port).next()
+
+def failed(hostname, port, address):
+    """
+    Report that a connection to the address of the host failed
+    """
+    with _lock:
+        host = _hosts.get((hostname, port))
+    if host:
+        host.failed(address)
+
+def clear():
+    """
+    Forget all resolved addresses
+    """
+    with _lock:
+        _hosts.clear()
+
+def _get_host(hostname, port):
+    with _lock:
+        host = _hosts.get((hostname, port))
+        if host and time.time() - host.resolved < TTL:
+            return host
+
+    addresses = []
+    for addrinfo in socket.getaddrinfo(hostname, port, 0, socket.SOCK_STREAM):
+        if addrinfo[0] not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        address = addrinfo[4][0]
+        if isinstance(address, basestring) and address not in addresses:
+            addresses.append(address)
+    if not addresses:
+        raise ValueError("Unknown host %s" % hostname)
+    _log.debug("Resolved %s to %s" % (hostname, ", ".join(addresses)))
+
+    with _lock:
+        if host and host.addresses == addresses:
+            # Keep rotation and failures if nothing changed
+            host.resolved = time.time()
+        else:
+            host = _hosts[(hostname, port)] = _Host(addresses)
+        return host
+
+class _Host:
+    """
+    Addresses of a host together with the rotation and failure state
+    """
+
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.resolved = time.time()
+        self._next = 0
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            now = time.time()
+            for i in range(len(self.addresses)):
+                address = self.addresses[(self._next + i) % len(self.addresses)]
+                if now - self._failures.get(address, 0) >= FAILURE_TIMEOUT:
+                    self._next = (self._next + i + 1) % len(self.addresses)
+                    return address
+            # Everything failed recently, just keep rotating
+            address = self.addresses[self._next]
+            self._next = (self._next + 1) % len(self.addresses)
+            return address
+
+    def failed(self, address):
+        with self._lock:
+            if address in self.addresses:
+                self._failures[address] = time.time()
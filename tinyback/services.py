@@ -15,19 +15,27 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import HTMLParser
 import abc
 import httplib
 import json
 import platform
 import re
 import socket
-import urllib
+import ssl
+import sys
 import urlparse
-import socket
 
 import tinyback
-from tinyback import exceptions
+from tinyback import aio, exceptions, extract, metrics, pool, resolver
+
+READ_SIZE = 4096
+"""Bytes read at a time from response bodies that are searched for a pattern"""
+
+BODY_RATE_WEIGHT = 0.05
+"""Weight of the latest response in the learned share of codes needing a body"""
+
+DIRECT_GET_THRESHOLD = 0.1
+"""Share of codes needing a body above which HTTPService.fetch skips HEAD"""
 
 class Service:
     """
@@ -66,6 +74,22 @@ class Service:
         The long URL is usually a bytestring.
         """
 
+    def fetch_async(self, code, loop, callback):
+        """
+        Non-blocking variant of fetch
+
+        Looks up the given code using the aio.EventLoop loop and schedules
+        callback(result, exc_info) once done, where exc_info is None on success
+        and a sys.exc_info() tuple otherwise. The default implementation simply
+        calls fetch, which blocks the loop.
+        """
+        try:
+            result = self.fetch(code)
+        except Exception:
+            loop.call_soon(callback, None, sys.exc_info())
+        else:
+            loop.call_soon(callback, result, None)
+
 class HTTPService(Service):
     """
     Httplib-based URL shortener client
@@ -79,6 +103,13 @@ class HTTPService(Service):
         Returns the base URL of the URL shortener
         """
 
+    @property
+    def short_url(self):
+        """
+        Returns the base URL of the short URLs, which is followed by the code
+        """
+        return self.url
+
     @property
     def http_headers(self):
         """
@@ -94,64 +125,302 @@ class HTTPService(Service):
         """
         return True
 
+    @property
+    def http_body_statuses(self):
+        """
+        HTTP status codes on which fetch needs the response body
+        """
+        return []
+
+    @property
+    def http_body_patterns(self):
+        """
+        Compiled regular expressions that find the target in a response body
+
+        Reading the body stops as soon as one of them matches. If empty, the
+        whole body is read.
+        """
+        return []
+
+    @property
+    def http_fetch_strategy(self):
+        """
+        How _http_probe requests a code
+
+        "head" always sends HEAD and GET only if the body is needed, "get"
+        always sends GET. "auto" switches to GET while more than
+        DIRECT_GET_THRESHOLD of the recent codes needed a body.
+        """
+        return "auto"
+
     def __init__(self):
         parsed_url = urlparse.urlparse(self.url)
         self._path = parsed_url.path or "/"
+        if parsed_url.query:
+            self._path += "?" + parsed_url.query
+        self._scheme = parsed_url.scheme
 
         if parsed_url.scheme == "http":
             klass = httplib.HTTPConnection
+            default_port = httplib.HTTP_PORT
         elif parsed_url.scheme == "https":
             klass = httplib.HTTPSConnection
+            default_port = httplib.HTTPS_PORT
         else:
             raise ValueError("Unknown scheme %s" % parsed_url.scheme)
 
         pos = parsed_url.netloc.find(':');
         if pos != -1:
             self._hostname = parsed_url.netloc[0:pos]
-            self._port = parsed_url.netloc[pos+1:]
+            self._port = int(parsed_url.netloc[pos+1:])
         else:
             self._hostname = parsed_url.netloc
-            self._port = None
-        addr = [addrinfo for addrinfo in socket.getaddrinfo(self._hostname, self._port or 80)
-                if (addrinfo[0] == socket.AF_INET or addrinfo[0] == socket.AF_INET6) and
-                   isinstance(addrinfo[4][0], basestring)]
-        if not len(addr):
-            raise ValueError("Unknown host %s" % parsed_url.netloc)
-        self._host = addr[0][4][0]
-
-        version = platform.python_version_tuple()
-        if int(version[0]) == 2 and int(version[1]) <= 5:
-            self._conn = klass(self._host)
-        else:
-            self._conn = klass(self._host, timeout=30)
+            self._port = default_port
+        # Fail early for unknown hosts; the addresses are cached
+        resolver.resolve(self._hostname, self._port)
+
+        def connect():
+            # Every new connection goes to the next address of the host
+            address = resolver.next_address(self._hostname, self._port)
+            version = platform.python_version_tuple()
+            if int(version[0]) == 2 and int(version[1]) <= 5:
+                conn = klass(address, self._port)
+            elif parsed_url.scheme == "https":
+                conn = _HTTPSConnection(address, self._hostname, self._port, timeout=30)
+            else:
+                conn = klass(address, self._port, timeout=30)
+            conn.address = address
+            return conn
+        self._pool = pool.get_pool(self._scheme, self._hostname, self._port, connect)
+
+        self._replay = None
+        self._prefetched = None
+        self._body_rate = 0.0
+        self._body_needed = None
+        # Class names match the names in _factory_map
+        self._labels = {"service": self.__class__.__name__.lower()}
+
+    def fetch_async(self, code, loop, callback):
+        """
+        Non-blocking variant of fetch
+
+        Runs fetch against responses retrieved on the event loop. Whenever
+        fetch needs a response that has not been retrieved yet, the request is
+        issued on the loop and fetch is started over once the response is in.
+        This way the parsing logic of every service is reused unchanged.
+        """
+        responses = {}
+
+        def attempt():
+            try:
+                result = self._replay_fetch(code, responses)
+            except _PendingRequest, e:
+                try:
+                    address = resolver.next_address(self._hostname, self._port)
+                except (socket.error, ValueError), error:
+                    callback(None, (exceptions.ServiceException, exceptions.ServiceException("DNS error: %s" % error), None))
+                    return
+                aio.HTTPRequest(loop, (address, self._port), self._hostname,
+                    self._scheme, e.method, e.path, e.headers,
+                    lambda response, exc_info: received(address, e.method, e.path, response, exc_info))
+            except Exception:
+                callback(None, sys.exc_info())
+            else:
+                callback(result, None)
+
+        def received(address, method, path, response, exc_info):
+            if exc_info:
+                resolver.failed(self._hostname, self._port, address)
+                callback(None, exc_info)
+            else:
+                metrics.count("tinyback_response_bytes_total", self._labels, len(response[1]))
+                responses[(method, path)] = response
+                attempt()
+
+        attempt()
+
+    def _replay_fetch(self, code, responses):
+        """
+        Run fetch, answering requests from the responses dictionary
+
+        Responses are keyed by (method, path). Raises _PendingRequest for
+        the first request that has no response yet. fetch_async runs fetch
+        once per response, so the learned share of codes needing a body is
+        only updated by the run that does not raise _PendingRequest.
+        """
+        self._replay = responses
+        self._body_needed = None
+        pending = False
+        try:
+            return self.fetch(code)
+        except _PendingRequest:
+            pending = True
+            raise
+        finally:
+            self._replay = None
+            if not pending and self._body_needed is not None:
+                self._body_rate += BODY_RATE_WEIGHT * (self._body_needed - self._body_rate)
 
     def _http_head(self, code):
         return self._http_fetch(code, "HEAD")[0]
 
-    def _http_get(self, code):
-        return self._http_fetch(code, "GET")
+    def _http_get(self, code, until=None):
+        return self._http_fetch(code, "GET", until)
+
+    def _http_probe(self, code):
+        """
+        Request the code with HEAD or GET according to http_fetch_strategy
+
+        Returns the response. If GET was sent, the body is kept for the next
+        call of _http_body.
+        """
+        self._prefetched = None
+        body_statuses = self.http_body_statuses
+        strategy = self.http_fetch_strategy
+        if not body_statuses or strategy == "head":
+            get = False
+        elif strategy == "get":
+            get = True
+        elif self._replay is not None and ("GET", self._path + code) in self._replay:
+            # Stick to the decision made when the request was issued
+            get = True
+        elif self._replay is not None and ("HEAD", self._path + code) in self._replay:
+            get = False
+        else:
+            get = self._body_rate > DIRECT_GET_THRESHOLD
+
+        if get:
+            resp, data = self._http_get(code, self.http_body_patterns)
+            if self._replay is None:
+                self._prefetched = (code, resp, data)
+        else:
+            resp = self._http_head(code)
+
+        needed = 1.0 if resp.status in body_statuses else 0.0
+        if self._replay is None:
+            self._body_rate += BODY_RATE_WEIGHT * (needed - self._body_rate)
+        else:
+            self._body_needed = needed
+        return resp
+
+    def _http_body(self, code):
+        """
+        Returns the response and body of a GET for the code, reusing the one
+        sent by _http_probe if there was one
+        """
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched and prefetched[0] == code:
+            return prefetched[1:]
+        return self._http_get(code, self.http_body_patterns)
+
+    def _http_fetch(self, code, method, until=None):
+        """
+        Send a request for the code, returns the response and its body
 
-    def _http_fetch(self, code, method):
+        If until is a list of compiled regular expressions, reading the body
+        stops as soon as one of them matches.
+        """
         headers = self.http_headers
         if self.http_keepalive:
             headers["Connection"] = "Keep-Alive"
         else:
             headers["Connection"] = "close"
         headers["Host"] = self._hostname
+        path = self._path + code
 
-        try:
-            self._conn.request(method, self._path + code, headers=headers)
-            resp = self._conn.getresponse()
-            result = (resp, resp.read())
-            if not self.http_keepalive:
-                self._conn.close()
-            return result
-        except httplib.HTTPException, e:
-            self._conn.close()
-            raise exceptions.ServiceException("HTTP exception: %s" % e)
-        except socket.error, e:
-            self._conn.close()
-            raise exceptions.ServiceException("Socket error: %s" % e)
+        if self._replay is not None:
+            if (method, path) not in self._replay:
+                raise _PendingRequest(method, path, headers)
+            return self._replay[(method, path)]
+        return self._http_request(method, path, headers, until)
+
+    def _http_request(self, method, path, headers, until=None):
+        """
+        Send the request over a pooled connection, returns the response and
+        its body
+        """
+        # On a socket error, try once more with a connection to the next
+        # address of the host
+        for attempt in range(2):
+            try:
+                failover = not attempt and len(resolver.resolve(self._hostname, self._port)) > 1
+                conn = self._pool.get()
+            except (socket.error, ValueError), e:
+                raise exceptions.ServiceException("DNS error: %s" % e)
+            fresh = conn.sock is None
+            try:
+                conn.request(method, path, headers=headers)
+                resp = conn.getresponse()
+                result = (resp, self._http_read(resp, until))
+            except httplib.HTTPException, e:
+                conn.close()
+                raise exceptions.ServiceException("HTTP exception: %s" % e)
+            except socket.error, e:
+                conn.close()
+                if fresh:
+                    resolver.failed(self._hostname, self._port, getattr(conn, "address", None))
+                if not failover:
+                    raise exceptions.ServiceException("Socket error: %s" % e)
+            else:
+                break
+
+        metrics.count("tinyback_response_bytes_total", self._labels, len(result[1]))
+        if self.http_keepalive and resp.isclosed() and self._http_reusable(resp):
+            self._pool.put(conn)
+        else:
+            conn.close()
+        return result
+
+    def _http_read(self, resp, until):
+        """
+        Read the body of the response, stopping early once a pattern matches
+        """
+        if not until:
+            return resp.read()
+        data = ""
+        while True:
+            chunk = resp.read(READ_SIZE)
+            if not chunk:
+                return data
+            # Patterns may span chunks, so search everything read so far
+            data += chunk
+            for pattern in until:
+                if pattern.search(data):
+                    return data
+
+    def _http_reusable(self, resp):
+        """
+        Whether the connection may go back to the pool after the response
+        """
+        return not resp.will_close
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """
+    HTTPS connection to the given address, verified against the hostname
+    """
+
+    def __init__(self, address, hostname, port, timeout):
+        httplib.HTTPSConnection.__init__(self, hostname, port, timeout=timeout)
+        self._address = address
+
+    def connect(self):
+        sock = socket.create_connection((self._address, self.port), self.timeout)
+        if getattr(self, "_context", None):
+            self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+        else:
+            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+
+class _PendingRequest(Exception):
+    """
+    Raised by HTTPService._http_fetch during fetch_async or while recording
+    a cassette when a response has not been retrieved yet.
+    """
+
+    def __init__(self, method, path, headers):
+        Exception.__init__(self, method, path)
+        self.method = method
+        self.path = path
+        self.headers = headers
 
 class SimpleService(HTTPService):
     """
@@ -190,7 +459,7 @@ class SimpleService(HTTPService):
         return [403, 420, 429]
 
     def fetch(self, code):
-        resp = self._http_head(code)
+        resp = self._http_probe(code)
 
         if resp.status in self.http_status_redirect:
             location = resp.getheader("Location")
@@ -209,7 +478,7 @@ class SimpleService(HTTPService):
     def unexpected_http_status(self, code, resp):
         raise exceptions.ServiceException("Unexpected HTTP status %i" % resp.status)
 
-class YourlsService(Service):
+class YourlsService(HTTPService):
     """
     A service for installations of Yourls (http://yourls.org).
     """
@@ -239,35 +508,17 @@ class YourlsService(Service):
             return "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
         raise RuntimeError("Bad value for yourls_url_convert parameter")
 
-    def __init__(self):
-        parsed_url = urlparse.urlparse(self.yourls_api_url)
-        self._path = parsed_url.path or "/"
-
-        if parsed_url.scheme == "http":
-            klass = httplib.HTTPConnection
-        elif parsed_url.scheme == "https":
-            klass = httplib.HTTPSConnection
-        else:
-            raise ValueError("Unknown scheme %s" % parsed_url.scheme)
+    @property
+    def url(self):
+        # The code is appended to the URL, so shorturl has to come last
+        return self.yourls_api_url + "?action=expand&format=simple&shorturl="
 
-        version = platform.python_version_tuple()
-        if int(version[0]) == 2 and int(version[1]) <= 5:
-            self._conn = klass(parsed_url.netloc)
-        else:
-            self._conn = klass(parsed_url.netloc, timeout=30)
+    @property
+    def short_url(self):
+        return urlparse.urljoin(self.yourls_api_url, "/")
 
     def fetch(self, code):
-        params = {"action": "expand", "shorturl": code, "format": "simple"}
-        try:
-            self._conn.request("GET", self._path + "?" + urllib.urlencode(params))
-            resp = self._conn.getresponse()
-            data = resp.read()
-        except httplib.HTTPException, e:
-            self._conn.close()
-            raise exceptions.ServiceException("HTTP exception: %s" % e)
-        except socket.error, e:
-            self._conn.close()
-            raise exceptions.ServiceException("Socket error: %s" % e)
+        resp, data = self._http_get(code)
 
         if resp.status == 200:
             if data == "not found":
@@ -298,9 +549,7 @@ class Bitly(HTTPService):
             if resp.reason == "Moved":  # Normal bit.ly redirect
                 return location
             elif resp.reason == "Moved Permanently":
-                # Weird "bundles" redirect, forces connection close despite
-                # sending Keep-Alive header
-                self._conn.close()
+                # Weird "bundles" redirect, see _http_reusable
                 raise exceptions.CodeBlockedException()
             else:
                 raise exceptions.ServiceException("Unknown HTTP reason %s after HTTP status 301" % resp.reason)
@@ -318,6 +567,13 @@ class Bitly(HTTPService):
         else:
             raise exceptions.ServiceException("Unknown HTTP status %i" % resp.status)
 
+    def _http_reusable(self, resp):
+        # Weird "bundles" redirect, forces connection close despite sending
+        # Keep-Alive header
+        if resp.status == 301 and resp.reason == "Moved Permanently":
+            return False
+        return super(Bitly, self)._http_reusable(resp)
+
     def _parse_warning_url(self, code, url):
         url = urlparse.urlparse(url)
         if url.scheme != "http" or url.netloc != "bit.ly" or url.path != "/a/warning":
@@ -334,6 +590,10 @@ class Isgd(SimpleService):
     http://is.gd/
     """
 
+    _RATE_LIMIT_RE = re.compile(re.escape("<div id=\"main\"><p>Rate limit exceeded - please wait 1 minute before accessing more shortened URLs</p></div>"))
+    _BLOCKED_RE = re.compile("<p>For reference and to help those fighting spam the original destination of this URL is given below \(we strongly recommend you don't visit it since it may damage your PC\): -<br />(.*)</p><h2>is\.gd</h2><p>is\.gd is a free service used to shorten long URLs\.")
+    _PREVIEW_RE = re.compile("<b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"(.*)\" class=\"biglink\">")
+
     @property
     def charset(self):
         return "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_"
@@ -353,11 +613,19 @@ class Isgd(SimpleService):
         """
         return [502]
 
+    @property
+    def http_body_statuses(self):
+        return [200]
+
+    @property
+    def http_body_patterns(self):
+        return [self._RATE_LIMIT_RE, self._BLOCKED_RE, self._PREVIEW_RE]
+
     def unexpected_http_status(self, code, resp):
         if resp.status != 200:
             return super(Isgd, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_body(code)
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
 
@@ -371,23 +639,19 @@ class Isgd(SimpleService):
             return self._parse_preview(code, data)
 
     def _parse_blocked(self, code, data):
-        match = re.search("<p>For reference and to help those fighting spam the original destination of this URL is given below \(we strongly recommend you don't visit it since it may damage your PC\): -<br />(.*)</p><h2>is\.gd</h2><p>is\.gd is a free service used to shorten long URLs\.", data)
-        if not match:
+        url = extract.search(self._BLOCKED_RE, data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL in 'Link Disabled' page")
 
-        url = match.group(1).decode("utf-8")
-        url = HTMLParser.HTMLParser().unescape(url).encode("utf-8")
         if url == "":
             raise exceptions.CodeBlockedException("Empty URL on preview")
         return url
 
     def _parse_preview(self, code, data):
-        match = re.search("<b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"(.*)\" class=\"biglink\">", data)
-        if not match:
+        url = extract.search(self._PREVIEW_RE, data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL in 'Preview' page")
-
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
 
 class Owly(SimpleService):
@@ -395,6 +659,8 @@ class Owly(SimpleService):
     http://ow.ly/
     """
 
+    _WARNING_RE = re.compile("<a class=\"btn ignore\" href=\"(.*?)\" title=")
+
     @property
     def charset(self):
         return "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -403,20 +669,26 @@ class Owly(SimpleService):
     def url(self):
         return "http://ow.ly/"
 
+    @property
+    def http_body_statuses(self):
+        return [200]
+
+    @property
+    def http_body_patterns(self):
+        return [self._WARNING_RE]
+
     def unexpected_http_status(self, code, resp):
         if resp.status != 200:
             return super(Owly, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_body(code)
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
 
-        match = re.search("<a class=\"btn ignore\" href=\"(.*?)\" title=", data)
-        if not match:
+        url = extract.search(self._WARNING_RE, data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL in safety warning")
-
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
 
 class Tinyurl(HTTPService):
@@ -424,6 +696,10 @@ class Tinyurl(HTTPService):
     http://tinyurl.com/
     """
 
+    _ERRORHELP_RE = re.compile('<meta http-equiv="refresh" content="0;url=(.*?)">')
+    _TINYURL_REDIRECT_RE = re.compile("<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site\\. The URL it redirects to is <a href=\"(.*?)\">", re.DOTALL)
+    _PREVIEW_RE = re.compile("<a id=\"redirecturl\" href=\"(.*?)\">Proceed to this site.</a>", re.DOTALL)
+
     @property
     def charset(self):
         return "0123456789abcdefghijklmnopqrstuvwxyz"
@@ -432,8 +708,16 @@ class Tinyurl(HTTPService):
     def url(self):
         return "http://tinyurl.com/"
 
+    @property
+    def http_body_statuses(self):
+        return [200]
+
+    @property
+    def http_body_patterns(self):
+        return [self._ERRORHELP_RE, self._TINYURL_REDIRECT_RE]
+
     def fetch(self, code):
-        resp = self._http_head(code)
+        resp = self._http_probe(code)
 
         if resp.status == 200:
             return self._fetch_200(code)
@@ -450,16 +734,22 @@ class Tinyurl(HTTPService):
         elif resp.status == 404:
             raise exceptions.NoRedirectException()
         elif resp.status == 500:
-            # Some "errorhelp" URLs result in HTTP status 500, which goes away when trying a different server
-            self._conn.close()
+            # Connection was dropped, see _http_reusable
             raise exceptions.ServiceException("HTTP status 500")
         else:
             raise exceptions.ServiceException("Unknown HTTP status %i" % resp.status)
 
         return resp.status
 
+    def _http_reusable(self, resp):
+        # Some "errorhelp" URLs result in HTTP status 500, which goes away when
+        # trying a different server
+        if resp.status == 500:
+            return False
+        return super(Tinyurl, self)._http_reusable(resp)
+
     def _fetch_200(self, code):
-        resp, data = self._http_get(code)
+        resp, data = self._http_body(code)
 
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
@@ -472,7 +762,7 @@ class Tinyurl(HTTPService):
             raise exceptions.ServiceException("Unexpected response on status 200")
 
     def _parse_errorhelp(self, code, data):
-        match = re.search('<meta http-equiv="refresh" content="0;url=(.*?)">', data)
+        match = self._ERRORHELP_RE.search(data)
         if not match:
             raise exceptions.ServiceException("No redirect on \"errorhelp\" page on HTTP status 200")
         url = urlparse.urlparse(match.group(1))
@@ -487,27 +777,24 @@ class Tinyurl(HTTPService):
         return query["url"][0]
 
     def _parse_tinyurl_redirect(self, data):
-        match = re.search("<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site\\. The URL it redirects to is <a href=\"(.*?)\">", data, re.DOTALL)
-        if not match:
+        url = extract.search(self._TINYURL_REDIRECT_RE, data)
+        if url is None:
             raise exceptions.ServiceException("No redirect on \"tinyurl redirect\" page on HTTP status 200")
-
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
     def _preview(self, code, affiliate_url):
-        resp, data = self._http_get("preview.php?num=" + code)
+        resp, data = self._http_get("preview.php?num=" + code, [self._PREVIEW_RE])
 
         if resp.status != 200:
             raise exceptions.ServiceException("Unexpected HTTP status %i on preview page" % resp.status)
 
-        match = re.search("<a id=\"redirecturl\" href=\"(.*?)\">Proceed to this site.</a>", data, re.DOTALL)
-        if not match:
+        url = extract.search(self._PREVIEW_RE, data)
+        if url is None:
             raise exceptions.ServiceException("No redirect on preview page")
 
-        url = match.group(1).decode("utf-8")
         if url == "":
             return self._scrub_url(code, affiliate_url)
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
     def _scrub_url(self, code, url):
         parsed_url = urlparse.urlparse(url)
@@ -544,6 +831,8 @@ class Snipurl(SimpleService):
     http://snipurl.com
     """
 
+    _PREVIEW_RE = re.compile("<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>(.*?)</div> <br />")
+
     @property
     def charset(self):
         return "0123456789abcdefghijklmnopqrstuvwxyz-_~"
@@ -560,6 +849,14 @@ class Snipurl(SimpleService):
     def http_keepalive(self):
         return False
 
+    @property
+    def http_body_statuses(self):
+        return [500]
+
+    @property
+    def http_body_patterns(self):
+        return [self._PREVIEW_RE]
+
     def fetch(self, code):
         location = super(Snipurl, self).fetch(code)
         try:
@@ -573,18 +870,16 @@ class Snipurl(SimpleService):
         if resp.status != 500:
             return super(Snipurl, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_body(code)
         if resp.status != 500:
             raise exceptions.ServiceException("HTTP status changed from 500 to %i on second request" % resp.status)
 
-        match = re.search("<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>(.*?)</div> <br />", data)
-        if not match:
+        url = extract.search(self._PREVIEW_RE, data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL on preview page")
+        return url
 
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
-
-class Googl(Service):
+class Googl(HTTPService):
     """
     http://goo.gl/
     """
@@ -597,26 +892,16 @@ class Googl(Service):
     def charset(self):
         return "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
-    def __init__(self):
-        host = "www.googleapis.com"
+    @property
+    def url(self):
+        return "https://www.googleapis.com/urlshortener/v1/url?shortUrl=http://goo.gl/"
 
-        version = platform.python_version_tuple()
-        if int(version[0]) == 2 and int(version[1]) <= 5:
-            self._conn = httplib.HTTPSConnection(host)
-        else:
-            self._conn = httplib.HTTPSConnection(host, timeout=30)
+    @property
+    def short_url(self):
+        return "http://goo.gl/"
 
     def fetch(self, code):
-        try:
-            self._conn.request("GET", "/urlshortener/v1/url?shortUrl=http://goo.gl/%s" % code)
-            resp = self._conn.getresponse()
-            data = resp.read()
-        except httplib.HTTPException, e:
-            self._conn.close()
-            raise exceptions.ServiceException("HTTP exception: %s" % e)
-        except socket.error, e:
-            self._conn.close()
-            raise exceptions.ServiceException("Socket error: %s" % e)
+        resp, data = self._http_get(code)
 
         if resp.status == 200:
             return self._parse_json(data)
@@ -714,6 +999,10 @@ class Wpme(SimpleService):
 
 
 class BaseVisibliService(SimpleService):
+
+    _IFRAME_RE = re.compile(r'<iframe id="[^"]+" src="([^"]+)">')
+    _USER_AGENT_RE = re.compile("Undefined index:  HTTP_USER_AGENT")
+
     @property
     def http_status_redirect(self):
         return [301]
@@ -731,6 +1020,14 @@ class BaseVisibliService(SimpleService):
         return {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.8.3) "
             "Gecko/20120431 Firefox/18.0"}
 
+    @property
+    def http_body_statuses(self):
+        return [200]
+
+    @property
+    def http_body_patterns(self):
+        return [self._IFRAME_RE, self._USER_AGENT_RE]
+
     def unexpected_http_status(self, code, resp):
         if resp.status == 302:
             location = resp.getheader("Location")
@@ -746,19 +1043,16 @@ class BaseVisibliService(SimpleService):
         if resp.status != 200:
             return super(BaseVisbliService, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_body(code)
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
 
-        match = re.search(r'<iframe id="[^"]+" src="([^"]+)">', data)
-        if not match:
-            if 'Undefined index:  HTTP_USER_AGENT' in data:
+        url = extract.search(self._IFRAME_RE, data)
+        if url is None:
+            if self._USER_AGENT_RE.search(data):
                 raise exceptions.ServiceException("Website broken about user-agent")
 
             raise exceptions.ServiceException("No iframe url found")
-
-        url = match.group(1).decode("utf-8")
-        url = HTMLParser.HTMLParser().unescape(url).encode("utf-8")
         return url
 
 
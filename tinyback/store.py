@@ -0,0 +1,221 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012-2013 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.store - Local database of resolved codes
+
+A ResultStore keeps every code a Reaper resolved, keyed by service and code,
+in an SQLite database. Codes that do not exist are kept with a NULL URL;
+codes that could not be fetched are not kept at all. A Reaper with a store
+skips codes that are already in it, so reaping a task again only fetches
+what is missing, and export recreates the upload of a task from the store
+alone.
+
+The store also remembers tasks whose upload failed, so they can be submitted
+again later. A task is handed out again RETRY_DELAY seconds after its first
+failed upload, with the delay doubling after every further failure, and is
+dropped after MAX_ATTEMPTS failed uploads.
+"""
+
+import gzip
+import json
+import logging
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from tinyback import generators
+
+BATCH_SIZE = 1000
+"""Number of results collected in memory before they are written"""
+
+TIMEOUT = 60
+"""Seconds to wait for another process holding a lock on the database"""
+
+MAX_ATTEMPTS = 5
+"""Number of failed uploads after which a task is dropped"""
+
+RETRY_DELAY = 600
+"""Seconds before a task is handed out again after its first failed upload"""
+
+MAX_RETRY_DELAY = 6 * 3600
+"""Upper bound for the delay before a failed task is handed out again"""
+
+class ResultStore:
+    """
+    SQLite database of resolved codes
+
+    Results are buffered and written in batches of BATCH_SIZE; commit writes
+    the buffer out. Lookups see buffered results as well. A store may be used
+    by several threads and, through the same file, by several processes.
+    """
+
+    def __init__(self, path):
+        if not sqlite3:
+            raise RuntimeError("The sqlite3 module is not available")
+        self._log = logging.getLogger("tinyback.ResultStore")
+        self._path = path
+        self._lock = threading.Lock()
+        self._pending = {}
+        # Failed uploads of the tasks claimed by this process
+        self._claimed = {}
+
+        self._db = sqlite3.connect(path, timeout=TIMEOUT, check_same_thread=False)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (service TEXT NOT NULL, "
+                "code TEXT NOT NULL, url TEXT, fetched REAL NOT NULL, PRIMARY KEY (service, code))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS failed_tasks (id TEXT PRIMARY KEY, "
+                "task TEXT NOT NULL, failed REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "not_before REAL NOT NULL DEFAULT 0)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(failed_tasks)")]
+            if "attempts" not in columns:
+                # Databases created by earlier versions
+                self._db.execute("ALTER TABLE failed_tasks ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+                self._db.execute("ALTER TABLE failed_tasks ADD COLUMN not_before REAL NOT NULL DEFAULT 0")
+
+    def put(self, service, code, url):
+        """
+        Record the long URL of a code, or None if the code does not exist
+        """
+        with self._lock:
+            self._pending[(service, code)] = (url, time.time())
+            if len(self._pending) >= BATCH_SIZE:
+                self._flush()
+
+    def lookup(self, service, code, max_age=None):
+        """
+        Returns (True, url) if the code is in the store, (False, None)
+        otherwise; url is None for codes that do not exist
+
+        If max_age is given, codes that did not exist more than max_age
+        seconds ago count as not in the store, so they are fetched again.
+        """
+        with self._lock:
+            row = self._pending.get((service, code))
+            if not row:
+                row = self._db.execute("SELECT url, fetched FROM results WHERE service = ? AND code = ?",
+                    (service, code)).fetchone()
+        if row is None:
+            return False, None
+        url, fetched = row
+        if url is None and max_age is not None and fetched < time.time() - max_age:
+            return False, None
+        return True, url
+
+    def scan(self, service, start=None, stop=None):
+        """
+        Returns (code, url) for all codes of the service from start to stop
+        inclusive, in byte order of the codes
+        """
+        query = "SELECT code, url FROM results WHERE service = ?"
+        params = [service]
+        if start is not None:
+            query += " AND code >= ?"
+            params.append(start)
+        if stop is not None:
+            query += " AND code <= ?"
+            params.append(stop)
+        query += " ORDER BY code"
+        with self._lock:
+            self._flush()
+            return self._db.execute(query, params).fetchall()
+
+    def export(self, task, fileobj):
+        """
+        Write the results of the task to fileobj in the gzipped format of the
+        Reaper
+
+        Returns the number of codes of the task that are not in the store.
+        The output is only complete if that number is 0.
+        """
+        missing = 0
+        gzip_fileobj = gzip.GzipFile(mode="wb", fileobj=fileobj)
+        for code in generators.factory(task["generator_type"], task["generator_options"]):
+            known, url = self.lookup(task["service"], code)
+            if not known:
+                missing += 1
+            elif url is not None:
+                gzip_fileobj.write("%s|%s\n" % (code, url))
+        gzip_fileobj.close()
+        return missing
+
+    def save_failed_task(self, task, failed=True):
+        """
+        Remember a task whose results could not be uploaded
+
+        Returns False if the task was dropped after MAX_ATTEMPTS failed
+        uploads. If failed is False, a claimed task that was not run is only
+        put back, without counting an attempt.
+        """
+        with self._lock:
+            attempts = self._claimed.pop(task["id"], 0)
+            now = time.time()
+            not_before = now
+            if failed:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    self._log.error("Dropping task %s after %i failed uploads" % (task["id"], attempts))
+                    return False
+                not_before += min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (attempts - 1))
+            self._flush()
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO failed_tasks (id, task, failed, attempts, not_before) "
+                    "VALUES (?, ?, ?, ?, ?)", (task["id"], json.dumps(task), now, attempts, not_before))
+            return True
+
+    def claim_failed_task(self):
+        """
+        Returns the oldest task whose upload failed and is due again, and
+        forgets it, or None
+
+        Every failed task is handed out once, even to several processes.
+        """
+        with self._lock:
+            while True:
+                with self._db:
+                    row = self._db.execute("SELECT id, task, attempts FROM failed_tasks WHERE not_before <= ? "
+                        "ORDER BY failed LIMIT 1", (time.time(),)).fetchone()
+                    if row is None:
+                        return None
+                    # Whoever deletes the row owns the task
+                    if self._db.execute("DELETE FROM failed_tasks WHERE id = ?", (row[0],)).rowcount:
+                        self._claimed[row[0]] = row[2]
+                        return json.loads(row[1])
+
+    def commit(self):
+        """
+        Write all buffered results to the database
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        rows = [(service, code, url, fetched) for (service, code), (url, fetched) in self._pending.iteritems()]
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO results (service, code, url, fetched) VALUES (?, ?, ?, ?)", rows)
+        self._log.debug("Stored %i results" % len(rows))
+        self._pending = {}
@@ -1,24 +1,79 @@
 import httplib
 import json
 import logging
+import random
+import socket
+import tempfile
+import threading
+import time
 import urllib
 import urlparse
 
 import tinyback
+from tinyback import pool
+
+TIMEOUT = 60
+"""Socket timeout for tracker requests in seconds"""
+
+RETRIES = 6
+"""Number of attempts for idempotent tracker requests"""
+
+RETRY_DELAY = 2
+"""Base of the exponential backoff between attempts in seconds"""
+
+MAX_RETRY_DELAY = 300
+"""Upper bound for the backoff between attempts in seconds"""
+
+CHUNK_SIZE = 256 * 1024
+"""Bytes sent per request by a streaming upload"""
+
+MAX_BUFFER = 4 * 1024 * 1024
+"""Unacknowledged bytes a streaming upload keeps before writes block"""
+
+RESUME_DELAY = 30
+"""Seconds a streaming upload waits before resuming after a failure"""
+
+MAX_RESUMES = 5
+"""Consecutive failures after which a streaming upload gives up"""
+
+class StreamingUnsupported(Exception):
+    """
+    The tracker does not support streaming uploads
+    """
 
 class Tracker:
+    """
+    Tracker client
 
-    def __init__(self, tracker_url):
+    Connections are kept alive in a pool shared by all threads. Idempotent
+    calls (clear, put) are retried after network errors and server errors,
+    with a random delay of up to RETRY_DELAY * 2 ** attempt seconds in
+    between. fetch hands out a new task every time and is only retried when a
+    kept-alive connection turns out to be closed by the tracker.
+    """
+
+    def __init__(self, tracker_url, timeout=TIMEOUT, retries=RETRIES):
         self._log = logging.getLogger("tinyback.Tracker")
         self._log.info("Initializing tracker at %s" % tracker_url)
 
         if tracker_url[-1] != "/":
             tracker_url += "/"
         self._url = urlparse.urlparse(tracker_url)
+        self._timeout = timeout
+        self._retries = max(1, retries)
+        self._batch_supported = True
+
+        if self._url.scheme == "https":
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        def connect():
+            return connection_class(self._url.netloc, timeout=self._timeout)
+        self._pool = pool.get_pool(self._url.scheme, self._url.hostname, self._url.port, connect)
 
     def clear(self):
         self._log.info("Clearing all tasks")
-        status, data = self._request("GET", "task/clear")
+        status, data = self._request("GET", "task/clear", idempotent=True)
         if status != httplib.OK:
             raise Exception("Unexpected status %i" % status)
 
@@ -33,15 +88,61 @@ class Tracker:
             self._log.info("No tasks available")
         return task
 
+    def fetch_batch(self, count):
+        """
+        Lease up to count tasks
+
+        Returns a list of (task, lease) tuples, where lease is the number of
+        seconds the tracker reserves the task for us, or None if it does not
+        expire. Falls back to fetch if the tracker does not support batches.
+        """
+        if count > 1 and self._batch_supported:
+            status, data = self._request("GET", "task/get_batch", {"count": count})
+            if status == httplib.NOT_FOUND:
+                self._log.warn("Tracker does not support batches, fetching single tasks")
+                self._batch_supported = False
+            elif status != httplib.OK:
+                raise Exception("Unexpected status %i" % status)
+            else:
+                data = json.loads(data)
+                lease = data.get("lease")
+                self._log.info("Received %i tasks" % len(data["tasks"]))
+                return [(task, lease) for task in data["tasks"]]
+
+        task = self.fetch()
+        if task:
+            return [(task, None)]
+        return []
+
+    def renew(self, task):
+        """
+        Extend the lease of a task, returns the new lease in seconds
+        """
+        status, data = self._request("GET", "task/renew", {"id": task["id"]}, idempotent=True)
+        if status == httplib.CONFLICT:
+            raise Exception("Lease of task %s was lost" % task["id"])
+        elif status != httplib.OK:
+            raise Exception("Unexpected status %i" % status)
+        return json.loads(data)["lease"]
+
+    def upload(self, task, username=None, temp_dir=None):
+        """
+        Returns an Upload streaming the results of the task to the tracker
+        """
+        return Upload(self, task, username, temp_dir)
+
     def put(self, task, data_file, username=None):
+        if isinstance(data_file, Upload):
+            data_file.finish()
+            return
+
         task_id = task["id"]
-        data_file.seek(0)
 
         params = {"id": task_id}
         if username:
             params["username"] = username
 
-        status, task= self._request("POST", "task/put", params, data_file)
+        status, task= self._request("POST", "task/put", params, data_file, idempotent=True)
         if status == httplib.CONFLICT:
             self._log.warn("Server refused data for task %s" % task_id)
         elif status == httplib.OK:
@@ -49,22 +150,322 @@ class Tracker:
         else:
             raise Exception("Unexpected status %i" % status)
 
-    def _request(self, method, path, params={}, body=None):
+    def put_chunk(self, task, offset, data, final=False, username=None):
+        """
+        Send part of the results of a task, starting at offset
+
+        Returns the offset up to which the tracker has stored the results, or
+        None if the tracker refused the data. Raises StreamingUnsupported if
+        the tracker does not know task/put_chunk.
+        """
+        params = {"id": task["id"], "offset": offset}
+        if final:
+            params["final"] = 1
+        if username:
+            params["username"] = username
+
+        status, data = self._request("POST", "task/put_chunk", params, data, idempotent=True)
+        if status == httplib.CONFLICT:
+            self._log.warn("Server refused data for task %s" % task["id"])
+            return None
+        elif status == httplib.NOT_FOUND:
+            raise StreamingUnsupported("Tracker does not support streaming uploads")
+        elif status != httplib.OK:
+            raise Exception("Unexpected status %i" % status)
+        return json.loads(data)["offset"]
+
+    def put_offset(self, task):
+        """
+        Returns the offset up to which the tracker has stored the results
+        """
+        status, data = self._request("GET", "task/put_offset", {"id": task["id"]}, idempotent=True)
+        if status == httplib.NOT_FOUND:
+            raise StreamingUnsupported("Tracker does not support streaming uploads")
+        elif status != httplib.OK:
+            raise Exception("Unexpected status %i" % status)
+        return json.loads(data)["offset"]
+
+    def _request(self, method, path, params={}, body=None, idempotent=False):
+        params = dict(params)
         params["version"] = tinyback.__version__
 
-        conn = httplib.HTTPConnection(self._url.netloc)
         path = self._url.path + path
         if len(params):
             path += "?" + urllib.urlencode(params)
 
-        if body:
-            conn.request(method, path, body=body)
+        attempt = 0
+        while True:
+            attempt += 1
+            if hasattr(body, "seek"):
+                body.seek(0)
+            try:
+                status, data = self._send(method, path, body)
+            except _StaleConnection:
+                # The tracker closed an idle connection before reading the
+                # request; sending it again is safe for every call
+                continue
+            except (socket.error, httplib.HTTPException), e:
+                error = "Error contacting tracker: %s" % e
+            else:
+                if status == 403:
+                    self._log.warn("Received 403 Forbidden from tracker")
+                    self._log.warn("Tracker says: %s" % data)
+                    raise Exception("403 Forbidden")
+                if status < 500:
+                    return (status, data)
+                error = "Tracker returned status %i" % status
+
+            if not idempotent or attempt >= self._retries:
+                raise Exception(error)
+            delay = random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt))
+            self._log.warn("%s - Retrying in %.1f seconds" % (error, delay))
+            time.sleep(delay)
+
+    def _send(self, method, path, body):
+        conn = self._pool.get()
+        reused = conn.sock is not None
+        try:
+            if body is not None:
+                conn.request(method, path, body=body)
+            else:
+                conn.request(method, path)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+            if reused and isinstance(e, (httplib.BadStatusLine, socket.error)) and not isinstance(e, socket.timeout):
+                raise _StaleConnection()
+            raise
+
+        if resp.will_close:
+            conn.close()
         else:
-            conn.request(method, path)
-
-        resp = conn.getresponse()
-        if resp.status == 403:
-            self._log.warn("Received 403 Forbidden from tracker")
-            self._log.warn("Tracker says: %s" % resp.read())
-            raise Exception("403 Forbidden")
-        return (resp.status, resp.read())
+            self._pool.put(conn)
+        return (resp.status, data)
+
+class _StaleConnection(Exception):
+    pass
+
+class Upload:
+    """
+    File-like object streaming the results of a task to the tracker
+
+    A background thread sends everything written in CHUNK_SIZE chunks to
+    task/put_chunk, each with its offset in the stream; the tracker answers
+    with the offset up to which it has stored the data. Data is kept in
+    memory until the tracker has acknowledged it, and write blocks while more
+    than MAX_BUFFER bytes are unacknowledged. When sending a chunk fails, the
+    upload waits RESUME_DELAY seconds, asks the tracker for its offset
+    (task/put_offset) and resumes from there. Failures to get the offset count
+    as failures as well; after MAX_RESUMES consecutive failures the upload
+    gives up, drops everything written to it from then on and finish raises
+    the last error.
+
+    If the tracker does not support streaming uploads, all data is kept and
+    finish submits it with Tracker.put instead. Beyond MAX_BUFFER bytes, the
+    data is moved to a temporary file in temp_dir.
+
+    finish sends the rest of the data and waits until the tracker has all of
+    it.
+    """
+
+    def __init__(self, tracker, task, username=None, temp_dir=None):
+        self._log = logging.getLogger("tinyback.Upload")
+        self._tracker = tracker
+        self._task = task
+        self._username = username
+        self._temp_dir = temp_dir
+
+        self._chunks = []
+        self._length = 0
+        self._acked = 0
+        self._finishing = False
+        self._done = False
+        self._closed = False
+        self._unsupported = False
+        self._spill = None
+        self._failures = 0
+        self._error = None
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        if not data:
+            return
+        with self._cond:
+            while self._length > MAX_BUFFER and not self._closed and not self._unsupported:
+                self._cond.wait(1)
+            if self._closed:
+                if self._error is not None:
+                    # The upload failed, finish reports it
+                    return
+                raise ValueError("I/O operation on closed upload")
+            self._chunks.append(data)
+            self._length += len(data)
+            if self._unsupported:
+                if self._spill or self._length > MAX_BUFFER:
+                    self._spill_chunks()
+            elif self._length >= CHUNK_SIZE:
+                self._cond.notify_all()
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        with self._cond:
+            return self._acked + self._length
+
+    def finish(self):
+        with self._cond:
+            self._finishing = True
+            self._cond.notify_all()
+            while not (self._done or self._closed or self._unsupported):
+                self._cond.wait(1)
+            if self._done:
+                return
+            if not self._unsupported:
+                raise Exception("Streaming upload of task %s failed: %s" % (self._task["id"], self._error))
+            if self._spill:
+                self._spill_chunks()
+                data = self._spill
+            else:
+                data = "".join(self._chunks)
+        self._tracker.put(self._task, data, self._username)
+        with self._cond:
+            self._done = True
+            self._close_spill()
+
+    def close(self):
+        """
+        Stop the upload, dropping data that was not sent yet
+        """
+        with self._cond:
+            self._closed = True
+            self._close_spill()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._closed or self._unsupported or self._finishing or self._length >= CHUNK_SIZE):
+                    self._cond.wait()
+                if self._closed or self._unsupported or self._done:
+                    return
+                data = "".join(self._chunks)
+                self._chunks = [data]
+                chunk = data[:CHUNK_SIZE]
+                offset = self._acked
+                final = self._finishing and len(data) <= CHUNK_SIZE
+
+            try:
+                acked = self._tracker.put_chunk(self._task, offset, chunk, final, self._username)
+                if acked is not None and acked < offset:
+                    raise Exception("Tracker lost data before offset %i" % offset)
+            except StreamingUnsupported, e:
+                self._stop_streaming(e)
+                return
+            except Exception, e:
+                self._fail(e)
+                continue
+
+            with self._cond:
+                if acked is None or (final and acked == offset + len(chunk)):
+                    self._done = True
+                    self._cond.notify_all()
+                    return
+                self._failures = 0
+                self._advance(acked)
+
+    def _fail(self, error):
+        """
+        Wait and find out where to resume after a failed chunk
+        """
+        if self._count_failure(error):
+            return
+        self._log.warn("Error streaming task %s: %s - Resuming in %i seconds" % (self._task["id"], error, RESUME_DELAY))
+
+        while True:
+            time.sleep(RESUME_DELAY)
+            with self._cond:
+                if self._closed:
+                    return
+            try:
+                acked = self._tracker.put_offset(self._task)
+            except StreamingUnsupported, e:
+                self._stop_streaming(e)
+                return
+            except Exception, e:
+                self._log.warn("Error asking for offset of task %s: %s" % (self._task["id"], e))
+                if self._count_failure(e):
+                    return
+                continue
+            with self._cond:
+                if acked < self._acked:
+                    # Data before self._acked is gone, start over
+                    self._error = "tracker lost acknowledged data"
+                    self._closed = True
+                    self._cond.notify_all()
+                    return
+                self._advance(acked)
+            self._log.info("Resuming task %s at offset %i" % (self._task["id"], acked))
+            return
+
+    def _count_failure(self, error):
+        """
+        Remember a failure, returns True if the upload gave up
+        """
+        with self._cond:
+            self._failures += 1
+            self._error = error
+            gave_up = self._failures >= MAX_RESUMES
+            if gave_up:
+                self._closed = True
+            self._cond.notify_all()
+            closed = self._closed
+        if gave_up:
+            self._log.error("Giving up on streaming task %s after %i failures" % (self._task["id"], MAX_RESUMES))
+        return closed
+
+    def _stop_streaming(self, error):
+        """
+        Keep all data for Tracker.put, as the tracker does not support
+        streaming uploads
+        """
+        with self._cond:
+            if self._acked:
+                # Cannot happen with a consistent tracker; the acknowledged
+                # data is gone, so it cannot be submitted again
+                self._error = error
+                self._closed = True
+            else:
+                self._log.warn("%s - Submitting task %s at the end" % (error, self._task["id"]))
+                self._unsupported = True
+            self._cond.notify_all()
+
+    def _spill_chunks(self):
+        """
+        Move the data kept for Tracker.put to the temporary file
+        """
+        if not self._spill:
+            self._spill = tempfile.TemporaryFile(dir=self._temp_dir)
+        for data in self._chunks:
+            self._spill.write(data)
+        self._chunks = []
+
+    def _close_spill(self):
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+
+    def _advance(self, acked):
+        """
+        Drop the data the tracker has acknowledged
+        """
+        data = "".join(self._chunks)[acked - self._acked:]
+        self._chunks = [data]
+        self._length = len(data)
+        self._acked = acked
+        self._cond.notify_all()